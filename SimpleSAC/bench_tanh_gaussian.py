@@ -0,0 +1,92 @@
+import timeit
+
+import numpy as np
+import torch
+from torch.distributions import Normal
+from torch.distributions.transformed_distribution import TransformedDistribution
+from torch.distributions.transforms import TanhTransform
+
+import absl.app
+import absl.flags
+
+from .model import ReparameterizedTanhGaussian
+from .utils import define_flags_with_default
+
+
+FLAGS_DEF = define_flags_with_default(
+    batch_size=256,
+    N=10,
+    cql_n_actions=10,
+    action_dim=6,
+    device='cpu',
+    number=200,
+)
+
+
+class DistributionTanhGaussian(ReparameterizedTanhGaussian):
+    """Reference implementation, through torch.distributions objects."""
+
+    def forward(self, mean, log_std, deterministic=False):
+        log_std = torch.clamp(log_std, self.log_std_min, self.log_std_max)
+        std = torch.exp(log_std)
+        action_distribution = TransformedDistribution(
+            Normal(mean, std), TanhTransform(cache_size=1)
+        )
+        if deterministic:
+            action_sample = torch.tanh(mean)
+        else:
+            action_sample = action_distribution.rsample()
+        log_prob = torch.sum(action_distribution.log_prob(action_sample), dim=-1)
+        return action_sample, log_prob
+
+
+def policy_step(module, mean, log_std):
+    """One sample, log-prob and backward pass, as in the policy loss."""
+    mean = mean.detach().requires_grad_()
+    log_std = log_std.detach().requires_grad_()
+    actions, log_prob = module(mean, log_std)
+    (actions.sum() + log_prob.sum()).backward()
+    return actions, log_prob, mean.grad, log_std.grad
+
+
+def main(argv):
+    FLAGS = absl.flags.FLAGS
+    reference, fused = DistributionTanhGaussian(), ReparameterizedTanhGaussian()
+
+    def sync():
+        if FLAGS.device.startswith('cuda'):
+            torch.cuda.synchronize()
+
+    # the shapes ConservativeSAC.train samples actions for
+    shapes = {
+        'B': (FLAGS.batch_size,),
+        'BxN': (FLAGS.batch_size * FLAGS.N,),
+        'Bxcql_n_actions': (FLAGS.batch_size, FLAGS.cql_n_actions),
+    }
+
+    print(f"{'shape':>16} {'reference (us)':>15} {'fused (us)':>11} {'speedup':>8} {'max abs diff':>14}")
+    for name, shape in shapes.items():
+        mean = torch.randn(*shape, FLAGS.action_dim, device=FLAGS.device)
+        log_std = torch.randn(*shape, FLAGS.action_dim, device=FLAGS.device) - 1.
+
+        outputs = []
+        for module in (reference, fused):
+            torch.manual_seed(0)
+            outputs.append(policy_step(module, mean, log_std))
+        max_diff = max(
+            (a - b).abs().max().item() for a, b in zip(*outputs)
+        )
+
+        timings = []
+        for module in (reference, fused):
+            policy_step(module, mean, log_std)
+            sync()
+            timings.append(timeit.timeit(
+                lambda: (policy_step(module, mean, log_std), sync()),
+                number=FLAGS.number) / FLAGS.number * 1e6)
+        print(f"{name:>16} {timings[0]:>15.1f} {timings[1]:>11.1f} "
+              f"{timings[0] / timings[1]:>7.1f}x {max_diff:>14.2e}")
+
+
+if __name__ == '__main__':
+    absl.app.run(main)
@@ -0,0 +1,212 @@
+import json
+import os
+import re
+import struct
+import tempfile
+import threading
+from queue import Queue
+
+import numpy as np
+import torch
+
+
+# same layout as safetensors: an 8 bytes little endian header size, a json header
+# describing every tensor, then the raw tensor bytes
+_NUMPY_DTYPES = {
+    'F64': np.float64, 'F32': np.float32, 'F16': np.float16, 'BF16': np.int16,
+    'I64': np.int64, 'I32': np.int32, 'I16': np.int16, 'I8': np.int8,
+    'U64': np.uint64, 'U32': np.uint32, 'U16': np.uint16, 'U8': np.uint8, 'BOOL': np.bool_,
+}
+_DTYPES = {np.dtype(v): k for k, v in _NUMPY_DTYPES.items() if k != 'BF16'}
+
+
+def flatten_state(state):
+    """Split a nested state into a {name: array or tensor} dict and a json serializable structure.
+
+    Dicts, lists and tuples are walked, tensors and numpy arrays are replaced by
+    references to their flat name, and only plain python scalars are kept as is.
+    """
+    tensors = {}
+
+    def encode(value, name):
+        if torch.is_tensor(value):
+            tensors[name] = value
+            return {'__tensor__': name}
+        if isinstance(value, np.ndarray):
+            tensors[name] = value
+            return {'__ndarray__': name}
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, dict):
+            return {'__dict__': [[k, encode(v, '{}.{}'.format(name, k))] for k, v in value.items()]}
+        if isinstance(value, tuple):
+            return {'__tuple__': [encode(v, '{}.{}'.format(name, i)) for i, v in enumerate(value)]}
+        if isinstance(value, list):
+            return [encode(v, '{}.{}'.format(name, i)) for i, v in enumerate(value)]
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        raise TypeError('Cannot checkpoint value of type {} at {}'.format(type(value), name))
+
+    return tensors, encode(state, 'state')
+
+
+def unflatten_state(tensors, structure, device=None):
+    def decode(value):
+        if isinstance(value, list):
+            return [decode(v) for v in value]
+        if isinstance(value, dict):
+            if '__tensor__' in value:
+                tensor = tensors[value['__tensor__']]
+                if not torch.is_tensor(tensor):
+                    tensor = torch.from_numpy(tensor)
+                if device is not None:
+                    tensor = tensor.to(device)
+                return tensor
+            if '__ndarray__' in value:
+                return tensors[value['__ndarray__']]
+            if '__tuple__' in value:
+                return tuple(decode(v) for v in value['__tuple__'])
+            return {k: decode(v) for k, v in value['__dict__']}
+        return value
+
+    return decode(structure)
+
+
+def save_checkpoint(state, path):
+    """Write state to path atomically, see flatten_state for the supported values."""
+    tensors, structure = flatten_state(state)
+    header, offset = {}, 0
+    buffers = []
+    for name, array in tensors.items():
+        if torch.is_tensor(array):
+            array = array.detach().cpu()
+            if array.dtype == torch.bfloat16:
+                dtype, array = 'BF16', array.view(torch.int16).numpy()
+            else:
+                array = array.numpy()
+                dtype = _DTYPES[array.dtype]
+        else:
+            dtype = _DTYPES[array.dtype]
+        data = np.ascontiguousarray(array).tobytes()
+        header[name] = dict(
+            dtype=dtype, shape=list(array.shape), data_offsets=[offset, offset + len(data)])
+        buffers.append(data)
+        offset += len(data)
+    header['__metadata__'] = {'structure': json.dumps(structure)}
+    header = json.dumps(header).encode('utf-8')
+    # keep the tensor data 8 bytes aligned
+    header += b' ' * (-len(header) % 8)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fout:
+        fout.write(struct.pack('<Q', len(header)))
+        fout.write(header)
+        for data in buffers:
+            fout.write(data)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, device='cpu'):
+    """Read back a state written by save_checkpoint, without unpickling anything."""
+    with open(path, 'rb') as fin:
+        header_size, = struct.unpack('<Q', fin.read(8))
+        header = json.loads(fin.read(header_size))
+        data = fin.read()
+    structure = json.loads(header.pop('__metadata__')['structure'])
+    arrays = {}
+    for name, info in header.items():
+        start, stop = info['data_offsets']
+        array = np.frombuffer(memoryview(data)[start:stop], dtype=_NUMPY_DTYPES[info['dtype']])
+        arrays[name] = array.copy().reshape(info['shape'])
+        if info['dtype'] == 'BF16':
+            arrays[name] = torch.from_numpy(arrays[name]).view(torch.bfloat16)
+    return unflatten_state(arrays, structure, device)
+
+
+def snapshot_state(state):
+    """Copy of the tensors in state, so that training can go on while it is written."""
+    tensors, structure = flatten_state(state)
+    tensors = {
+        name: tensor.detach().to('cpu', copy=True) if torch.is_tensor(tensor) else tensor.copy()
+        for name, tensor in tensors.items()
+    }
+    return unflatten_state(tensors, structure)
+
+
+class CheckpointManager(object):
+    """Rotating checkpoints written in the background, at most one per step.
+
+    Files are named checkpoint_<step>.st in directory, and only the keep most
+    recent ones are kept.
+    """
+
+    _PATTERN = re.compile(r'^checkpoint_(\d+)\.st$')
+
+    def __init__(self, directory, keep=3):
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        self._last_step = None
+        self._queue = Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def steps(self):
+        steps = []
+        for name in os.listdir(self.directory):
+            match = self._PATTERN.match(name)
+            if match:
+                steps.append(int(match.group(1)))
+        return sorted(steps)
+
+    def path(self, step):
+        return os.path.join(self.directory, 'checkpoint_{:08d}.st'.format(step))
+
+    def latest(self):
+        """Path of the most recent checkpoint, None if there is none."""
+        steps = self.steps()
+        if not steps:
+            return None
+        return self.path(steps[-1])
+
+    def load_latest(self, device='cpu'):
+        """Most recent checkpoint that can be read back, None if there is none.
+
+        Unreadable files, e.g. left by a machine that went down while writing,
+        are skipped in favor of older ones.
+        """
+        for step in reversed(self.steps()):
+            try:
+                return load_checkpoint(self.path(step), device)
+            except Exception as e:
+                print(f"Skipping unreadable checkpoint {self.path(step)}: {e}")
+        return None
+
+    def save(self, state, step):
+        """Queue state to be written for step, returns False if step was already saved."""
+        if self._error is not None:
+            raise self._error
+        if step == self._last_step:
+            return False
+        self._last_step = step
+        self._queue.put((snapshot_state(state), step))
+        return True
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk."""
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+
+    def _writer(self):
+        while True:
+            state, step = self._queue.get()
+            try:
+                save_checkpoint(state, self.path(step))
+                for old_step in self.steps()[:-self.keep]:
+                    os.remove(self.path(old_step))
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
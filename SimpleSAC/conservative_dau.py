@@ -184,6 +184,25 @@ class ConservativeDAU(object):
         metrics.update(cql_metrics)
         return metrics
 
+    @property
+    def optimizers(self):
+        return dict(policy=self.policy_optimizer, af=self.af_optimizer, vf=self.vf_optimizer)
+
+    def state_dict(self):
+        """Tensors and optimizer states only, see checkpoint.save_checkpoint."""
+        return dict(
+            modules=[module.state_dict() for module in self.modules],
+            optimizers={k: v.state_dict() for k, v in self.optimizers.items()},
+            total_steps=self._total_steps,
+        )
+
+    def load_state_dict(self, state_dict):
+        for module, module_state in zip(self.modules, state_dict['modules']):
+            module.load_state_dict(module_state)
+        for k, optimizer in self.optimizers.items():
+            optimizer.load_state_dict(state_dict['optimizers'][k])
+        self._total_steps = state_dict['total_steps']
+
     def torch_to_device(self, device):
         for module in self.modules:
             module.to(device)
@@ -1,3 +1,5 @@
+import hashlib
+
 import gym
 
 import absl.app
@@ -7,6 +9,7 @@ from .conservative_sac import ConservativeSAC
 from .replay_buffer import *
 from .model import TanhGaussianPolicy, FullyConnectedQFunction, SamplerPolicy
 from .sampler import TrajSampler
+from .checkpoint import CheckpointManager, load_checkpoint
 from .utils import *
 from viskit.logging import logger, setup_logger
 from dau.code.envs.biped import Walker
@@ -18,7 +21,10 @@ FLAGS_DEF = define_flags_with_default(
     max_traj_length=800,
     seed=42,
     device='cpu',
+    script_policy=False,
     save_model=False,
+    keep_checkpoints=3,
+    resume=False,
     batch_size=256,
     sparse=False,
 
@@ -41,6 +47,8 @@ FLAGS_DEF = define_flags_with_default(
     all_same_N=False,
     # N_datapoints=250000,
     dt_feat=False,
+    normalize_obs=False,
+    normalize_reward=False,
     pretrained_target_path='',
     shared_q_target=False,
     max_q_target=False,
@@ -57,20 +65,37 @@ def main(argv):
     FLAGS = absl.flags.FLAGS
 
     variant = get_user_flags(FLAGS, FLAGS_DEF)
-    wandb_logger = WandBLogger(config=FLAGS.logging, variant=variant)
-    setup_logger(
+    if FLAGS.resume and FLAGS.logging.experiment_id is None:
+        # the same command line maps to the same run, so that a restarted job finds its checkpoints
+        FLAGS.logging.experiment_id = hashlib.sha1(repr(sorted(variant.items())).encode()).hexdigest()
+    wandb_logger = WandBLogger(config=FLAGS.logging, variant=variant, resume=FLAGS.resume)
+
+    checkpoints, checkpoint = None, None
+    if FLAGS.save_model or FLAGS.resume:
+        checkpoints = CheckpointManager(
+            os.path.join(wandb_logger.config.output_dir, 'checkpoints'), FLAGS.keep_checkpoints)
+    if FLAGS.resume:
+        checkpoint = checkpoints.load_latest()
+    resumed = checkpoint is not None
+    if resumed:
+        print(f"Resuming from epoch {checkpoint['epoch']}")
+
+    log_dir = setup_logger(
         variant=variant,
         exp_id=wandb_logger.experiment_id,
         seed=FLAGS.seed,
         base_log_dir=FLAGS.logging.output_dir,
-        include_exp_prefix_sub_dir=False
+        include_exp_prefix_sub_dir=False,
+        log_dir=checkpoint['log_dir'] if resumed else None,
+        resume_rows=checkpoint['epoch'] + 1 if resumed else None,
     )
 
     set_random_seed(FLAGS.seed)
 
     if "pendulum" in FLAGS.env:
         datasets, eval_samplers = {}, {}
-        for dt in [.01, .02, .005]:
+        dts = [.01, .02, .005]
+        for dt in dts:
             env = gym.make('Pendulum-v1').unwrapped
             env.dt = dt
             eval_samplers[dt] = TrajSampler(WrapContinuousPendulumSparse(env),
@@ -84,7 +109,8 @@ def main(argv):
                 half_angle = False
             datasets[dt] = load_pendulum_dataset(
                 f"/root/autodl-tmp/rlmf/pendulum_dataset_{str(dt)[2:]}.hdf5",
-                half_angle=half_angle)
+                half_angle=half_angle,
+                dt_feat=(dt - np.mean(dts)) / np.std(dts) if FLAGS.dt_feat else None)
     elif "door-open-v2-goal-observable" in FLAGS.env:
         # find correct buffer file
         buffers = {
@@ -104,9 +130,10 @@ def main(argv):
             eval_samplers[dt] = TrajSampler(env, FLAGS.max_traj_length)
 
             # fetch dataset
-            dataset = load_door_dataset(buffers[dt], traj_length=500)
-            if FLAGS.sparse:
-                dataset['rewards'] = (dataset['rewards'] == 10.0 * (dt/10)).astype('float32')
+            dataset = load_door_dataset(
+                buffers[dt], traj_length=500,
+                sparse_reward=10.0 * (dt/10) if FLAGS.sparse else None,
+                dt_feat=(dt - np.mean(dts)) / np.std(dts) if FLAGS.dt_feat else None)
             datasets[dt] = dataset
         
         # for dt in range(1,11):
@@ -136,19 +163,25 @@ def main(argv):
             eval_samplers[dt] = TrajSampler(env, FLAGS.max_traj_length)
 
             # fetch dataset
-            dataset = load_door_dataset(buffers[dt], traj_length=traj_lengths[dt])
+            dataset = load_door_dataset(
+                buffers[dt], traj_length=traj_lengths[dt],
+                dt_feat=(dt - np.mean(dts)) / np.std(dts) if FLAGS.dt_feat else None)
             datasets[dt] = dataset
     elif 'kitchen' in FLAGS.env:
         datasets, eval_samplers = {}, {}
+        dts = [30, 40]
         env = gym.make(FLAGS.env)
-        datasets[40] = load_d4rl_dataset(env)
+        datasets[40] = preprocess_dataset(
+            load_d4rl_dataset(env),
+            dt_feat=(40 - np.mean(dts)) / np.std(dts) if FLAGS.dt_feat else None)
         datasets[40]['terminals'] = datasets[40]['dones']
         
         datasets[30] = load_kitchen_dataset(
             '/iris/u/kayburns/continuous-rl/CQL/experiments/collect/kitchen-complete-v0/8e25ba5f337a44d4a27aedc077c4a9bf/buffer.h5py',
             traj_length=666,
             splice=False,
-            filter_bad=True)
+            filter_bad=True,
+            dt_feat=(30 - np.mean(dts)) / np.std(dts) if FLAGS.dt_feat else None)
 
 
         env30 = gym.make(FLAGS.env).unwrapped
@@ -178,11 +211,25 @@ def main(argv):
     else:
         eval_sampler = TrajSampler(gym.make(FLAGS.env).unwrapped, FLAGS.max_traj_length) # TODO
 
-    if FLAGS.load_model:
+    # statistics are computed once from the datasets, and applied to each batch
+    normalizer = None
+    if FLAGS.normalize_obs or FLAGS.normalize_reward:
+        normalizer = DatasetNormalizer.from_datasets(
+            list(datasets.values()), FLAGS.normalize_obs, FLAGS.normalize_reward)
+
+    if not resumed and FLAGS.load_model and not FLAGS.load_model.endswith('.pkl'):
+        checkpoint = load_checkpoint(FLAGS.load_model)
+        print(f"Loaded model from epoch {checkpoint['epoch']}")
+    if checkpoint is not None and checkpoint['normalizer'] is not None:
+        normalizer = DatasetNormalizer.from_state_dict(checkpoint['normalizer'])
+
+    if not resumed and FLAGS.load_model.endswith('.pkl'):
+        # models pickled before the checkpoint format
         loaded_model = wandb_logger.load_pickle_from_filename(FLAGS.load_model)
         print(f"Loaded model from epoch {loaded_model['epoch']}")
         sac = loaded_model['sac']
         policy = sac.policy
+        normalizer = loaded_model.get('normalizer', normalizer)
     else:
         if FLAGS.dt_feat:
             obs_shape = list(eval_samplers.values())[0].env.observation_space.shape[0]+1
@@ -221,12 +268,30 @@ def main(argv):
 
         sac = ConservativeSAC(FLAGS.cql, policy, qf1, qf2, target_qf1, target_qf2)
     sac.torch_to_device(FLAGS.device)
+    if checkpoint is not None:
+        sac.load_state_dict(checkpoint['sac'])
+
+    sampler_policy = SamplerPolicy(policy, FLAGS.device, normalizer, script=FLAGS.script_policy)
+
+    def checkpoint_state(epoch):
+        return {
+            'sac': sac.state_dict(), 'variant': variant, 'epoch': epoch,
+            'normalizer': None if normalizer is None else normalizer.state_dict(),
+            'random_state': get_random_state(),
+            'viskit_metrics': metrics_sink.values,
+            'log_dir': log_dir,
+        }
 
-    sampler_policy = SamplerPolicy(policy, FLAGS.device)
+    start_epoch = 0
+    if resumed:
+        # continue exactly where the checkpointed epoch ended
+        start_epoch = checkpoint['epoch'] + 1
+        set_random_state(checkpoint['random_state'])
+    metrics_sink = MetricsSink(
+        wandb_logger, log_dir, values=checkpoint['viskit_metrics'] if resumed else None)
 
-    viskit_metrics = {}
     dts = sorted(list(eval_samplers.keys()))
-    for epoch in range(FLAGS.n_epochs):
+    for epoch in range(start_epoch, FLAGS.n_epochs):
         metrics = {'epoch': epoch}
 
         with Timer() as train_timer:
@@ -240,23 +305,17 @@ def main(argv):
                     max_steps = 1
                 for dt in dts:
                     # batch_dt is N, 1, D
+                    # the dt feature is already part of the observations when dt_feat is set
                     batch_dt = subsample_flat_batch_n(
                         datasets[dt], per_dataset_batch_size, max_steps)
-                    if FLAGS.dt_feat:
-                        dt_feat = np.ones((per_dataset_batch_size, max_steps, 1))*dt
-                        norm_dt = (dt_feat - np.mean(dts)) / np.std(dts)
-                        batch_dt['observations'] = np.concatenate([
-                            batch_dt['observations'], norm_dt], axis=2
-                        ).astype(np.float32)
-                        batch_dt['next_observations'] = np.concatenate([
-                            batch_dt['next_observations'], norm_dt], axis=2
-                        ).astype(np.float32)
                     batch_dts.append(batch_dt)
 
                 # create a batch which samples equally from each buffer
                 batch = {}
                 for k in batch_dts[0].keys():
                     batch[k] = np.concatenate([b[k] for b in batch_dts], axis=0)
+                if normalizer is not None:
+                    batch = normalizer.normalize_batch(batch)
                 batch = batch_to_torch(batch, FLAGS.device)
                 if FLAGS.N_steps:
                     if FLAGS.all_same_N:
@@ -268,7 +327,10 @@ def main(argv):
                 n_steps = n_steps.repeat_interleave(per_dataset_batch_size)
                 # TODO weird: this is replicating the same indexing per_dataset_batch_size times
                 if FLAGS.shared_q_target:
-                    batch['next_observations'][:,(n_steps-1).long(),-1] = (max(dts) - np.mean(dts)) / np.std(dts)
+                    shared_dt_feat = (max(dts) - np.mean(dts)) / np.std(dts)
+                    if normalizer is not None and normalizer.observation_mean is not None:
+                        shared_dt_feat = (shared_dt_feat - normalizer.observation_mean[-1]) / normalizer.observation_std[-1]
+                    batch['next_observations'][:,(n_steps-1).long(),-1] = shared_dt_feat
                 # discount_arr = torch.Tensor([FLAGS.cql.discount ** (1) for dt in dts]).cuda()
                 discount_arr = torch.Tensor([FLAGS.cql.discount ** (dt/max(dts)) for dt in dts]).cuda()
                 discount_arr =  discount_arr.repeat_interleave(per_dataset_batch_size)
@@ -303,33 +365,29 @@ def main(argv):
                             norm_dt = (dt - np.mean(dts)) / np.std(dts)
                             generate_pendulum_visualization(
                                 sac.policy, sac.qf1, sac.qf2, wandb_logger,
-                                f'val_dt{dt}_epoch{epoch}.png', FLAGS.dt_feat, norm_dt)
+                                f'val_dt{dt}_epoch{epoch}.png', FLAGS.dt_feat, norm_dt,
+                                normalizer)
 
                     if "goal-observable" in FLAGS.env:
                         metrics[f'max_success_{dt}'] = np.mean([np.max(t['successes']) for t in trajs])
                         metrics[f'final_state_success_{dt}'] = np.mean([t['successes'][-1] for t in trajs])
                     metrics[f'average_return_{dt}'] = np.mean([np.sum(t['rewards']) for t in trajs])
                     metrics[f'average_traj_length_{dt}'] = np.mean([len(t['rewards']) for t in trajs])
-                    if FLAGS.save_model:
-                        # if metrics[f'average_return_{dt}'] >= 3:
-                        #     file_name = f"model_r{metrics[f'average_return_{dt}']}_epoch{epoch}.pkl"
-                        # else:
-                        #     file_name = 'model.pkl'
-                        file_name = 'model.pkl'
-                        save_data = {'sac': sac, 'variant': variant, 'epoch': epoch}
-                        wandb_logger.save_pickle(save_data, file_name)
 
         metrics['train_time'] = train_timer()
         metrics['eval_time'] = eval_timer()
         metrics['epoch_time'] = train_timer() + eval_timer()
-        wandb_logger.log(metrics)
-        viskit_metrics.update(metrics)
-        logger.record_dict(viskit_metrics)
-        logger.dump_tabular(with_prefix=False, with_timestamp=False)
-
-    if FLAGS.save_model:
-        save_data = {'sac': sac, 'variant': variant, 'epoch': epoch}
-        wandb_logger.save_pickle(save_data, 'model.pkl')
+        metrics_sink.log(metrics)
+
+        if checkpoints is not None and (epoch == 0 or (epoch + 1) % FLAGS.eval_period == 0):
+            # written in the background, after logging so that a resumed run starts from the next epoch
+            metrics_sink.flush()
+            checkpoints.save(checkpoint_state(epoch), epoch)
+
+    metrics_sink.close()
+    if checkpoints is not None and start_epoch < FLAGS.n_epochs:
+        checkpoints.save(checkpoint_state(epoch), epoch)
+        checkpoints.wait()
 
 if __name__ == '__main__':
     absl.app.run(main)
@@ -0,0 +1,66 @@
+import functools
+import hashlib
+import inspect
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+def cache_dir():
+    path = os.environ.get(
+        'SIMPLESAC_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'SimpleSAC')
+    )
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def cache_key(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def cached_dataset(loader):
+    """Cache the arrays returned by loader(h5path, ...) as .npy files, loaded back memory-mapped.
+
+    Entries are keyed on the loader name, the source path and the bound loader
+    arguments, and are dropped as soon as the source file size or mtime changes.
+    """
+    signature = inspect.signature(loader)
+
+    @functools.wraps(loader)
+    def wrapped(h5path, *args, **kwargs):
+        bound = signature.bind(h5path, *args, **kwargs)
+        bound.apply_defaults()
+        arguments = sorted((k, v) for k, v in bound.arguments.items() if k != 'h5path')
+
+        stat = os.stat(h5path)
+        source_dir = os.path.join(
+            cache_dir(), '{}-{}'.format(loader.__name__, cache_key(os.path.realpath(h5path))))
+        stamp_dir = os.path.join(source_dir, cache_key(stat.st_size, stat.st_mtime_ns))
+        path = os.path.join(stamp_dir, cache_key(arguments))
+
+        if not os.path.isdir(path):
+            # the source changed since the other entries were written
+            if os.path.isdir(source_dir):
+                for stale in os.listdir(source_dir):
+                    if stale != os.path.basename(stamp_dir):
+                        shutil.rmtree(os.path.join(source_dir, stale), ignore_errors=True)
+            os.makedirs(stamp_dir, exist_ok=True)
+            dataset = loader(h5path, *args, **kwargs)
+            tmp_path = tempfile.mkdtemp(dir=stamp_dir)
+            for k, v in dataset.items():
+                np.save(os.path.join(tmp_path, k + '.npy'), np.ascontiguousarray(v))
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # another job stored the same entry first
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+        return {
+            name[:-len('.npy')]: np.load(os.path.join(path, name), mmap_mode='r')
+            for name in sorted(os.listdir(path))
+        }
+
+    return wrapped
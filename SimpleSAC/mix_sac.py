@@ -89,6 +89,9 @@ class MixSAC(object):
         self._total_steps += 1
         batch_size, N, _ = batch['observations'].shape
         n_steps = n_steps.long()-1
+        if 'masks' in batch:
+            # bootstrap from the last step of the sampled episode instead of crossing into the next one
+            n_steps = torch.minimum(n_steps.to(batch['masks'].device), batch['masks'].sum(1).long() - 1)
 
         observations = batch['observations'][:,0,:]
         actions = batch['actions'][:,0,:]
@@ -97,12 +100,9 @@ class MixSAC(object):
         dones = batch['dones'].squeeze()
         replay_mask = torch.logical_not(demo_mask)
 
-        new_actions_demo, log_pi_demo = self.policy(
-            observations[:,:-1], use_second_head=False)
-        new_actions_replay, log_pi_replay = self.policy(
-            observations[:,:-1], use_second_head=True)
-        new_actions = new_actions_demo*demo_mask.unsqueeze(1) + new_actions_replay*replay_mask.unsqueeze(1)
-        log_pi = log_pi_demo*demo_mask + log_pi_replay*replay_mask
+        # demo rows use the first policy head and replay rows the second one
+        new_actions, log_pi = self.policy(
+            observations[:,:-1], second_head_mask=replay_mask)
 
         if self.config.use_automatic_entropy_tuning:
             alpha_loss = -(self.log_alpha() * (log_pi + self.config.target_entropy).detach()).mean()
@@ -125,14 +125,8 @@ class MixSAC(object):
         q1_pred = self.qf1(observations, actions)
         q2_pred = self.qf2(observations, actions)
 
-        new_next_actions_demo, next_log_pi_demo = self.policy(
-            next_observations[:,:-1], use_second_head=False)
-        new_next_actions_replay, next_log_pi_replay = self.policy(
-            next_observations[:,:-1], use_second_head=True)
-        new_next_actions_demo = new_next_actions_demo*demo_mask.repeat_interleave(N).unsqueeze(1)
-        new_next_actions_replay = new_next_actions_replay*replay_mask.repeat_interleave(N).unsqueeze(1)
-        new_next_actions = new_next_actions_demo + new_next_actions_replay
-        next_log_pi = next_log_pi_demo*demo_mask.repeat_interleave(N) + next_log_pi_replay*replay_mask.repeat_interleave(N)
+        new_next_actions, next_log_pi = self.policy(
+            next_observations[:,:-1], second_head_mask=replay_mask.repeat_interleave(N))
         
         target_q_values = torch.min(
             self.target_qf1(next_observations, new_next_actions),
@@ -33,6 +33,7 @@ FLAGS_DEF = define_flags_with_default(
     init_buffer=True,
     seed=42,
     device='cpu',
+    script_policy=False,
     save_model=False,
     dt=40,
 
@@ -179,7 +180,7 @@ def main(argv):
 
     mix_sac.torch_to_device(FLAGS.device)
 
-    sampler_policy = SamplerPolicy(mix_sac.policy, FLAGS.device)
+    sampler_policy = SamplerPolicy(mix_sac.policy, FLAGS.device, script=FLAGS.script_policy)
 
     viskit_metrics = {}
     dts = [80, 40] # we load the replay buffer in first
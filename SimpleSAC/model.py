@@ -2,9 +2,6 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.distributions import Normal
-from torch.distributions.transformed_distribution import TransformedDistribution
-from torch.distributions.transforms import TanhTransform
 
 
 def extend_and_repeat(tensor, dim, repeat):
@@ -99,14 +96,34 @@ class TwoHeadedFullyConnectedNetwork(nn.Module):
             nn.init.orthogonal_(last_fc.weight, gain=np.sqrt(2))
             nn.init.orthogonal_(last_fc_1.weight, gain=np.sqrt(2))
 
-    def forward(self, input_tensor, use_second_head=True):
+    def forward(self, input_tensor, use_second_head=True, second_head_mask=None):
+        hidden = self.network(input_tensor)
+        if second_head_mask is not None:
+            # per-row head selection, both heads share a single trunk pass
+            second_head_mask = second_head_mask.reshape(
+                second_head_mask.shape + (1,) * (hidden.ndim - second_head_mask.ndim))
+            return torch.where(second_head_mask, self.last_fc_1(hidden), self.last_fc(hidden))
         if use_second_head:
-            return self.last_fc_1(self.network(input_tensor))
+            return self.last_fc_1(hidden)
         else:
-            return self.last_fc(self.network(input_tensor))
+            return self.last_fc(hidden)
+
+
+LOG_SQRT_2PI = 0.5 * np.log(2 * np.pi)
+
+
+def normal_log_prob(value, mean, log_std):
+    # same as Normal(mean, exp(log_std)).log_prob(value)
+    return -0.5 * ((value - mean) * torch.exp(-log_std)) ** 2 - log_std - LOG_SQRT_2PI
+
+
+def tanh_log_abs_det_jacobian(pre_tanh_value):
+    # log(1 - tanh(x)^2) in the numerically stable form used by TanhTransform
+    return 2.0 * (np.log(2.0) - pre_tanh_value - F.softplus(-2.0 * pre_tanh_value))
 
 
 class ReparameterizedTanhGaussian(nn.Module):
+    """Tanh squashed gaussian, computed without building torch.distributions objects."""
 
     def __init__(self, log_std_min=-20.0, log_std_max=2.0, no_tanh=False):
         super().__init__()
@@ -116,37 +133,46 @@ class ReparameterizedTanhGaussian(nn.Module):
 
     def log_prob(self, mean, log_std, sample):
         log_std = torch.clamp(log_std, self.log_std_min, self.log_std_max)
-        std = torch.exp(log_std)
         if self.no_tanh:
-            action_distribution = Normal(mean, std)
-        else:
-            action_distribution = TransformedDistribution(
-                Normal(mean, std), TanhTransform(cache_size=1)
-            )
-        return torch.sum(action_distribution.log_prob(sample), dim=-1)
+            return torch.sum(normal_log_prob(sample, mean, log_std), dim=-1)
+        pre_tanh_sample = torch.atanh(sample)
+        log_prob = normal_log_prob(pre_tanh_sample, mean, log_std) \
+            - tanh_log_abs_det_jacobian(pre_tanh_sample)
+        return torch.sum(log_prob, dim=-1)
 
     def forward(self, mean, log_std, deterministic=False):
         log_std = torch.clamp(log_std, self.log_std_min, self.log_std_max)
-        std = torch.exp(log_std)
-
-
-        if self.no_tanh:
-            action_distribution = Normal(mean, std)
-        else:
-            action_distribution = TransformedDistribution(
-                Normal(mean, std), TanhTransform(cache_size=1)
-            )
 
         if deterministic:
             action_sample = torch.tanh(mean)
+            if self.no_tanh:
+                log_prob = normal_log_prob(action_sample, mean, log_std)
+            else:
+                # the pre-tanh sample is the mean itself
+                log_prob = -log_std - LOG_SQRT_2PI - tanh_log_abs_det_jacobian(mean)
+            return action_sample, torch.sum(log_prob, dim=-1)
+
+        noise = torch.randn_like(mean)
+        pre_tanh_sample = mean + torch.exp(log_std) * noise
+        # (pre_tanh_sample - mean) / std is the noise itself
+        log_prob = -0.5 * noise ** 2 - log_std - LOG_SQRT_2PI
+        if self.no_tanh:
+            action_sample = pre_tanh_sample
         else:
-            action_sample = action_distribution.rsample()
+            action_sample = torch.tanh(pre_tanh_sample)
+            log_prob = log_prob - tanh_log_abs_det_jacobian(pre_tanh_sample)
 
-        log_prob = torch.sum(
-            action_distribution.log_prob(action_sample), dim=-1
-        )
+        return action_sample, torch.sum(log_prob, dim=-1)
 
-        return action_sample, log_prob
+    def sample(self, mean, log_std, deterministic=False):
+        # actions only, without building the distributions needed for log_prob
+        if deterministic:
+            return torch.tanh(mean)
+        log_std = torch.clamp(log_std, self.log_std_min, self.log_std_max)
+        action_sample = mean + torch.exp(log_std) * torch.randn_like(mean)
+        if self.no_tanh:
+            return action_sample
+        return torch.tanh(action_sample)
 
 class TanhGaussianPolicy(nn.Module):
 
@@ -183,6 +209,12 @@ class TanhGaussianPolicy(nn.Module):
         log_std = self.log_std_multiplier() * log_std + self.log_std_offset()
         return self.tanh_gaussian(mean, log_std, deterministic)
 
+    def act(self, observations, deterministic: bool = False):
+        base_network_output = self.base_network(observations)
+        mean, log_std = torch.split(base_network_output, self.action_dim, dim=-1)
+        log_std = self.log_std_multiplier() * log_std + self.log_std_offset()
+        return self.tanh_gaussian.sample(mean, log_std, deterministic)
+
 class TwoHeadedTanhGaussianPolicy(nn.Module):
 
     def __init__(self, observation_dim, action_dim, arch='256-256',
@@ -202,35 +234,97 @@ class TwoHeadedTanhGaussianPolicy(nn.Module):
         self.log_std_offset = Scalar(log_std_offset)
         self.tanh_gaussian = ReparameterizedTanhGaussian(no_tanh=no_tanh)
 
-    def log_prob(self, observations, actions, use_second_head=True):
+    def log_prob(self, observations, actions, use_second_head=True, second_head_mask=None):
         if actions.ndim == 3:
             observations = extend_and_repeat(observations, 1, actions.shape[1])
-        base_network_output = self.base_network(observations, use_second_head=use_second_head)
+        base_network_output = self.base_network(
+            observations, use_second_head=use_second_head, second_head_mask=second_head_mask)
         mean, log_std = torch.split(base_network_output, self.action_dim, dim=-1)
         log_std = self.log_std_multiplier() * log_std + self.log_std_offset()
         return self.tanh_gaussian.log_prob(mean, log_std, actions)
 
-    def forward(self, observations, deterministic=False, use_second_head=True, repeat=None):
+    def forward(self, observations, deterministic=False, use_second_head=True, repeat=None,
+                second_head_mask=None):
+        """second_head_mask, a boolean tensor over the leading dim of observations, selects
+        the head row by row and takes precedence over use_second_head."""
         if repeat is not None:
             observations = extend_and_repeat(observations, 1, repeat)
-        base_network_output = self.base_network(observations, use_second_head=use_second_head)
+        base_network_output = self.base_network(
+            observations, use_second_head=use_second_head, second_head_mask=second_head_mask)
         mean, log_std = torch.split(base_network_output, self.action_dim, dim=-1)
         log_std = self.log_std_multiplier() * log_std + self.log_std_offset()
         return self.tanh_gaussian(mean, log_std, deterministic)
 
+    def act(self, observations, deterministic: bool = False, use_second_head: bool = True):
+        base_network_output = self.base_network(observations, use_second_head=use_second_head)
+        mean, log_std = torch.split(base_network_output, self.action_dim, dim=-1)
+        log_std = self.log_std_multiplier() * log_std + self.log_std_offset()
+        return self.tanh_gaussian.sample(mean, log_std, deterministic)
+
+
+class PolicyActor(nn.Module):
+    """Inference-only view of a policy, mapping observations to actions.
+
+    Parameters are shared with the wrapped policy, so a traced actor follows training.
+    """
+
+    def __init__(self, policy, deterministic=False):
+        super().__init__()
+        self.policy = policy
+        self.deterministic = deterministic
+
+    def forward(self, observations):
+        return self.policy.act(observations, self.deterministic)
+
 
 class SamplerPolicy(object):
 
-    def __init__(self, policy, device):
+    def __init__(self, policy, device, normalizer=None, script=False):
         self.policy = policy
         self.device = device
+        self.normalizer = normalizer
+        self.script = script
+        self._actors = {}
+        self._inputs = None
+
+    def normalize_observations(self, observations):
+        """Apply the training observation normalization, if any."""
+        if self.normalizer is None:
+            return observations
+        return self.normalizer.normalize_observations(observations)
+
+    def actor(self, deterministic=False, example_inputs=None):
+        """Actions-only module for the policy, traced with TorchScript when script is set."""
+        deterministic = bool(deterministic)
+        if deterministic not in self._actors:
+            actor = PolicyActor(self.policy, deterministic)
+            if self.script:
+                if example_inputs is None:
+                    example_inputs = torch.zeros(
+                        1, self.policy.observation_dim, device=self.device)
+                with torch.no_grad():
+                    actor = torch.jit.trace(actor, example_inputs, check_trace=False)
+            self._actors[deterministic] = actor
+        return self._actors[deterministic]
+
+    def export(self, path, deterministic=True):
+        """Save a standalone TorchScript actor, observations are expected normalized."""
+        actor = PolicyActor(self.policy, deterministic)
+        example_inputs = torch.zeros(1, self.policy.observation_dim, device=self.device)
+        with torch.no_grad():
+            torch.jit.save(torch.jit.trace(actor, example_inputs, check_trace=False), path)
+
+    def _input_buffer(self, observations):
+        # reused across calls, the env steps with a fixed observation shape
+        if self._inputs is None or self._inputs.shape != observations.shape:
+            self._inputs = torch.empty(
+                observations.shape, dtype=torch.float32, device=self.device)
+        return self._inputs.copy_(torch.as_tensor(observations))
 
     def __call__(self, observations, deterministic=False):
-        with torch.no_grad():
-            observations = torch.tensor(
-                observations, dtype=torch.float32, device=self.device
-            )
-            actions, _ = self.policy(observations, deterministic)
+        with torch.inference_mode():
+            observations = self.normalize_observations(self._input_buffer(observations))
+            actions = self.actor(deterministic, observations)(observations)
             actions = actions.cpu().numpy()
         return actions
 
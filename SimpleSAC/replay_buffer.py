@@ -1,4 +1,5 @@
 from copy import copy, deepcopy
+import functools
 import h5py
 from queue import Queue
 import threading
@@ -8,6 +9,8 @@ import d4rl
 import numpy as np
 import torch
 
+from .data_cache import cached_dataset
+
 
 class ReplayBuffer(object):
     def __init__(self, max_size, data=None):
@@ -33,33 +36,101 @@ class ReplayBuffer(object):
         self._actions = np.zeros((self._max_size, action_dim), dtype=np.float32)
         self._rewards = np.zeros(self._max_size, dtype=np.float32)
         self._dones = np.zeros(self._max_size, dtype=np.float32)
+        # absolute index of the last step of the episode each slot belongs to,
+        # -1 while that episode is still being collected
+        self._episode_ends = np.full(self._max_size, -1, dtype=np.int64)
+        self._episode_start = self._total_steps
         self._next_idx = 0
         self._size = 0
         self._initialized = True
 
-    def add_sample(self, observation, action, reward, next_observation, done):
+    def _fill_episode_ends(self, first_step, last_step, episode_end):
+        """Set the episode end of the stored absolute steps in [first_step, last_step)."""
+        first_step = max(first_step, self._total_steps - self._size)
+        if first_step >= last_step:
+            return
+        start = first_step % self._max_size
+        count = last_step - first_step
+        head = min(count, self._max_size - start)
+        self._episode_ends[start:start + head] = episode_end
+        self._episode_ends[:count - head] = episode_end
+
+    def add_sample(self, observation, action, reward, next_observation, done, timeout=False):
         if not self._initialized:
             self._init_storage(observation.size, action.size)
 
-        self._observations[self._next_idx, :] = np.array(observation, dtype=np.float32)
-        self._next_observations[self._next_idx, :] = np.array(next_observation, dtype=np.float32)
-        self._actions[self._next_idx, :] = np.array(action, dtype=np.float32)
+        # assignment casts to float32 in place, no need for intermediate arrays
+        self._observations[self._next_idx, :] = observation
+        self._next_observations[self._next_idx, :] = next_observation
+        self._actions[self._next_idx, :] = action
         self._rewards[self._next_idx] = reward
-        self._dones[self._next_idx] = float(done)
+        self._dones[self._next_idx] = done
+        self._episode_ends[self._next_idx] = -1
 
         if self._size < self._max_size:
             self._size += 1
         self._next_idx = (self._next_idx + 1) % self._max_size
         self._total_steps += 1
 
-    def add_traj(self, observations, actions, rewards, next_observations, dones):
-        for o, a, r, no, d in zip(observations, actions, rewards, next_observations, dones):
-            self.add_sample(o, a, r, no, d)
+        if done or timeout:
+            self._fill_episode_ends(self._episode_start, self._total_steps, self._total_steps - 1)
+            self._episode_start = self._total_steps
+
+    def add_traj(self, observations, actions, rewards, next_observations, dones, timeouts=None):
+        observations = np.asarray(observations)
+        actions = np.asarray(actions)
+        n_samples = observations.shape[0]
+        if n_samples == 0:
+            return
+        if not self._initialized:
+            self._init_storage(observations[0].size, actions[0].size)
+
+        self._total_steps += n_samples
+        # only the most recent max_size samples survive
+        skip = max(n_samples - self._max_size, 0)
+        self._next_idx = (self._next_idx + skip) % self._max_size
+        n_samples -= skip
+        first_step = self._total_steps - n_samples
+
+        # an episode ends on a done, or on a timeout of the sampler
+        episode_flags = np.asarray(dones)[skip:].astype(bool)
+        if timeouts is not None:
+            episode_flags = episode_flags | np.asarray(timeouts)[skip:].astype(bool)
+        steps = first_step + np.arange(n_samples)
+        end_steps = steps[episode_flags]
+        episode_ends = np.full(n_samples, -1, dtype=np.int64)
+        if end_steps.size:
+            next_end = np.searchsorted(end_steps, steps)
+            closed = next_end < end_steps.size
+            episode_ends[closed] = end_steps[next_end[closed]]
+
+        columns = [
+            (self._observations, observations[skip:].reshape(n_samples, -1)),
+            (self._next_observations, np.asarray(next_observations)[skip:].reshape(n_samples, -1)),
+            (self._actions, actions[skip:].reshape(n_samples, -1)),
+            (self._rewards, np.asarray(rewards)[skip:]),
+            (self._dones, np.asarray(dones)[skip:]),
+            (self._episode_ends, episode_ends),
+        ]
+
+        # at most two slice assignments: up to the end of the storage, then wrapped around
+        head = min(n_samples, self._max_size - self._next_idx)
+        for storage, values in columns:
+            storage[self._next_idx:self._next_idx + head] = values[:head]
+            storage[:n_samples - head] = values[head:]
+
+        self._size = min(self._size + n_samples, self._max_size)
+        self._next_idx = (self._next_idx + n_samples) % self._max_size
+
+        if end_steps.size:
+            # close the episode that was open before this batch
+            self._fill_episode_ends(self._episode_start, first_step, end_steps[0])
+            self._episode_start = end_steps[-1] + 1
 
     def add_batch(self, batch):
         self.add_traj(
             batch['observations'], batch['actions'], batch['rewards'],
-            batch['next_observations'], batch['dones']
+            batch['next_observations'], batch['dones'], batch.get('timeouts')
         )
 
     def sample(self, batch_size):
@@ -67,25 +138,27 @@ class ReplayBuffer(object):
         return self.select(indices)
 
     def sample_n(self, batch_size, n):
-        indices = np.random.randint(len(self) - n, size=batch_size)
-        indices = np.repeat(indices, n) + np.tile(np.arange(n), batch_size)
-        batch = self.select(indices)  # B * N, D
+        """Sample windows of n consecutive steps, shaped (B, N, D).
+
+        The returned masks (B, N) are 1 on the steps of the episode each window
+        starts in, and 0 once that episode has ended. Windows are taken in insertion
+        order across the ring buffer seam and never run past the latest sample.
+        """
+        oldest_step = self._total_steps - self._size
+        starts = oldest_step + np.random.randint(self._size - n + 1, size=batch_size)
+        steps = starts[:, None] + np.arange(n)
+        indices = steps % self._max_size
+        batch = self.select(indices.reshape(-1))  # B * N, D
         # reshape to B, N, D
         for k, v in batch.items():
             if len(v.shape) < 2:
                 batch[k] = v.reshape(batch_size, n, 1)
             else:
                 batch[k] = v.reshape(batch_size, n, -1)
-        # zero out new episodes
-        batch['dones'] = np.cumsum(batch['dones'], axis=1)
-        for k, v in batch.items():
-            if k == 'next_observations':
-                # shift dones to prevent overwriting next_obs
-                dones_shift = np.roll(batch['dones'], 1, axis=1)
-                dones_shift[:, 0, :] = 0
-                batch[k] = np.logical_not(dones_shift) * v
-            else:
-                batch[k] = np.logical_not(batch['dones']) * v
+        episode_ends = self._episode_ends[indices[:, 0]]
+        # the episode still being collected ends at the latest sample
+        episode_ends = np.where(episode_ends < 0, self._total_steps - 1, episode_ends)
+        batch['masks'] = (steps <= episode_ends[:, None]).astype(np.float32)
         return batch
 
     def select(self, indices):
@@ -150,7 +223,178 @@ def load_d4rl_dataset(env):
         dones=dataset['terminals'].astype(np.float32),
     )
 
-def load_pendulum_dataset(h5path, half_angle=False):
+def trajectory_terminals(dones, traj_length):
+    """Terminal flags at every done, and every traj_length steps after a done.
+
+    Steps before the first done are cut every traj_length steps as well.
+    """
+    size = dones.shape[0]
+    done_idxs = np.flatnonzero(dones)
+    starts = np.concatenate([[-1], done_idxs])
+    stops = np.concatenate([done_idxs, [size]])
+    # number of traj_length cuts strictly inside each (start, stop) span
+    counts = (stops - starts - 1) // traj_length
+    ranks = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    terminals = np.zeros(size, dtype=np.float32)
+    terminals[np.repeat(starts, counts) + ranks * traj_length] = 1
+    terminals[done_idxs] = 1
+    return terminals
+
+
+def trajectory_bounds(terminals):
+    """(start, stop) indices of every trajectory closed by a terminal."""
+    stops = np.flatnonzero(terminals) + 1
+    starts = np.concatenate([[0], stops[:-1]])
+    return starts, stops
+
+
+def trajectory_returns(rewards, terminals):
+    """Undiscounted return of every trajectory closed by a terminal."""
+    starts, stops = trajectory_bounds(terminals)
+    if not stops.size:
+        return np.zeros(0)
+    return np.add.reduceat(rewards[:stops[-1]].astype(np.float64), starts)
+
+
+def trajectory_mask(terminals, keep):
+    """Expand a per-trajectory boolean to a per-step mask.
+
+    Steps after the last terminal do not belong to any trajectory and are dropped.
+    """
+    starts, stops = trajectory_bounds(terminals)
+    mask = np.zeros(terminals.shape[0], dtype=bool)
+    if stops.size:
+        mask[:stops[-1]] = np.repeat(keep, stops - starts)
+    return mask
+
+
+def segment_trajectories(dones, rewards, traj_length, min_return=None):
+    """Terminal flags and, if min_return is set, a mask of the steps of trajectories
+    with a return above min_return (None otherwise)."""
+    terminals = trajectory_terminals(dones, traj_length)
+    keep = None
+    if min_return is not None:
+        keep = trajectory_mask(
+            terminals, trajectory_returns(rewards, terminals) > min_return)
+    return dict(terminals=terminals, keep=keep)
+
+
+def preprocess_dataset(dataset, sparse_reward=None, dt_feat=None):
+    """Training-ready relabeling shared by the offline loaders.
+
+    sparse_reward: if set, rewards become 1 where they equal sparse_reward and 0 elsewhere
+    dt_feat: if set, appended to the observations as a constant last feature
+    """
+    if sparse_reward is not None:
+        dataset['rewards'] = (dataset['rewards'] == sparse_reward).astype(np.float32)
+    if dt_feat is not None:
+        for k in ['observations', 'next_observations']:
+            feat = np.full((dataset[k].shape[0], 1), dt_feat, dtype=np.float32)
+            dataset[k] = np.hstack([dataset[k], feat]).astype(np.float32)
+    return dataset
+
+
+def merge_statistics(a, b):
+    """Parallel (Chan et al.) merge of two per-feature {count, mean, var} statistics."""
+    count = a['count'] + b['count']
+    if count == 0:
+        return a
+    delta = b['mean'] - a['mean']
+    mean = a['mean'] + delta * b['count'] / count
+    m2 = a['var'] * a['count'] + b['var'] * b['count'] + delta ** 2 * a['count'] * b['count'] / count
+    return dict(count=count, mean=mean, var=m2 / count)
+
+
+def dataset_statistics(array, chunk_size=1 << 16):
+    """Per-feature {count, mean, var} of a (N, D) array, streamed over row chunks.
+
+    Only one chunk is read at a time, so this works on memory-mapped datasets.
+    """
+    stats = dict(count=0, mean=0., var=0.)
+    for start in range(0, array.shape[0], chunk_size):
+        chunk = np.asarray(array[start:start + chunk_size], dtype=np.float64)
+        stats = merge_statistics(stats, dict(
+            count=chunk.shape[0], mean=chunk.mean(axis=0), var=chunk.var(axis=0)))
+    return stats
+
+
+class DatasetNormalizer(object):
+    """Fixed observation (and optionally reward) normalization from dataset statistics.
+
+    Statistics use the {count, mean, var} format of dau's RunningNormalizer.export,
+    observations are standardized and rewards divided by their std. Either side
+    is left untouched when its statistics are None.
+    """
+
+    def __init__(self, observation_stats=None, reward_stats=None, min_var=1e-2):
+        self.observation_stats = observation_stats
+        self.reward_stats = reward_stats
+        self.min_var = min_var
+        self.observation_mean = self.observation_std = None
+        if observation_stats is not None:
+            self.observation_mean = np.asarray(observation_stats['mean'], dtype=np.float32)
+            self.observation_std = np.sqrt(
+                np.maximum(observation_stats['var'], min_var)).astype(np.float32)
+        self.reward_std = None
+        if reward_stats is not None:
+            self.reward_std = np.float32(np.sqrt(np.maximum(reward_stats['var'], min_var)).item())
+
+    @classmethod
+    def from_datasets(cls, datasets, normalize_observations=True, normalize_rewards=False):
+        """Statistics computed once per dataset, then pooled over all of them."""
+        observation_stats = None
+        if normalize_observations:
+            observation_stats = [dataset_statistics(d['observations']) for d in datasets]
+            observation_stats = functools.reduce(merge_statistics, observation_stats)
+        reward_stats = None
+        if normalize_rewards:
+            reward_stats = [dataset_statistics(d['rewards'].reshape(-1, 1)) for d in datasets]
+            reward_stats = functools.reduce(merge_statistics, reward_stats)
+        return cls(observation_stats, reward_stats)
+
+    def state_dict(self):
+        return dict(observation_stats=self.observation_stats,
+                    reward_stats=self.reward_stats, min_var=self.min_var)
+
+    @classmethod
+    def from_state_dict(cls, state_dict):
+        return cls(**state_dict)
+
+    def normalize_observations(self, observations):
+        if self.observation_mean is None:
+            return observations
+        mean, std = self.observation_mean, self.observation_std
+        if torch.is_tensor(observations):
+            mean, std = self._observation_tensors(observations.device)
+            return (observations - mean) / std
+        return ((observations - mean) / std).astype(np.float32)
+
+    def _observation_tensors(self, device):
+        # kept per device so that sampling does not copy the statistics every step
+        if not hasattr(self, '_tensors'):
+            self._tensors = {}
+        if device not in self._tensors:
+            self._tensors[device] = (
+                torch.as_tensor(self.observation_mean, device=device),
+                torch.as_tensor(self.observation_std, device=device))
+        return self._tensors[device]
+
+    def normalize_rewards(self, rewards):
+        if self.reward_std is None:
+            return rewards
+        return rewards / self.reward_std
+
+    def normalize_batch(self, batch):
+        """Normalized copy of a batch, applied at gather time."""
+        batch = dict(batch)
+        batch['observations'] = self.normalize_observations(batch['observations'])
+        batch['next_observations'] = self.normalize_observations(batch['next_observations'])
+        batch['rewards'] = self.normalize_rewards(batch['rewards'])
+        return batch
+
+
+@cached_dataset
+def load_pendulum_dataset(h5path, half_angle=False, dt_feat=None):
     dataset = load_h5(h5path)
     # subsample trajectories first
     # find the last done = 1
@@ -173,6 +417,8 @@ def load_pendulum_dataset(h5path, half_angle=False):
         v = v.reshape(-1, episode_length, nb_envs, dim_obs)  # this only works for pendulum
         # v = v[:,:,:10,:]
         dataset[k] = v.transpose(0, 2, 1, 3).reshape(-1, dim_obs)
+    dataset['terminals'] = segment_trajectories(
+        dataset['dones'], dataset['rewards'], episode_length)['terminals']
     # then select out correct angles
     if half_angle:
         mask = dataset['observations'][:, 1] >= 0
@@ -180,7 +426,6 @@ def load_pendulum_dataset(h5path, half_angle=False):
         if half_angle:
             v = v[mask]
         dataset[k] = v
-    dataset['terminals'] = dataset['dones']
     # # makes non-sparse
     # def angle_normalize(x):
     #     return ((x + np.pi) % (2 * np.pi)) - np.pi
@@ -189,7 +434,7 @@ def load_pendulum_dataset(h5path, half_angle=False):
     # u = dataset['actions'].squeeze()
     # u = np.clip(u, -max_torque, max_torque)[0]
     # dataset['rewards'] = - (angle_normalize(th) ** 2 + 0.1 * thdot**2 + 0.001 * (u**2))
-    return dataset
+    return preprocess_dataset(dataset, dt_feat=dt_feat)
 
 
 def load_h5(h5path):
@@ -204,46 +449,26 @@ def load_h5(h5path):
     return dataset
 
 
-def load_kitchen_dataset(h5path, traj_length, splice, filter_bad):
+@cached_dataset
+def load_kitchen_dataset(h5path, traj_length, splice, filter_bad, dt_feat=None):
     dataset = load_h5(h5path)
     # track terminal states to prevent indexing across trajs in n-step returns
-    if dataset['dones'].sum():
-        dones = dataset['dones'].nonzero()[0]
-        dataset['terminals'] = np.zeros_like(dataset['dones'])
-        terminal_tracker = min(dones[0], traj_length - 1)
-        for done in dones:
-            while terminal_tracker < done:
-                dataset['terminals'][terminal_tracker] = 1
-                terminal_tracker += traj_length
-            terminal_tracker = done
-        while terminal_tracker <= dataset['terminals'].size:
-            dataset['terminals'][terminal_tracker] = 1
-            terminal_tracker += traj_length
-    else:
-        dataset['terminals'] = np.zeros_like(dataset['dones'])
-        dataset['terminals'][traj_length - 1::traj_length] = 1
+    segments = segment_trajectories(
+        dataset['dones'], dataset['rewards'], traj_length,
+        min_return=1 if filter_bad else None)
+    dataset['terminals'] = segments['terminals']
     if filter_bad:
-        # get reward per trajectory
-        cum_rew = dataset['rewards'].cumsum().astype(int)
-        cum_rew_per_traj = cum_rew[dataset['terminals'].astype(bool)]
-        reward_per_traj = cum_rew_per_traj - np.roll(cum_rew_per_traj, shift=1)
-        reward_per_traj[0] = cum_rew_per_traj[0]
-        start = np.insert(dataset['terminals'].nonzero()[0] + 1, 0, 0)[:-1]
-        stop = dataset['terminals'].nonzero()[0] + 1
         # filter trajectories by reward
-        keep_idxs = np.zeros_like(dataset['terminals']).astype(bool)
-        for reward, start, stop in zip(reward_per_traj, start, stop):
-            if reward > 1:
-                keep_idxs[start:stop] = 1
         for k, v in dataset.items():
-            dataset[k] = v[keep_idxs]
+            dataset[k] = v[segments['keep']]
     if splice:
         for k, v in dataset.items():
             dataset[k] = v[300000:400000]
-    return dataset
+    return preprocess_dataset(dataset, dt_feat=dt_feat)
 
 
-def load_door_dataset(h5path, traj_length):
+@cached_dataset
+def load_door_dataset(h5path, traj_length, sparse_reward=None, dt_feat=None):
     dataset_file = h5py.File(h5path, "r")
     dataset = dict(
         observations=dataset_file["obs"][:].astype(np.float32),
@@ -264,10 +489,9 @@ def load_door_dataset(h5path, traj_length):
         dataset[k] = v.reshape((10000, -1)).squeeze()  # flatten again
 
     # add terminal flag
-    dataset['terminals'] = np.zeros(500000)
-    dataset['terminals'][traj_length - 1::traj_length] = 1
-    dataset['terminals'] = dataset['terminals'][490000:500000]
-    return dataset
+    dataset['terminals'] = trajectory_terminals(
+        np.zeros(500000), traj_length)[490000:500000]
+    return preprocess_dataset(dataset, sparse_reward=sparse_reward, dt_feat=dt_feat)
 
 
 def index_batch(batch, indices):
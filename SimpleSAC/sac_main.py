@@ -31,6 +31,7 @@ FLAGS_DEF = define_flags_with_default(
     init_buffer=False,
     seed=42,
     device='cpu',
+    script_policy=False,
     save_model=False,
     dt=80,
 
@@ -129,7 +130,7 @@ def main(argv):
     sac = SAC(FLAGS.sac, policy, qf1, qf2, target_qf1, target_qf2)
     sac.torch_to_device(FLAGS.device)
 
-    sampler_policy = SamplerPolicy(policy, FLAGS.device)
+    sampler_policy = SamplerPolicy(policy, FLAGS.device, script=FLAGS.script_policy)
 
     viskit_metrics = {}
     for epoch in range(FLAGS.n_epochs):
@@ -12,15 +12,25 @@ class StepSampler(object):
         self._traj_steps = 0
         self._current_observation = self.env.reset()
         self.action_scale = action_scale
+        self._staging = None
+
+    def _staging_block(self, n_steps, observation, action):
+        """Preallocated per-step storage, reused across calls to sample."""
+        if self._staging is None or self._staging['observations'].shape[0] < n_steps:
+            self._staging = dict(
+                observations=np.empty((n_steps, *np.shape(observation)), dtype=np.float32),
+                actions=np.empty((n_steps, *np.shape(action)), dtype=np.float32),
+                rewards=np.empty(n_steps, dtype=np.float32),
+                next_observations=np.empty((n_steps, *np.shape(observation)), dtype=np.float32),
+                dones=np.empty(n_steps, dtype=np.float32),
+                timeouts=np.empty(n_steps, dtype=np.float32),
+            )
+        return {k: v[:n_steps] for k, v in self._staging.items()}
 
     def sample(self, policy, n_steps, deterministic=False, replay_buffer=None):
-        observations = []
-        actions = []
-        rewards = []
-        next_observations = []
-        dones = []
+        staging = None
 
-        for _ in range(n_steps):
+        for i in range(n_steps):
             self._traj_steps += 1
             observation = self._current_observation
             action = policy(
@@ -29,30 +39,30 @@ class StepSampler(object):
             action = action / self.action_scale
             next_observation, reward, done, _ = self.env.step(action)
             # reward = reward * (fs/10)
-            observations.append(observation)
-            actions.append(action*self.action_scale)
-            rewards.append(reward)
-            dones.append(done)
-            next_observations.append(next_observation)
-
-            if replay_buffer is not None:
-                replay_buffer.add_sample(
-                    observation, action*self.action_scale, reward, next_observation, done
-                )
+            if staging is None:
+                staging = self._staging_block(n_steps, observation, action)
+            staging['observations'][i] = observation
+            staging['actions'][i] = action*self.action_scale
+            staging['rewards'][i] = reward
+            staging['dones'][i] = done
+            staging['next_observations'][i] = next_observation
+            timeout = not done and self._traj_steps >= self.max_traj_length
+            staging['timeouts'][i] = timeout
 
             self._current_observation = next_observation
 
-            if done or self._traj_steps >= self.max_traj_length:
+            if done or timeout:
                 self._traj_steps = 0
                 self._current_observation = self.env.reset()
 
-        return dict(
-            observations=np.array(observations, dtype=np.float32),
-            actions=np.array(actions, dtype=np.float32),
-            rewards=np.array(rewards, dtype=np.float32),
-            next_observations=np.array(next_observations, dtype=np.float32),
-            dones=np.array(dones, dtype=np.float32),
-        )
+        if staging is None:
+            return {}
+
+        # commit all the steps to the replay buffer at once
+        if replay_buffer is not None:
+            replay_buffer.add_batch(staging)
+
+        return {k: v.copy() for k, v in staging.items()}
 
     @property
     def env(self):
@@ -138,9 +148,13 @@ class TrajSampler(object):
                 file_path_stem = os.path.splitext(output_file)[0]
                 if qs:
                     q_estimates = []
+                    # the critics were trained on normalized observations
+                    q_observations = np.array(observations)
+                    if hasattr(policy, 'normalize_observations'):
+                        q_observations = policy.normalize_observations(q_observations)
                     for q in qs:
                         q_estimates.append(
-                            q(torch.Tensor(np.array(observations)).cuda(),
+                            q(torch.Tensor(q_observations).cuda(),
                             torch.Tensor(np.array(actions)).cuda()).cpu().detach().numpy())
                     plot_q_over_traj(
                         q_estimates, rewards, imgs, f'{file_path_stem}_q.jpg')
@@ -7,6 +7,9 @@ import os
 from copy import copy
 from socket import gethostname
 import pickle
+import csv
+import threading
+from queue import Queue, Empty
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -24,6 +27,9 @@ import wandb
 
 import torch
 
+from viskit.logging import logger as viskit_logger, ColumnarProgress
+from viskit.tabulate import tabulate
+
 
 class Timer(object):
 
@@ -66,7 +72,7 @@ class WandBLogger(object):
         table = wandb.Table(data=data, columns = ["x", "y"])
         return wandb.plot.line(table, "x", "y")
 
-    def __init__(self, config, variant):
+    def __init__(self, config, variant, resume=False):
         self.config = self.get_default_config(config)
 
         if self.config.experiment_id is None:
@@ -97,6 +103,7 @@ class WandBLogger(object):
             id=self.config.experiment_id,
             anonymous=self.config.anonymous,
             notes=self.config.notes,
+            resume='allow' if resume else None,
             settings=wandb.Settings(
                 start_method="thread",
                 _disable_stats=True,
@@ -137,6 +144,112 @@ class WandBLogger(object):
         return self.config.output_dir
 
 
+class MetricsSink(object):
+    """Queue per-epoch metrics and write them out in batches on a background thread.
+
+    Every record goes to W&B, and its scalars to log_dir/progress.csv and
+    progress.records. As viskit expects, each row holds the latest value of
+    every scalar logged so far. The csv columns are fixed when the first batch
+    is written, scalars first logged after that only go to W&B and
+    progress.records. The terminal table is printed at most once every
+    print_period seconds.
+    """
+
+    def __init__(self, wandb_logger, log_dir, flush_period=5.0, print_period=60.0, values=None):
+        self.wandb_logger = wandb_logger
+        self.csv_path = os.path.join(log_dir, 'progress.csv')
+        self.flush_period = flush_period
+        self.print_period = print_period
+        # latest value of each scalar, kept on the calling thread
+        self.values = dict(values or {})
+        self._queue = Queue()
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        self._error = None
+        self._columns = None
+        if os.path.exists(self.csv_path) and os.path.getsize(self.csv_path) > 0:
+            with open(self.csv_path, newline='') as fin:
+                self._columns = next(csv.reader(fin))
+        self._columnar = ColumnarProgress(os.path.join(log_dir, 'progress.records'), append=True)
+        self._last_print = time.time()
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def is_scalar(value):
+        return isinstance(value, (int, float, np.generic)) or (
+            torch.is_tensor(value) and value.numel() == 1)
+
+    def log(self, metrics):
+        """Non blocking, tensors are only read back on the writer thread."""
+        if self._error is not None:
+            raise self._error
+        self.values.update({k: v for k, v in metrics.items() if self.is_scalar(v)})
+        self._queue.put((dict(metrics), dict(self.values)))
+
+    def flush(self):
+        """Block until every record logged so far is written."""
+        self._wake.set()
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        self._closed.set()
+        self._wake.set()
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _writer(self):
+        while True:
+            # read before draining, so that the last pass after close gets
+            # every record logged before it
+            closed = self._closed.is_set()
+            if not closed:
+                self._wake.wait(self.flush_period)
+                self._wake.clear()
+            records = []
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                if records and self._error is None:
+                    self._write(records)
+            except Exception as e:
+                self._error = e
+            finally:
+                for _ in records:
+                    self._queue.task_done()
+            if closed:
+                break
+
+    def _write(self, records):
+        rows = []
+        for metrics, values in records:
+            self.wandb_logger.log(metrics)
+            rows.append({
+                k: v.item() if torch.is_tensor(v) else v for k, v in values.items()
+            })
+
+        if self._columns is None:
+            self._columns = list(rows[-1].keys())
+            with open(self.csv_path, 'w', newline='') as fout:
+                csv.writer(fout).writerow(self._columns)
+        with open(self.csv_path, 'a', newline='') as fout:
+            writer = csv.DictWriter(fout, self._columns, extrasaction='ignore')
+            writer.writerows(rows)
+        for row in rows:
+            self._columnar.append(row)
+
+        if self._closed.is_set() or time.time() - self._last_print >= self.print_period:
+            self._last_print = time.time()
+            for line in tabulate(sorted(rows[-1].items())).split('\n'):
+                viskit_logger.log(line, with_prefix=False, with_timestamp=False)
+
+
 def define_flags_with_default(**kwargs):
     for key, val in kwargs.items():
         if isinstance(val, ConfigDict):
@@ -162,6 +275,25 @@ def set_random_seed(seed):
     random.seed(seed)
 
 
+def get_random_state():
+    state = dict(
+        python=random.getstate(),
+        numpy=np.random.get_state(),
+        torch=torch.get_rng_state(),
+    )
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_random_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
 def print_flags(flags, flags_def):
     logging.info(
         'Running training with hyperparameters: \n{}'.format(
@@ -213,7 +345,7 @@ def arr_to_th(arr) -> torch.Tensor:
 
     return torch.from_numpy(arr).float().to('cuda')
 
-def generate_pendulum_visualization(policy, qf1, qf2, logger, filename, dt_feat, dt):
+def generate_pendulum_visualization(policy, qf1, qf2, logger, filename, dt_feat, dt, normalizer=None):
     nb_pixels = 50
     theta_space = np.linspace(-np.pi, np.pi, nb_pixels)
     dtheta_space = np.linspace(-10, 10, nb_pixels)
@@ -227,6 +359,8 @@ def generate_pendulum_visualization(policy, qf1, qf2, logger, filename, dt_feat,
     if dt_feat:
         dt_feat = (torch.ones((state_space.shape[0], 1)) * dt).cuda()
         observation = torch.hstack([state_space, dt_feat])
+    if normalizer is not None:
+        observation = normalizer.normalize_observations(observation)
     actions = policy(observation)[0]
     values = qf1(observation, actions).reshape(target_shape).squeeze()
 
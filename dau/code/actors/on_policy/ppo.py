@@ -7,7 +7,7 @@ from torch.distributions.kl import kl_divergence
 from abstract import ParametricFunction
 from actors.on_policy.online_actor import OnlineActorContinuous, OnlineActorDiscrete
 from gym.spaces import Box, Discrete
-from models import ContinuousRandomPolicy, DiscreteRandomPolicy, NormalizedMLP
+from models import ContinuousRandomPolicy, DiscreteRandomPolicy, NormalizedMLP, ActorCriticHead
 
 
 def loss(distr: Distribution, actions: Tensor, critic_value: Tensor,
@@ -86,7 +86,9 @@ class PPOActor(object):
         """Configure actor.
 
         kwargs must contain action_space, observation_space, nb_layers, hidden_size,
-        normalize, dt, eps_clamp, c_kl and c_entropy.
+        normalize, dt, eps_clamp, c_kl and c_entropy. If kwargs contains a
+        shared_function (an ActorCriticMLP), its policy head is used instead
+        of a separate policy network.
         """
         action_space = kwargs['action_space']
         observation_space = kwargs['observation_space']
@@ -99,11 +101,14 @@ class PPOActor(object):
         elif isinstance(action_space, Discrete):
             nb_actions = action_space.n
             policy_generator, actor_generator = DiscreteRandomPolicy, PPOActorDiscrete
-        policy_function = policy_generator(
-            nb_state_feats, nb_actions, kwargs['nb_layers'], kwargs['hidden_size'])
-
-        if kwargs['normalize']:
-            policy_function = NormalizedMLP(policy_function)
+        if kwargs.get('shared_function') is not None:
+            policy_function = ActorCriticHead(kwargs['shared_function'], 'policy')
+        else:
+            policy_function = policy_generator(
+                nb_state_feats, nb_actions, kwargs['nb_layers'], kwargs['hidden_size'])
+
+            if kwargs['normalize']:
+                policy_function = NormalizedMLP(policy_function)
 
         return actor_generator(policy_function, kwargs['dt'], kwargs['c_entropy'],
                                kwargs["eps_clamp"], kwargs["c_kl"])
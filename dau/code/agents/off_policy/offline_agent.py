@@ -1,4 +1,6 @@
-from typing import Optional
+from typing import Optional, Tuple, List
+from threading import Thread, Lock, Condition
+import copy
 from abstract import Arrayable, Tensorable
 from cudaable import Cudaable
 from stateful import StateDict
@@ -9,6 +11,7 @@ from logging import info
 import numpy as np
 from torch import Tensor
 from convert import th_to_arr, arr_to_th
+from nn import normalizers, update_normalizers, modules, hard_update
 from agents.agent import Agent
 from critics.critic import Critic
 from actors.actor import Actor
@@ -26,29 +29,58 @@ class OfflineAgent(CompoundStateful, Agent, Cudaable):
     :args beta: prioritized experience replay parameters (untested)
     :args actor: actor used
     :args critic: critic used
+    :args replay_ratio: number of batches processed per environment
+       interaction. If set, the agent trains to keep this ratio instead of
+       processing learn_per_step batches every steps_btw_train interactions
+    :args async_learn: if True, batches are processed by a learner thread,
+       and environment interaction never waits on training. The replay
+       ratio then defaults to learn_per_step / steps_btw_train
     """
     def __init__(
             self, memory_size: int, batch_size: int,
             steps_btw_train: int, learn_per_step: int,
             alpha: Optional[float], beta: Optional[float],
-            actor: Actor, critic: Critic) -> None:
+            actor: Actor, critic: Critic, replay_ratio: Optional[float] = None,
+            async_learn: bool = False) -> None:
         CompoundStateful.__init__(self)
 
+        # learner thread: the memory lock protects the sampler and the pending
+        # observations, the model lock the actor and critic, which are updated
+        # in place by the learner, and the acting lock the published copy of
+        # the actor used to interact with the environment
+        self._async_learn = async_learn
+        self._learner: Optional[Thread] = None
+        self._memory_lock = Lock()
+        self._model_lock = Lock()
+        self._acting_lock = Lock()
+        self._logs_lock = Lock()
+        self._learn_cond = Condition()
+        self._pending_obs: List[Arrayable] = []
+        self._pending_logs: List[Tuple[int, float, float]] = []
+
         # reset and set in train mode
         self.reset()
         self.train()
 
         # define learning components
         self._actor = actor
+        # the acting copy is not part of the state, it is published from the actor
+        object.__setattr__(self, '_acting_actor', copy.deepcopy(actor) if async_learn else actor)
         self._critic = critic
+        self._normalizers = normalizers(self._actor, self._critic)
         self._sampler = setup_memory(
             alpha=alpha, beta=beta, memory_size=memory_size, batch_size=batch_size)
 
         # counter and parameters
         self._count = 0
+        self._nb_updates = 0
+        self._device = 'cpu'
         self._warm_up = 10 # prevents learning from a near empty buffer
         self._steps_btw_train = steps_btw_train
         self._learn_per_step = learn_per_step
+        if replay_ratio is None and async_learn:
+            replay_ratio = learn_per_step / steps_btw_train
+        self._replay_ratio = replay_ratio
 
     def reset(self):
         """Reset current transition (not memory buffer) !"""
@@ -63,9 +95,12 @@ class OfflineAgent(CompoundStateful, Agent, Cudaable):
     def step(self, obs: Arrayable):
         if self._train:
             self._obs = obs
-            action = self._actor.act_noisy(obs)
+            # only waits for a weight copy, never for an update
+            with self._acting_lock:
+                action = self._acting_actor.act_noisy(obs)
             self._action = action
         else:
+            # the learner is stopped in eval mode
             action = th_to_arr(self._actor.act(obs))
 
         return action
@@ -82,63 +117,152 @@ class OfflineAgent(CompoundStateful, Agent, Cudaable):
             self._reward = reward
             self._done = done
             self._time_limit = time_limit
-            self._sampler.push(
-                self._obs, self._action, self._next_obs,
-                self._reward, self._done, self._time_limit)
+            with self._memory_lock:
+                self._sampler.push(
+                    self._obs, self._action, self._next_obs,
+                    self._reward, self._done, self._time_limit)
+                # the learner applies them between two updates
+                if self._async_learn:
+                    self._pending_obs.append(self._obs)
+            if not self._async_learn:
+                update_normalizers(self._normalizers, self._obs)
             self.learn()
 
-    def learn(self):
-        if self._count % self._steps_btw_train == self._steps_btw_train - 1 and self._count > self._warm_up:
-            cum_critic_loss = 0
-            cum_critic_value = 0
+    def _due_updates(self) -> int:
+        """Number of batches to process to catch up with the replay ratio."""
+        if self._count <= self._warm_up:
+            return 0
+        return int((self._count - self._warm_up) * self._replay_ratio) - self._nb_updates
+
+    def _update(self) -> Tuple[Tensor, Tensor]:
+        """Process one batch, returns the (detached) mean critic loss and value."""
+        with self._memory_lock:
+            batch = self._sampler.sample()
+            pending_obs, self._pending_obs = self._pending_obs, []
+        for obs in pending_obs:
+            update_normalizers(self._normalizers, obs)
+        # the batch is moved to device once, and only tensors are used below
+        obs, action, next_obs, reward, done, weights, time_limit = \
+            [arr_to_th(arr, self._device) if arr is not None else None for arr in batch]
+
+        # don't update when a time limit is reached
+        if time_limit is not None:
+            weights = weights * (1 - time_limit)
 
-            for _ in range(self._learn_per_step):
-                obs, action, next_obs, reward, done, weights, time_limit = \
-                    self._sampler.sample()
+        max_action = self._actor.act(obs)
+        max_next_action = self._actor.act(next_obs, target=True)
 
-                # don't update when a time limit is reached
-                if time_limit is not None:
-                    weights = weights * (1 - time_limit)
+        critic_loss = self._critic.optimize(
+            obs, action, max_action,
+            next_obs, max_next_action, reward, done, time_limit, weights)
+        critic_value = self._critic.critic(
+            obs, max_action)
 
-                max_action = self._actor.act(obs)
-                max_next_action = self._actor.act(next_obs, target=True)
+        self._actor.optimize(-critic_value)
+        with self._memory_lock:
+            self._sampler.observe((critic_loss * weights).detach())
+        self._nb_updates += 1
 
-                critic_loss = self._critic.optimize(
-                    obs, action, max_action,
-                    next_obs, max_next_action, reward, done, time_limit, weights)
-                critic_value = self._critic.critic(
-                    obs, max_action)
+        return (critic_loss * weights).mean().detach(), critic_value.mean().detach()
 
-                weights = arr_to_th(weights, device=critic_loss.device)
-                self._actor.optimize(-critic_value)
-                self._sampler.observe(th_to_arr(critic_loss * weights))
+    def _train_steps(self, nb_updates: int) -> None:
+        # losses are accumulated on device, and only synced once at the end
+        cum_critic_loss, cum_critic_value = 0, 0
+        nb_done = 0
+        for _ in range(nb_updates):
+            with self._model_lock:
+                # the learner thread stops as soon as the agent leaves train mode
+                if not self._train:
+                    break
+                critic_loss, critic_value = self._update()
+            cum_critic_loss = cum_critic_loss + critic_loss
+            cum_critic_value = cum_critic_value + critic_value
+            nb_done += 1
+        if nb_done > 0:
+            if self._async_learn:
+                self._publish()
+            with self._logs_lock:
+                self._pending_logs.append(
+                    (self._count, cum_critic_loss.item() / nb_done,
+                     cum_critic_value.item() / nb_done))
 
-                cum_critic_loss += (critic_loss * weights).mean().item()
-                cum_critic_value += critic_value.mean().item()
+    def _publish(self) -> None:
+        """Copy the weights of the actor to the acting actor."""
+        with self._acting_lock:
+            for module, acting_module in zip(modules(self._actor, targets=False),
+                                             modules(self._acting_actor, targets=False)):
+                hard_update(module, acting_module)
 
-            info(f'At step {self._count}, critic loss: {cum_critic_loss / self._learn_per_step}')
-            info(f'At step {self._count}, critic value: {cum_critic_value / self._learn_per_step}')
-            log("loss/critic", cum_critic_loss / self._learn_per_step, self._count)
-            log("value/critic", cum_critic_value / self._learn_per_step, self._count)
-            self._actor.log()
-            self._critic.log()
+    def _learner_loop(self) -> None:
+        while True:
+            with self._learn_cond:
+                while not (self._train and self._due_updates() > 0):
+                    self._learn_cond.wait()
+                nb_updates = min(self._due_updates(), self._learn_per_step)
+            self._train_steps(nb_updates)
+
+    def _flush_logs(self) -> None:
+        with self._logs_lock:
+            pending_logs, self._pending_logs = self._pending_logs, []
+        if not pending_logs:
+            return
+        for count, critic_loss, critic_value in pending_logs:
+            info(f'At step {count}, critic loss: {critic_loss}')
+            info(f'At step {count}, critic value: {critic_value}')
+            log("loss/critic", critic_loss, count)
+            log("value/critic", critic_value, count)
+        # actor and critic statistics are written by the learner's updates
+        with self._model_lock:
+            for _ in pending_logs:
+                self._actor.log()
+                self._critic.log()
+
+    def learn(self):
+        if self._async_learn:
+            if self._learner is None:
+                self._learner = Thread(target=self._learner_loop, daemon=True)
+                self._learner.start()
+            with self._learn_cond:
+                self._learn_cond.notify()
+        elif self._replay_ratio is not None:
+            nb_updates = self._due_updates()
+            if nb_updates > 0:
+                self._train_steps(nb_updates)
+        elif self._count % self._steps_btw_train == self._steps_btw_train - 1 and self._count > self._warm_up:
+            self._train_steps(self._learn_per_step)
+        self._flush_logs()
 
     def state_dict(self) -> StateDict:
-        state = CompoundStateful.state_dict(self)
+        with self._model_lock:
+            state = CompoundStateful.state_dict(self)
         state["count"] = self._count
         return state
 
     def load_state_dict(self, state_dict: StateDict):
-        CompoundStateful.load_state_dict(self, state_dict)
+        with self._model_lock:
+            CompoundStateful.load_state_dict(self, state_dict)
+            if self._async_learn:
+                self._publish()
         self._count = state_dict["count"]
+        if self._replay_ratio is not None:
+            # do not catch up on the updates of the reloaded run
+            self._nb_updates = self._nb_updates + self._due_updates()
 
     def train(self):
         self._train = True
+        with self._learn_cond:
+            self._learn_cond.notify()
 
     def eval(self):
         self._train = False
+        # wait for the update in progress, if any
+        with self._model_lock:
+            pass
 
     def to(self, device):
+        self._device = device
+        if self._async_learn:
+            object.__setattr__(self, '_acting_actor', self._acting_actor.to(device))
         return CompoundStateful.to(self, device)
 
     def value(self, obs: Arrayable) -> Tensor:
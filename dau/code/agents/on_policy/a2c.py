@@ -1,7 +1,6 @@
 from typing import Union
 from mylog import log
 from logging import info
-from memory.trajectory import Trajectory
 from agents.on_policy.online_agent import OnlineAgent
 from optimizer import setup_optimizer
 from itertools import chain
@@ -34,8 +33,7 @@ class A2CAgent(OnlineAgent):
     def learn(self) -> None:
         if self._count % self._T != self._T - 1:
             return None
-        traj = Trajectory.tobatch(*self._current_trajectories)
-        traj = traj.to(self._device)
+        traj = self._rollout.tobatch()
         v, v_target = self._critic.value_batch(traj)
 
         critic_loss = self._critic.loss(v, v_target)
@@ -1,5 +1,5 @@
 from abc import abstractmethod
-from typing import Optional, List
+from typing import Optional
 
 import numpy as np
 from torch import Tensor
@@ -7,8 +7,9 @@ from torch import Tensor
 from abstract import Arrayable
 from stateful import StateDict
 from stateful import CompoundStateful
-from memory.trajectory import Trajectory
+from memory.trajectory import RolloutStorage
 from convert import th_to_arr, check_array
+from nn import normalizers, update_normalizers
 
 from agents.agent import Agent
 from actors.on_policy.online_actor import OnlineActor, OnlineActorContinuous
@@ -33,15 +34,13 @@ class OnlineAgent(CompoundStateful, Agent):
         # define learning components
         self._actor = actor
         self._critic = critic
+        self._normalizers = normalizers(self._actor, self._critic)
         self._count = 0
         self._T = T
         self._device = "cpu"
+        self._rollout = RolloutStorage(T)
         self.reset()
 
-        # init _nb_train_env and _current_trajectories to None
-        self._nb_train_env: Optional[int] = None
-        self._current_trajectories: List[Trajectory] = []
-
     def step(self, obs: Arrayable) -> np.ndarray:
         if self._mode != "eval":
             action = th_to_arr(self._actor.act_noisy(obs))
@@ -55,11 +54,8 @@ class OnlineAgent(CompoundStateful, Agent):
         return action
 
     def reset(self) -> None:
-        # use _nb_train_env to know if current trajectories were initialized at
-        # some point
-        if self._nb_train_env is not None:
-            self._current_trajectories: List[Trajectory] = \
-                [Trajectory(boundlength=self._T) for _ in range(self._nb_train_env)]
+        # the next transition is observed at step _count + 1
+        self._rollout.reset(self._count + 1)
         self._current_obs = np.array([])
         self._current_action = np.array([])
 
@@ -79,14 +75,9 @@ class OnlineAgent(CompoundStateful, Agent):
             time_limit = np.zeros(done.shape)
         time_limit = check_array(time_limit)
 
-        if not self._current_trajectories:
-            self._nb_train_env = done.shape[0]
-            self._current_trajectories = \
-                [Trajectory(boundlength=self._T) for _ in range(self._nb_train_env)]
-
-        for k, traj in enumerate(self._current_trajectories):
-            traj.push(self._current_obs[k], self._current_action[k], reward[k],
-                      float(done[k]), float(time_limit[k]))
+        update_normalizers(self._normalizers, self._current_obs)
+        self._rollout.push(self._current_obs, self._current_action, reward,
+                           done, time_limit)
 
         self.learn()
 
@@ -120,5 +111,6 @@ class OnlineAgent(CompoundStateful, Agent):
 
     def to(self, device) -> "OnlineAgent":
         self._device = device
+        self._rollout.to(device)
         CompoundStateful.to(self, device)
         return self
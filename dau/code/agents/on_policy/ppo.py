@@ -1,11 +1,14 @@
+import time
 from itertools import chain
 from logging import info
+from typing import Tuple
 
 import torch
+from torch import Tensor
 
 from mylog import log
-from memory.trajectory import Trajectory
 from optimizer import setup_optimizer
+from models import ActorCriticHead
 
 from agents.on_policy.online_agent import OnlineAgent
 from actors.on_policy.online_actor import OnlineActor
@@ -31,40 +34,57 @@ class PPOAgent(OnlineAgent):
         self._learn_per_step = learn_per_step
         self._batch_size = batch_size
 
+        # actor and critic heads of a shared trunk are evaluated in one pass
+        policy_function = self._actor._policy_function
+        v_function = self._critic._v_function
+        self._fused = isinstance(policy_function, ActorCriticHead) \
+            and isinstance(v_function, ActorCriticHead) \
+            and policy_function.shared is v_function.shared
+
+        # shared parameters must only be given once to the optimizer
+        parameters = {id(p): p for p in chain(policy_function.parameters(), v_function.parameters())}
         self._optimizer = setup_optimizer(
-            chain(self._actor._policy_function.parameters(), self._critic._v_function.parameters()),
+            list(parameters.values()),
             opt_name=opt_name,
             lr=lr, dt=dt, inverse_gradient_magnitude=1, weight_decay=weight_decay)
 
+    def _forward(self, obs: Tensor) -> Tuple[Tensor, Tensor]:
+        """Policy output and value on obs, in a single pass for a shared trunk."""
+        if self._fused:
+            policy, v = self._actor._policy_function.shared(obs)
+        else:
+            policy, v = self._actor.policy(obs), self._critic.value(obs)
+        return policy, v.squeeze(-1)
+
     def learn(self) -> None:
         if (self._count + 1) % self._T != 0:
             return None
 
-        traj = Trajectory.tobatch(*self._current_trajectories).to(self._device)
-        v, v_target = self._critic.value_batch(traj)
-
-        obs_flat = traj.obs.flatten(0, 1)
-        actions_flat = traj.actions.flatten(0, 1)
-        distr_flat = self._actor._distr_generator(
-            self._actor.policy(traj.obs.flatten(0, 1)))
-        old_distr = distr_flat.copy()
-        old_logp = distr_flat.log_prob(actions_flat).clone().detach()
-        old_v = v.flatten().clone().detach()
-        critic_value_flat = (v_target - v).flatten()
+        start_time = time.perf_counter()
+        traj = self._rollout.tobatch()
+        with torch.no_grad():
+            v, v_target = self._critic.value_batch(traj)
+
+            obs_flat = traj.obs.flatten(0, 1)
+            actions_flat = traj.actions.flatten(0, 1)
+            old_distr = self._actor._distr_generator(self._actor.policy(obs_flat))
+            old_logp = old_distr.log_prob(actions_flat)
+            old_v = v.flatten()
+            v_target_flat = v_target.flatten()
+            critic_value_flat = (v_target - v).flatten()
         full_batch_size = traj.length * traj.batch_size
 
-
         for ep in range(self._learn_per_step):
-            perm = torch.randperm(full_batch_size)
+            # every sample is visited once per epoch, the last minibatch may be smaller
+            perm = torch.randperm(full_batch_size, device=obs_flat.device)
 
-            for start in range(0, full_batch_size // self._batch_size, self._batch_size):
+            for start in range(0, full_batch_size, self._batch_size):
                 idxs = perm[start:start+self._batch_size]
 
-                v = self._critic.value(obs_flat[idxs]).squeeze()
-                critic_loss = self._critic.loss(
-                    v, v_target.flatten()[idxs].detach(), old_v[idxs].detach())
+                policy, v = self._forward(obs_flat[idxs])
+                critic_loss = self._critic.loss(v, v_target_flat[idxs], old_v[idxs])
                 loss_actor = self._actor.loss(
-                    distr=self._actor._distr_generator(self._actor.policy(obs_flat[idxs])),
+                    distr=self._actor._distr_generator(policy),
                     actions=actions_flat[idxs], critic_value=critic_value_flat[idxs],
                     old_logp=old_logp[idxs],
                     old_distr=old_distr[idxs]
@@ -75,12 +95,17 @@ class PPOAgent(OnlineAgent):
                 loss.backward()
                 self._optimizer.step()
 
+        if obs_flat.is_cuda:
+            torch.cuda.synchronize(obs_flat.device)
+        samples_per_sec = self._learn_per_step * full_batch_size / (time.perf_counter() - start_time)
 
         critic_loss = critic_loss.mean().item()
         critic_value = critic_value_flat.mean().item()
         info(f'At step {self._count}, critic loss: {critic_loss}')
         info(f'At step {self._count}, critic value: {critic_value}')
+        info(f'At step {self._count}, samples/sec: {samples_per_sec:.1f}')
         log("loss/critic", critic_loss, self._count)
         log("value/critic", critic_value, self._count)
+        log("perf/samples_per_sec", samples_per_sec, self._count)
         self._actor.log()
         self._critic.log()
@@ -1,7 +1,69 @@
 import os
+import pickle
+import re
+import tempfile
+from typing import Dict
+import numpy as np
 from analog.load import load, LoadPredicate, ExperimentLog
 from datetime import datetime
 
+SEGMENT_PATTERN = re.compile(r'^segment_(\d+)\.npz$')
+
+def load_kvts(run_dir: str) -> Dict[str, Dict[int, float]]:
+    """Key -> {timestamp: value} logs of a run, as PickleKVTWriter used to store them.
+
+    Reads the segments written by mylog.ArrayKVTWriter in order, so that a
+    later value logged at the same timestamp wins, and falls back on logs.pkl
+    for runs logged before. The segments extend logs.pkl when there is one: it
+    either holds the history of a run resumed after the switch, or was
+    exported from earlier segments.
+    """
+    segment_dir = os.path.join(run_dir, 'kvts')
+    log_file = os.path.join(run_dir, 'logs.pkl')
+    if not os.path.isdir(segment_dir):
+        with open(log_file, 'rb') as f:
+            return pickle.load(f)
+
+    segments = sorted(
+        (int(m.group(1)), m.group(0))
+        for m in map(SEGMENT_PATTERN.match, os.listdir(segment_dir)) if m)
+    logs: Dict[str, Dict[int, float]] = dict()
+    if os.path.isfile(log_file):
+        with open(log_file, 'rb') as f:
+            logs = pickle.load(f)
+    for _, name in segments:
+        with np.load(os.path.join(segment_dir, name)) as segment:
+            keys, offsets = segment['keys'], segment['offsets']
+            timestamps, values = segment['timestamps'].tolist(), segment['values'].tolist()
+        for i, key in enumerate(keys.tolist()):
+            start, stop = offsets[i], offsets[i + 1]
+            logs.setdefault(key, dict()).update(zip(timestamps[start:stop], values[start:stop]))
+    return logs
+
+def export_logs(exp_dir: str):
+    """Write logs.pkl next to every segment log under exp_dir that changed since.
+
+    analog.load only knows about logs.pkl, the export is atomic so that a
+    reader never sees a partial file.
+    """
+    for run_dir, dirnames, _ in os.walk(exp_dir):
+        if 'kvts' not in dirnames:
+            continue
+        segment_dir = os.path.join(run_dir, 'kvts')
+        log_file = os.path.join(run_dir, 'logs.pkl')
+        last_write = max(
+            [os.path.getmtime(os.path.join(segment_dir, name))
+             for name in os.listdir(segment_dir) if SEGMENT_PATTERN.match(name)],
+            default=None)
+        if last_write is None or (
+                os.path.isfile(log_file) and os.path.getmtime(log_file) >= last_write):
+            continue
+        logs = load_kvts(run_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=run_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(logs, f)
+        os.replace(tmp_path, log_file)
+
 def loader(workdir: str, exp_name: str, start_date=None, stop_date=None) -> ExperimentLog:
     list_exp_names = os.listdir(workdir)
     if exp_name not in list_exp_names:
@@ -9,6 +71,7 @@ def loader(workdir: str, exp_name: str, start_date=None, stop_date=None) -> Expe
                          f'is not in the work directory {workdir}')
 
     exp_dir = os.path.join(workdir, exp_name)
+    export_logs(exp_dir)
 
     # build predicate
     if start_date == 'last':
@@ -0,0 +1,69 @@
+"""Benchmark GAE target computation against the reference python loop."""
+import argparse
+import timeit
+
+import torch
+
+from utils import discounted_scan
+
+
+def gae_loop(r, d, tl, v, gamma, lambd):
+    """Reference implementation, one python iteration per timestep."""
+    tl = tl.clone()
+    tl[..., -1] = 1
+    stop = torch.max(d, tl)
+    gae = (1 - tl) * \
+        (r + gamma * (1 - d) * torch.cat([v[..., 1:], v[..., :1]], dim=-1) - v)
+    for t in reversed(range(0, r.shape[-1] - 1)):
+        gae[..., t] += (1 - stop[..., t]) * (gamma * lambd * gae[..., t + 1])
+    return gae
+
+
+def gae_scan(r, d, tl, v, gamma, lambd):
+    tl = tl.clone()
+    tl[..., -1] = 1
+    stop = torch.max(d, tl)
+    gae = (1 - tl) * \
+        (r + gamma * (1 - d) * torch.cat([v[..., 1:], v[..., :1]], dim=-1) - v)
+    return discounted_scan(gae, 1 - stop, gamma * lambd)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--T', type=int, nargs='+', default=[10, 100, 1000],
+                        help='trajectory lengths benchmarked.')
+    parser.add_argument('--nb_envs', type=int, nargs='+', default=[1, 16, 64],
+                        help='numbers of environments benchmarked.')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='device the tensors live on.')
+    parser.add_argument('--number', type=int, default=20,
+                        help='number of timed calls per configuration.')
+    args = parser.parse_args()
+
+    def sync():
+        if args.device.startswith('cuda'):
+            torch.cuda.synchronize()
+
+    print(f"{'T':>6} {'nb_envs':>8} {'loop (ms)':>10} {'scan (ms)':>10} {'speedup':>8}")
+    for T in args.T:
+        for nb_envs in args.nb_envs:
+            r = torch.randn(nb_envs, T, device=args.device)
+            v = torch.randn(nb_envs, T, device=args.device)
+            d = (torch.rand(nb_envs, T, device=args.device) < .05).float()
+            tl = (torch.rand(nb_envs, T, device=args.device) < .01).float()
+            assert torch.equal(gae_loop(r, d, tl, v, .99, .95),
+                               gae_scan(r, d, tl, v, .99, .95))
+
+            timings = []
+            for fn in (gae_loop, gae_scan):
+                fn(r, d, tl, v, .99, .95)
+                sync()
+                timings.append(timeit.timeit(
+                    lambda: (fn(r, d, tl, v, .99, .95), sync()),
+                    number=args.number) / args.number * 1e3)
+            print(f"{T:>6} {nb_envs:>8} {timings[0]:>10.3f} {timings[1]:>10.3f} "
+                  f"{timings[0] / timings[1]:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,8 @@ from actors.on_policy.a2c import A2CActor
 from actors.on_policy.ppo import PPOActor
 from critics.on_policy.ppo import PPOCritic
 from critics.on_policy.a2c import A2CCritic
+from models import ActorCriticMLP, NormalizedMLP
+from gym.spaces import Box
 
 def configure(args) -> Tuple[Agent, Env, Env]:
     """
@@ -63,7 +65,8 @@ def configure(args) -> Tuple[Agent, Env, Env]:
             steps_btw_train=args.steps_btw_train, learn_per_step=args.learn_per_step,
             memory_size=args.memory_size,
             batch_size=args.batch_size, alpha=args.alpha, beta=args.beta,
-            actor=actor, critic=critic)
+            actor=actor, critic=critic, replay_ratio=args.replay_ratio,
+            async_learn=args.async_learn)
     elif args.algo == "a2c":
 
         actor = A2CActor.configure(
@@ -83,12 +86,24 @@ def configure(args) -> Tuple[Agent, Env, Env]:
                          dt=args.dt, weight_decay=args.weight_decay)
     elif args.algo == "ppo":
 
+        shared_function = None
+        if args.shared_trunk:
+            action_space = eval_env.action_space
+            continuous = isinstance(action_space, Box)
+            shared_function = ActorCriticMLP(
+                eval_env.observation_space.shape[-1],
+                action_space.shape[-1] if continuous else action_space.n,
+                args.nb_layers, args.hidden_size, continuous)
+            if args.normalize_state:
+                shared_function = NormalizedMLP(shared_function)
+
         actor = PPOActor.configure(
             action_space=eval_env.action_space,
             observation_space=eval_env.observation_space,
             nb_layers=args.nb_layers, hidden_size=args.hidden_size,
             dt=args.dt, c_entropy=args.c_entropy,
-            eps_clamp=args.eps_clamp, c_kl=args.c_kl, normalize=args.normalize_state
+            eps_clamp=args.eps_clamp, c_kl=args.c_kl, normalize=args.normalize_state,
+            shared_function=shared_function
         )
 
         critic = PPOCritic.configure(
@@ -96,7 +111,7 @@ def configure(args) -> Tuple[Agent, Env, Env]:
             observation_space=eval_env.observation_space,
             nb_layers=args.nb_layers, hidden_size=args.hidden_size,
             noscale=args.noscale, eps_clamp=args.eps_clamp,
-            normalize=args.normalize_state)
+            normalize=args.normalize_state, shared_function=shared_function)
 
         agent = PPOAgent(
             T=args.n_step, actor=actor, critic=critic,
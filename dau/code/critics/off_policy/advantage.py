@@ -4,12 +4,11 @@ from typing import Optional
 
 import torch
 from torch import Tensor
-import numpy as np
 from gym.spaces import Box, Discrete
 
 from abstract import Arrayable, ParametricFunction, Tensorable
 from actors.actor import Actor
-from convert import arr_to_th, check_array, check_tensor
+from convert import check_tensor
 from critics.off_policy.offline_critic import OfflineCritic
 from models import MLP, ContinuousAdvantageMLP, NormalizedMLP
 from nn import soft_update
@@ -69,17 +68,19 @@ class AdvantageCritic(CompoundStateful, OfflineCritic):
         V^*(s) + dt A^*(s, a) = r(s, a) dt + gamma^dt V^*(s)
         A^*(s, a) = adv_function(s, a) - adv_function(s, max_action)
         """
-        obs = check_array(obs)
+        # no-ops when the batch is already on device, as sampled by OfflineAgent
+        obs = check_tensor(obs, self._device)
+        next_obs = check_tensor(next_obs, self._device)
         batch_size = obs.shape[0]
-        action = arr_to_th(action, self._device).type_as(max_action)
-        reward = arr_to_th(reward, self._device)
-        weights = arr_to_th(check_array(weights), self._device)
-        done = arr_to_th(check_array(done).astype('float'), self._device)
+        action = check_tensor(action, self._device).type_as(max_action)
+        reward = check_tensor(reward, self._device)
+        done = check_tensor(done, self._device).float()
 
         v = self._val_function(obs).squeeze()
         next_v = (1 - done) * self._target_val_function(next_obs).squeeze()
+        # a single forward on the concatenated (obs, action) and (obs, max_action)
         pre_advs = self.critic(
-            np.concatenate([obs, obs], axis=0),
+            torch.cat([obs, obs], dim=0),
             torch.cat([action, max_action], dim=0))
         pre_adv, pre_max_adv = pre_advs[:batch_size], pre_advs[batch_size:]
         adv = pre_adv - pre_max_adv
@@ -8,7 +8,7 @@ from torch import Tensor
 
 from abstract import Arrayable, ParametricFunction, Tensorable
 from actors.actor import Actor
-from convert import arr_to_th, check_array, check_tensor
+from convert import check_tensor
 from critics.off_policy.offline_critic import OfflineCritic
 from models import MLP, ContinuousAdvantageMLP, NormalizedMLP
 from nn import soft_update
@@ -62,13 +62,13 @@ class ValueCritic(CompoundStateful, OfflineCritic):
     def optimize(self, obs: Arrayable, action: Arrayable, max_action: Tensor,
                  next_obs: Arrayable, max_next_action: Tensor, reward: Arrayable,
                  done: Arrayable, time_limit: Arrayable, weights: Arrayable) -> Tensor:
-        action = arr_to_th(action, self._device)
-        reward = arr_to_th(reward, self._device)
-        weights = arr_to_th(check_array(weights), self._device)
-        done = arr_to_th(check_array(done).astype('float'), self._device)
+        # no-ops when the batch is already on device, as sampled by OfflineAgent
+        obs = check_tensor(obs, self._device)
+        next_obs = check_tensor(next_obs, self._device)
+        action = check_tensor(action, self._device)
+        reward = check_tensor(reward, self._device)
+        done = check_tensor(done, self._device).float()
 
-        obs = check_array(obs)
-        next_obs = check_array(next_obs)
         q = self.critic(obs, action)
         q_next = self.critic(next_obs, max_next_action, target=True) * (1 - done)
 
@@ -1,9 +1,10 @@
+from typing import Optional
 import torch
 from torch import Tensor
 from critics.on_policy.online_critic import OnlineCritic
 from gym.spaces import Box
 from gym import Space
-from models import MLP, NormalizedMLP
+from models import MLP, NormalizedMLP, ActorCriticHead
 from abstract import ParametricFunction
 
 class PPOCritic(OnlineCritic):
@@ -26,16 +27,20 @@ class PPOCritic(OnlineCritic):
     def loss(self, v: Tensor, v_target: Tensor, old_v: Tensor) -> Tensor:
         assert old_v.shape == v.shape and v_target.shape == v.shape
         loss_unclipped = ((v - v_target.detach()) ** 2)
-        v_clipped = old_v + torch.clamp(v-old_v, -self._eps_clamp, self.eps_clamp)
+        v_clipped = old_v + torch.clamp(v-old_v, -self._eps_clamp, self._eps_clamp)
         loss_clipped = ((v_clipped - v_target.detach()) ** 2)
         return .5 * torch.max(loss_clipped, loss_unclipped).mean()
 
     @staticmethod
     def configure(dt: float, gamma: float, observation_space: Space,
                   nb_layers: int, hidden_size: int,
-                  noscale: bool, eps_clamp: float, normalize: bool) -> "OnlineCritic":
+                  noscale: bool, eps_clamp: float, normalize: bool,
+                  shared_function: Optional[ParametricFunction] = None) -> "OnlineCritic":
 
         assert isinstance(observation_space, Box)
+        if shared_function is not None:
+            return PPOCritic(gamma, dt, ActorCriticHead(shared_function, 'value'), eps_clamp)
+
         nb_state_feats = observation_space.shape[-1]
         v_function = MLP(nb_inputs=nb_state_feats, nb_outputs=1,
                          nb_layers=nb_layers, hidden_size=hidden_size)
@@ -7,7 +7,7 @@ import numpy as np
 from main import evaluate
 from parse import setup_args
 from config import configure
-from mylog import logto
+from mylog import logto, logclose
 
 
 def main(args):
@@ -41,3 +41,4 @@ if __name__ == '__main__':
     except Exception:
         pass # Errors can occur with pickle. Still try to output video even if pickle is corrupted
     main(args)
+    logclose()
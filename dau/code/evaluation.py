@@ -17,7 +17,13 @@ def specific_evaluation(
         log: int,
         dt: float,
         env: Env,
-        agent: Agent):
+        agent: Agent,
+        headless: bool = False):
+    """Log environment specific images, and plot them unless headless.
+
+    In headless mode nothing is drawn and the training loop never sleeps on
+    plt.pause, only the images are handed to the logger.
+    """
 
     if isinstance(env.envs[0].unwrapped, AbstractPusher): # type: ignore
         nb_pixels = 50
@@ -25,11 +31,12 @@ def specific_evaluation(
 
         actions = agent.actions(state_space)
         values = agent.value(state_space)
-        plt.clf()
-        plt.subplot(131)
-        plt.plot(state_space, th_to_arr(values))
-        plt.subplot(132)
-        plt.plot(state_space, th_to_arr(actions))
+        if not headless:
+            plt.clf()
+            plt.subplot(131)
+            plt.plot(state_space, th_to_arr(values))
+            plt.subplot(132)
+            plt.plot(state_space, th_to_arr(actions))
         if isinstance(env.envs[0].unwrapped, ContinuousPusherEnv): # type: ignore
             action_space = np.linspace(-1, 1, nb_pixels)[:, np.newaxis]
             states, actions = np.meshgrid(state_space, action_space)
@@ -37,10 +44,12 @@ def specific_evaluation(
             actions = actions[..., np.newaxis]
             if isinstance(agent, OfflineAgent):
                 advantage = th_to_arr(agent.advantage(states, actions).squeeze())
-                plt.subplot(133)
-                plt.imshow(advantage)
+                if not headless:
+                    plt.subplot(133)
+                    plt.imshow(advantage)
                 log_image('adv', epoch, advantage)
-        plt.pause(.1)
+        if not headless:
+            plt.pause(.1)
     elif isinstance(env.envs[0].unwrapped, PendulumEnv): # type: ignore
         nb_pixels = 50
         theta_space = np.linspace(-np.pi, np.pi, nb_pixels)
@@ -62,27 +71,29 @@ def specific_evaluation(
                 1 - actions).reshape(target_shape).squeeze()
 
         actions = actions.reshape(target_shape).squeeze()
-        plt.figure(0, figsize=(20, 10))
-        plt.clf()
-        plt.subplot(241)
-        plt.imshow(th_to_arr(actions), origin='lower')
         log_image('act', epoch, th_to_arr(actions))
-        plt.subplot(242)
-        plt.imshow(th_to_arr(values), origin='lower')
         log_image('val', epoch, th_to_arr(values))
         if isinstance(agent, OfflineAgent):
-            plt.subplot(243)
-            plt.imshow(th_to_arr(advs), origin='lower')
             log_image('adv', epoch, th_to_arr(advs))
-            plt.subplot(244)
-            plt.imshow(th_to_arr(non_advs), origin='lower')
             log_image('inverse_adv', epoch, th_to_arr(non_advs))
-            plt.subplot(245)
-            plt.hist(th_to_arr(values).reshape(-1), bins=nb_pixels)
-            plt.subplot(246)
-            plt.hist(th_to_arr(non_advs).reshape(-1), bins=nb_pixels)
-        plt.colorbar()
-        plt.pause(.1)
+        if not headless:
+            plt.figure(0, figsize=(20, 10))
+            plt.clf()
+            plt.subplot(241)
+            plt.imshow(th_to_arr(actions), origin='lower')
+            plt.subplot(242)
+            plt.imshow(th_to_arr(values), origin='lower')
+            if isinstance(agent, OfflineAgent):
+                plt.subplot(243)
+                plt.imshow(th_to_arr(advs), origin='lower')
+                plt.subplot(244)
+                plt.imshow(th_to_arr(non_advs), origin='lower')
+                plt.subplot(245)
+                plt.hist(th_to_arr(values).reshape(-1), bins=nb_pixels)
+                plt.subplot(246)
+                plt.hist(th_to_arr(non_advs).reshape(-1), bins=nb_pixels)
+            plt.colorbar()
+            plt.pause(.1)
     elif isinstance(env.envs[0].unwrapped, HillEnv):
         nb_pixels = 50
         state_space = np.linspace(-1, 1, nb_pixels)[:, np.newaxis]
@@ -90,18 +101,21 @@ def specific_evaluation(
         actions = agent.actions(state_space)
         values = agent.value(state_space).squeeze()
 
-        plt.clf()
-        plt.subplot(1, 3, 1)
-        plt.plot(state_space, th_to_arr(values))
-        plt.subplot(1, 3, 2)
-        plt.plot(state_space, th_to_arr(actions))
+        if not headless:
+            plt.clf()
+            plt.subplot(1, 3, 1)
+            plt.plot(state_space, th_to_arr(values))
+            plt.subplot(1, 3, 2)
+            plt.plot(state_space, th_to_arr(actions))
         if isinstance(env.envs[0].unwrapped.action_space, Box): # type: ignore
             action_space = np.linspace(-1, 1, nb_pixels)[:, np.newaxis]
             states, actions = np.meshgrid(state_space, action_space)
             states = states[..., np.newaxis]
             actions = actions[..., np.newaxis]
             advantages = agent.advantage(states, actions).squeeze()
-            plt.subplot(1, 3, 3)
-            plt.imshow(th_to_arr(advantages))
+            if not headless:
+                plt.subplot(1, 3, 3)
+                plt.imshow(th_to_arr(advantages))
             log_image('adv', epoch, th_to_arr(advantages))
-        plt.pause(.1)
+        if not headless:
+            plt.pause(.1)
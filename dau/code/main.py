@@ -15,7 +15,7 @@ from interact import interact
 from evaluation import specific_evaluation
 from memory.buffer import MemorySampler
 from utils import compute_return
-from mylog import log, logto, log_video
+from mylog import log, logto, logclose, log_video
 from parse import setup_args
 from config import configure
 
@@ -41,7 +41,8 @@ def train(nb_steps: int, env: Env, agent: Agent, start_obs: Arrayable):
 def evaluate(dt: float, epoch: int, env: Env, agent: Agent, eval_gap: float,  # noqa: C901
              time_limit: Optional[float] = None, eval_return: bool = False,
              progress_bar: bool = True, video: bool = False, no_log: bool = True,
-             test: bool = False, eval_policy: bool = True) -> Optional[float]:
+             test: bool = False, eval_policy: bool = True,
+             headless: bool = False) -> Optional[float]:
     """Evaluate agent in environment.
 
     :args dt: time discretization
@@ -59,6 +60,7 @@ def evaluate(dt: float, epoch: int, env: Env, agent: Agent, eval_gap: float,  #
     :args test: log to a different test summary
     :args eval_policy: if the exploitation policy is noisy,
         remove the noise before evaluating
+    :args headless: log evaluation images without plotting them
 
     :return: return evaluated, None if no return is evaluated
     """
@@ -99,7 +101,7 @@ def evaluate(dt: float, epoch: int, env: Env, agent: Agent, eval_gap: float,  #
             log_video("demo", epoch, np.stack(imgs, axis=0))
 
     if not no_log:
-        specific_evaluation(epoch, log_gap, dt, env, agent)
+        specific_evaluation(epoch, log_gap, dt, env, agent, headless=headless)
     return R
 
 
@@ -146,7 +148,8 @@ def main(args):
             eval_gap,
             time_limit,
             eval_return=e % log_gap == log_gap - 1,
-            test=False
+            test=False,
+            headless=args.headless
         )
 
         # evaluate with noisy actions
@@ -158,7 +161,8 @@ def main(args):
             time_limit,
             eval_return=e % log_gap == log_gap - 1,
             test=False,
-            eval_policy=False
+            eval_policy=False,
+            headless=args.headless
         )
 
         if args.snapshot and e % snapshot_gap == snapshot_gap - 1:
@@ -172,7 +176,8 @@ def main(args):
             if new_R > R:
                 evaluate(
                     dt, e, eval_env, agent, eval_gap,
-                    time_limit, eval_return=True, test=True)
+                    time_limit, eval_return=True, test=True,
+                    headless=args.headless)
                 info(f"train> Saving new agent with return {new_R}")
                 state_dict = agent.state_dict()
                 state_dict["return"] = new_R
@@ -196,3 +201,4 @@ if __name__ == '__main__':
     logto(args.logdir, reload=not args.noreload)
 
     main(args)
+    logclose()
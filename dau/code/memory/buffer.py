@@ -3,8 +3,8 @@ from typing import Optional, Tuple, Any
 
 import h5py
 import numpy as np
-from abstract import Arrayable
-from convert import check_array
+from abstract import Arrayable, Tensorable
+from convert import check_array, th_to_arr
 
 from memory.sumtree import SumTree
 
@@ -107,7 +107,7 @@ class MemorySampler:
             self._reward[idxs], self._done[idxs], 1.,
             time_limit)
 
-    def observe(self, priorities: Arrayable):
+    def observe(self, priorities: Tensorable):
         pass
 
     def save(self, filename: str) -> None:
@@ -191,9 +191,9 @@ class PrioritizedMemorySampler:
 
         return obs, action, next_obs, reward, done, weights, time_limit
 
-    def observe(self, priorities: Arrayable):
+    def observe(self, priorities: Tensorable):
         assert self._idxs is not None, "No sample before observe ..."
-        priorities = check_array(priorities)
+        priorities = th_to_arr(priorities)
         self._max_priority = max(self._max_priority, priorities.max())
         for idx, prio in zip(self._idxs, priorities):
             self._sum_tree.modify(idx, prio ** self._alpha)
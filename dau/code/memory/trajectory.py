@@ -1,49 +1,72 @@
-from typing import List, Optional
+from typing import Dict, List, Optional, Sequence
 import random
 import numpy as np
-from numpy import array
+import torch
 
 from convert import check_array, check_tensor
 from abstract import Arrayable, Tensorable
 from cudaable import Cudaable
 
+_FIELDS = ("obs", "actions", "rewards", "done", "time_limit")
+
+
 class Trajectory:
     def __init__(self,
-                 obs: Optional[List[np.ndarray]] = None,
-                 actions: Optional[List[np.ndarray]] = None,
-                 rewards: Optional[List[float]] = None,
-                 done: Optional[List[float]] = None,
-                 time_limit: Optional[List[float]] = None,
+                 obs: Optional[Sequence[np.ndarray]] = None,
+                 actions: Optional[Sequence[np.ndarray]] = None,
+                 rewards: Optional[Sequence[float]] = None,
+                 done: Optional[Sequence[float]] = None,
+                 time_limit: Optional[Sequence[float]] = None,
                  boundlength: Optional[int] = None) -> None:
-        """Stores a trajectory as a list of (obs, action, reward, done, time_limit).
+        """Stores a trajectory as contiguous arrays of (obs, action, reward, done, time_limit).
+
+        Transitions live in preallocated buffers, of which [_start, _stop) is
+        the current trajectory, so that slicing a sub trajectory is a view.
 
-        :args obs: initial list of obs
-        :args actions: initial list of actions
-        :args rewards: initial list of rewards
-        :args done: initial list of done signal
-        :args time_limit: initial list of time limits
+        :args obs: initial list (or array) of obs
+        :args actions: initial list (or array) of actions
+        :args rewards: initial list (or array) of rewards
+        :args done: initial list (or array) of done signal
+        :args time_limit: initial list (or array) of time limits
         :args boundlength: max trajectory length
         """
-        if obs is None:
-            obs = []
-        if actions is None:
-            actions = []
-        if rewards is None:
-            rewards = []
-        if done is None:
-            done = []
-        if time_limit is None:
-            time_limit = []
-        self._obs = obs
-        self._actions = actions
-        self._rewards = rewards
-        self._done = done
-        self._time_limit = time_limit
         self._boundlength = boundlength
-
+        self._buffers: Optional[Dict[str, np.ndarray]] = None
+        self._start = 0
+        self._stop = 0
+
+        if obs is not None and len(obs) > 0:
+            self._buffers = dict(
+                obs=check_array(obs), actions=check_array(actions),
+                rewards=check_array(rewards), done=check_array(done),
+                time_limit=check_array(time_limit))
+            self._stop = len(self._buffers["obs"])
+            assert all(len(buf) == self._stop for buf in self._buffers.values())
+            self.boundlength()
+
+    def _allocate(self, obs: np.ndarray, action: np.ndarray) -> None:
+        capacity = 2 * self._boundlength if self._boundlength is not None else 16
+        self._buffers = dict(
+            obs=np.zeros((capacity, *obs.shape)),
+            actions=np.zeros((capacity, *action.shape)),
+            rewards=np.zeros(capacity),
+            done=np.zeros(capacity),
+            time_limit=np.zeros(capacity))
+
+    def _make_room(self) -> None:
+        """Move the trajectory to the front of the buffers, growing them if that frees too little."""
         length = len(self)
-        assert len(self._rewards) == length and len(self._actions) == length \
-            and len(self._done) == length and len(self._time_limit) == length
+        capacity = len(self._buffers["obs"])
+        if 2 * length > capacity:
+            capacity = 2 * capacity
+        for key, buf in self._buffers.items():
+            if capacity != len(buf):
+                new_buf = np.zeros((capacity, *buf.shape[1:]))
+            else:
+                new_buf = buf
+            new_buf[:length] = buf[self._start:self._stop]
+            self._buffers[key] = new_buf
+        self._start, self._stop = 0, length
 
     def push(self, obs: Arrayable, action: Arrayable, reward: float,
              done: float, time_limit: float) -> None:
@@ -54,38 +77,59 @@ class Trajectory:
         obs = check_array(obs)
         action = check_array(action)
 
-        self._obs.append(obs)
-        self._actions.append(action)
-        self._rewards.append(reward)
-        self._done.append(done)
-        self._time_limit.append(time_limit)
+        if self._buffers is None:
+            self._allocate(obs, action)
+        if self._stop == len(self._buffers["obs"]):
+            self._make_room()
+
+        self._buffers["obs"][self._stop] = obs
+        self._buffers["actions"][self._stop] = action
+        self._buffers["rewards"][self._stop] = reward
+        self._buffers["done"][self._stop] = done
+        self._buffers["time_limit"][self._stop] = time_limit
+        self._stop += 1
         self.boundlength()
 
+    def _view(self, key: str) -> np.ndarray:
+        if self._buffers is None:
+            return np.zeros(0)
+        return self._buffers[key][self._start:self._stop]
+
+    @property
+    def obs(self) -> np.ndarray:
+        return self._view("obs")
+
+    @property
+    def actions(self) -> np.ndarray:
+        return self._view("actions")
+
+    @property
+    def rewards(self) -> np.ndarray:
+        return self._view("rewards")
+
+    @property
+    def done(self) -> np.ndarray:
+        return self._view("done")
+
+    @property
+    def time_limit(self) -> np.ndarray:
+        return self._view("time_limit")
+
     def extract(self, length: int) -> "Trajectory":
         """Extract a random sub trajectory of length length."""
         assert length <= len(self)
         start = random.randrange(len(self) - length + 1)
         stop = start + length
-        obs = self._obs[start:stop]
-        actions = self._actions[start:stop]
-        rewards = self._rewards[start:stop]
-        done = self._done[start:stop]
-        time_limit = self._time_limit[start:stop]
-        return Trajectory(obs, actions, rewards, done, time_limit)
+        return Trajectory(*(self._view(key)[start:stop].copy() for key in _FIELDS))
 
     def __len__(self) -> int:
-        return len(self._obs)
+        return self._stop - self._start
 
     def boundlength(self) -> None:
         """Resize trajectory to boundlength if trajectory is too long."""
         if self._boundlength is None or len(self) <= self._boundlength:
             return None
-        delta = max(0, len(self) - self._boundlength)
-        self._obs = self._obs[delta:]
-        self._actions = self._actions[delta:]
-        self._rewards = self._rewards[delta:]
-        self._done = self._done[delta:]
-        self._time_limit = self._time_limit[delta:]
+        self._start = self._stop - self._boundlength
         assert len(self) == self._boundlength
 
     @property
@@ -94,33 +138,16 @@ class Trajectory:
         if len(self) == 0:
             return False
 
-        return self._done[-1] == 1.
+        return self.done[-1] == 1.
 
     @staticmethod
     def tobatch(*trajs: "Trajectory") -> "BatchTraj":
         """Turn a list of trajs into a batch of trajs."""
-        batch_size = len(trajs)
         length_traj = len(trajs[0])
         assert all(len(traj) == length_traj for traj in trajs)
 
-        obs_shape = trajs[0]._obs[0].shape
-        action_shape = trajs[0]._actions[0].shape
-
-        obs = np.zeros((batch_size, length_traj, *obs_shape))
-        actions = np.zeros((batch_size, length_traj, *action_shape))
-        rewards = np.zeros((batch_size, length_traj))
-        done = np.zeros((batch_size, length_traj))
-        time_limit = np.zeros((batch_size, length_traj))
-        for i, traj in enumerate(trajs):
-            assert obs[i, :].shape == array(traj._obs).shape \
-                and actions[i, :].shape == array(traj._actions).shape
-            obs[i, :] = array(traj._obs)
-            actions[i, :] = array(traj._actions)
-            rewards[i, :] = array(traj._rewards)
-            done[i, :] = array(traj._done)
-
-        return BatchTraj(obs=obs, actions=actions, rewards=rewards,
-                         done=done, time_limit=time_limit)
+        return BatchTraj(**{key: np.stack([traj._view(key) for traj in trajs])
+                            for key in _FIELDS})
 
 
 class BatchTraj(Cudaable):
@@ -165,38 +192,143 @@ class BatchTraj(Cudaable):
     def device(self):
         return self.obs.device
 
+class RolloutStorage(Cudaable):
+    """Fixed size (T, nb_envs, ...) storage of the last T transitions of each environment.
+
+    Tensors are allocated once, on the storage device, and written in place.
+    The transition of step t is written on row t % T, so a window ending
+    on row T - 1 is read back without any copy.
+
+    :args T: number of transitions kept per environment
+    """
+    def __init__(self, T: int) -> None:
+        self._T = T
+        self._device = "cpu"
+        self._buffers: Optional[Dict[str, torch.Tensor]] = None
+        self._step = 0
+        self._length = 0
+
+    def reset(self, step: int) -> None:
+        """Drop the stored transitions, next push is step step."""
+        self._step = step
+        self._length = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def push(self, obs: Arrayable, action: Arrayable, reward: Arrayable,
+             done: Arrayable, time_limit: Arrayable) -> None:
+        """Push one transition per environment (before seing the next observation)."""
+        values = dict(obs=obs, actions=action, rewards=reward,
+                      done=done, time_limit=time_limit)
+        values = {key: torch.as_tensor(check_array(value), dtype=torch.float32)
+                  for key, value in values.items()}
+        if self._buffers is None:
+            self._buffers = {key: torch.zeros((self._T, *value.shape), device=self._device)
+                             for key, value in values.items()}
+
+        row = self._step % self._T
+        for key, value in values.items():
+            self._buffers[key][row].copy_(value)
+        self._step += 1
+        self._length = min(self._length + 1, self._T)
+
+    def tobatch(self) -> "BatchTraj":
+        """Stored transitions as a (nb_envs, length) batch of trajectories, oldest first."""
+        stop = (self._step - 1) % self._T + 1
+        start = stop - self._length
+        if start >= 0:
+            batch = {key: buf[start:stop] for key, buf in self._buffers.items()}
+        else:
+            batch = {key: torch.cat([buf[start:], buf[:stop]])
+                     for key, buf in self._buffers.items()}
+        return BatchTraj(**{key: value.transpose(0, 1) for key, value in batch.items()})
+
+    def to(self, device) -> "RolloutStorage":
+        self._device = device
+        if self._buffers is not None:
+            self._buffers = {key: buf.to(device) for key, buf in self._buffers.items()}
+        return self
+
+
 class MemoryTrajectory:
+    """Stores whole trajectories back to back in one flat arena.
+
+    Trajectory i occupies [_starts[i], _starts[i] + _lengths[i]) of the arena
+    arrays, so that any set of sub trajectories can be gathered at once.
+
+    :args maxsize: max number of transitions kept, oldest trajectories are
+        dropped first
+    :args memory: initial list of trajectories
+    """
     def __init__(self, maxsize: int, memory: Optional[List[Trajectory]] = None) -> None:
         self._maxsize = maxsize
-        if memory is None:
-            memory = []
-        self._memory: List[Trajectory] = memory
-        self._cumsizes: List[int] = np.cumsum([len(traj) for traj in self._memory]).tolist()
+        self._arena: Optional[Dict[str, np.ndarray]] = None
+        self._starts: List[int] = []
+        self._lengths: List[int] = []
+        self._stop = 0
+        for traj in memory or []:
+            self.push(traj)
 
     def __len__(self) -> int:
-        return len(self._memory)
+        return len(self._starts)
 
     @property
     def size(self) -> int:
-        if len(self._cumsizes) == 0:
+        if len(self._starts) == 0:
             return 0
-        return self._cumsizes[-1]
+        return self._stop - self._starts[0]
+
+    def _reserve(self, length: int) -> None:
+        """Make room for length more transitions at the end of the arena."""
+        capacity = len(self._arena["obs"])
+        if self._stop + length <= capacity:
+            return None
+        first = self._starts[0] if self._starts else self._stop
+        size = self._stop - first
+        capacity = max(capacity, 2 * (size + length))
+        for key, buf in self._arena.items():
+            if capacity != len(buf):
+                new_buf = np.zeros((capacity, *buf.shape[1:]))
+            else:
+                new_buf = buf
+            new_buf[:size] = buf[first:self._stop]
+            self._arena[key] = new_buf
+        self._starts = [start - first for start in self._starts]
+        self._stop = size
 
     def _reducesize(self) -> None:
         if self.size < self._maxsize:
             return None
-        i, subsize = next((i, cumsize_i) for i, cumsize_i in enumerate(self._cumsizes)
-                          if cumsize_i > self.size - self._maxsize)
-        self._memory = self._memory[i+1:]
-        self._cumsizes = [s - subsize for s in self._cumsizes[i+1:]]
+        cumsizes = np.cumsum(self._lengths)
+        i = int(np.argmax(cumsizes > self.size - self._maxsize))
+        self._starts = self._starts[i+1:]
+        self._lengths = self._lengths[i+1:]
 
     def push(self, trajectory: Trajectory) -> None:
-        self._memory.append(trajectory)
-        self._cumsizes.append(self.size + len(trajectory))
+        length = len(trajectory)
+        if length > 0:
+            if self._arena is None:
+                self._arena = {key: np.zeros((length, *trajectory._view(key).shape[1:]))
+                               for key in _FIELDS}
+            self._reserve(length)
+            for key in _FIELDS:
+                self._arena[key][self._stop:self._stop + length] = trajectory._view(key)
+        self._starts.append(self._stop)
+        self._lengths.append(length)
+        self._stop += length
         self._reducesize()
 
+    def gather(self, idxs: np.ndarray, offsets: np.ndarray, length: int) -> Dict[str, np.ndarray]:
+        """Gather sub trajectories of the given length, starting offsets[j] steps into idxs[j]."""
+        starts = np.array([self._starts[i] for i in idxs])
+        steps = (starts + offsets)[:, None] + np.arange(length)
+        return {key: self._arena[key][steps] for key in _FIELDS}
+
     def choose(self, idxs: List[int]) -> List[Trajectory]:
-        return [self._memory[i] for i in idxs]
+        return [Trajectory(*(self._arena[key][self._starts[i]:self._starts[i] + self._lengths[i]]
+                             for key in _FIELDS))
+                for i in idxs]
 
 
 class MemorySampler:
@@ -206,31 +338,25 @@ class MemorySampler:
         self._batch_size = batch_size
         self._length_traj = length_traj
 
+    def _sample_idxs(self) -> np.ndarray:
+        """Batch of distinct trajectory indices, in O(batch_size) rather than O(len(memory)).
+
+        Draws with replacement and redraws the duplicates, which only takes a
+        few rounds since the memory is larger than the batch once warmed up.
+        """
+        size = len(self._memory)
+        idxs = np.unique(np.random.randint(size, size=self._batch_size))
+        while len(idxs) < self._batch_size:
+            extra = np.random.randint(size, size=self._batch_size - len(idxs))
+            idxs = np.unique(np.concatenate([idxs, extra]))
+        return np.random.permutation(idxs)
+
     def sample_batch(self) -> BatchTraj:
-        idxs = random.sample([i for i in range(len(self._memory))], self._batch_size)
-        trajs = self._memory.choose(idxs)
-        trajs_truncated = [traj.extract(self._length_traj) for traj in trajs]
-
-        obs_shape = trajs_truncated[0]._obs[0].shape
-        action_shape = trajs_truncated[0]._actions[0].shape
-
-        obs = np.zeros((self._batch_size, self._length_traj, *obs_shape))
-        actions = np.zeros((self._batch_size, self._length_traj, *action_shape))
-        rewards = np.zeros((self._batch_size, self._length_traj))
-        done = np.zeros((self._batch_size, self._length_traj))
-        tl = np.zeros((self._batch_size, self._length_traj))
-
-        for i, traj in enumerate(trajs_truncated):
-            for t in range(self._length_traj):
-                obs[i, t] = traj._obs[t]
-                actions[i, t] = traj._actions[t]
-                rewards[i, t] = traj._rewards[t]
-                done[i, t] = traj._done[t]
-                tl[i, t] = traj._time_limit[t]
-
-        batchtraj = BatchTraj(obs=obs, actions=actions, rewards=rewards,
-                              done=done, time_limit=tl)
-        return batchtraj
+        idxs = self._sample_idxs()
+        lengths = np.array([self._memory._lengths[i] for i in idxs])
+        assert (lengths >= self._length_traj).all()
+        offsets = np.random.randint(lengths - self._length_traj + 1)
+        return BatchTraj(**self._memory.gather(idxs, offsets, self._length_traj))
 
     def warmed_up(self) -> bool:
         return len(self._memory) > self._batch_size
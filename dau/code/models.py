@@ -1,5 +1,7 @@
 """Define pytorch models."""
 from collections import OrderedDict
+from typing import Dict
+import numpy as np
 import torch
 import torch.nn as nn
 from torch import Tensor
@@ -69,52 +71,92 @@ class ContinuousAdvantageMLP(MLP, ParametricFunction):
     def output_shape(self) -> Shape:
         return ((self._nb_outputs,),)
 
-class CustomBN(nn.Module):
-    """Normalize layer outputs by mean and stds of features.
+class RunningNormalizer(nn.Module):
+    """Normalize features by the mean and std of all the batches it was updated on.
 
-    The layer stores estimates of the mean and std on all previously seen
-    outputs, and normalize by these quantities.
-    :args nb_feats: number of output features of the previous layer
-    :args eps: numerical regularization of std (to prevent 0 std)
+    Statistics are only updated by explicit calls to update, with Chan et al.
+    parallel Welford merges in float64, so forwards (evaluation, target
+    networks, ...) never change them. The std used for normalization is
+    cached at each update.
+    :args nb_feats: number of features
+    :args min_var: numerical regularization of the variance (to prevent 0 std)
     """
-    def __init__(self, nb_feats: int, eps: float = 1e-5) -> None:
+    def __init__(self, nb_feats: int, min_var: float = 1e-2) -> None:
         super().__init__()
-        self._eps = eps
-        self.register_buffer('_count', torch.zeros(1, requires_grad=False))
-        self.register_buffer('_mean', torch.zeros(nb_feats, requires_grad=False))
-        self.register_buffer('_squared_mean', torch.ones(nb_feats, requires_grad=False))
+        self._min_var = min_var
+        self.register_buffer('_count', torch.zeros((), dtype=torch.float64))
+        self.register_buffer('_mean', torch.zeros(nb_feats, dtype=torch.float64))
+        self.register_buffer('_m2', torch.zeros(nb_feats, dtype=torch.float64))
+        self.register_buffer('_norm_mean', torch.zeros(nb_feats))
+        self.register_buffer('_norm_std', torch.ones(nb_feats))
 
     def forward(self, *inputs: Tensorable) -> torch.Tensor:
-        device = self._mean.device # type: ignore
-        t_input = check_tensor(inputs[0], device)
-        batch_size = t_input.size(0)
-
-        mean_shape = tuple(self._mean.size())
-        std = torch.sqrt(torch.clamp(self._squared_mean - self._mean ** 2, min=1e-2)) # type: ignore
-        output = (t_input - self._mean) / std # type: ignore
-        with torch.no_grad():
-            self._mean = (
-                self._mean * self._count +
-                batch_size * t_input.view(-1, *mean_shape).mean(dim=0)) \
-                / (self._count + batch_size) # type: ignore
-            self._squared_mean = (
-                self._squared_mean * self._count +
-                batch_size * (t_input.view(-1, *mean_shape) ** 2).mean(dim=0)) \
-                / (self._count + batch_size) # type: ignore
-            self._count += batch_size
-        return output
+        t_input = check_tensor(inputs[0], self._norm_mean.device)
+        return (t_input - self._norm_mean) / self._norm_std
+
+    @torch.no_grad()
+    def update(self, batch: Tensorable) -> None:
+        """Merge the statistics of a (..., nb_feats) batch."""
+        batch = check_tensor(batch, self._mean.device).reshape(-1, self._mean.shape[0]).double()
+        batch_count = batch.shape[0]
+        if batch_count == 0:
+            return
+        batch_mean = batch.mean(dim=0)
+        batch_m2 = ((batch - batch_mean) ** 2).sum(dim=0)
+
+        count = self._count + batch_count
+        delta = batch_mean - self._mean
+        self._mean.add_(delta * batch_count / count)
+        self._m2.add_(batch_m2 + delta ** 2 * self._count * batch_count / count)
+        self._count.copy_(count)
+        self._sync()
+
+    def _sync(self) -> None:
+        var = torch.clamp(self._m2 / self._count, min=self._min_var)
+        self._norm_mean.copy_(self._mean)
+        self._norm_std.copy_(torch.sqrt(var))
+
+    def export(self) -> Dict[str, np.ndarray]:
+        """Statistics as numpy arrays (count, mean and population var)."""
+        var = self._m2 / torch.clamp(self._count, min=1)
+        return dict(count=self._count.cpu().numpy(), mean=self._mean.cpu().numpy(),
+                    var=var.cpu().numpy())
+
+    @torch.no_grad()
+    def load(self, stats: Dict[str, np.ndarray]) -> None:
+        """Replace statistics by exported ones."""
+        device = self._mean.device
+        self._count.copy_(torch.as_tensor(stats['count'], dtype=torch.float64, device=device))
+        self._mean.copy_(torch.as_tensor(stats['mean'], dtype=torch.float64, device=device))
+        self._m2.copy_(torch.as_tensor(stats['var'], dtype=torch.float64, device=device) * self._count)
+        if self._count > 0:
+            self._sync()
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of the former CustomBN stored the mean of squares
+        if prefix + '_squared_mean' in state_dict:
+            count = state_dict.pop(prefix + '_count').double().reshape(())
+            mean = state_dict[prefix + '_mean'].double()
+            var = state_dict.pop(prefix + '_squared_mean').double() - mean ** 2
+            state_dict[prefix + '_count'] = count
+            state_dict[prefix + '_mean'] = mean
+            state_dict[prefix + '_m2'] = var * count
+            state_dict[prefix + '_norm_mean'] = mean.float()
+            state_dict[prefix + '_norm_std'] = torch.sqrt(torch.clamp(var, min=self._min_var)).float()
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
 class NormalizedMLP(nn.Module, ParametricFunction):
-    """Wrap around a module, and use CustomBN on the first input tensor.
+    """Wrap around a module, and use a RunningNormalizer on the first input tensor.
 
-    Amounts to applying state normalization.
+    Amounts to applying state normalization. Statistics are updated with
+    update_normalizers on the observed states, not by forwards.
     :args model: the model to be wrapped
     """
     def __init__(self, model: ParametricFunction) -> None:
         super().__init__()
         self._model = model
         # only normalize first input (is this what we want to do in the long go?)
-        self._bn = CustomBN(self._model.input_shape()[0][0])
+        self._bn = RunningNormalizer(self._model.input_shape()[0][0])
 
     def forward(self, *inputs: Tensorable):
         device = next(self.parameters())
@@ -157,3 +199,67 @@ class ContinuousRandomPolicy(MLP):
 
     def forward(self, *inputs: Tensorable) -> Tensor:
         return torch.tanh(super().forward(inputs[0])), torch.exp(self._log_sigma)
+
+
+class ActorCriticMLP(nn.Module, ParametricFunction):
+    """MLP trunk shared by a policy head and a value head.
+
+    Both heads are the last linear layer of a single MLP, so one forward
+    returns (policy output, value), the policy output being that of a
+    ContinuousRandomPolicy (continuous=True) or of a DiscreteRandomPolicy.
+
+    :args nb_state_feats: number of state space feats
+    :args nb_actions: number of action space feats (or of actions)
+    :args nb_layers: number of MLP hidden layers - 1
+    :args hidden_size: hidden layers number of units
+    :args continuous: continuous or discrete action space
+    """
+    def __init__(self, nb_state_feats: int, nb_actions: int,
+                 nb_layers: int, hidden_size: int, continuous: bool) -> None:
+        super().__init__()
+        self._nb_actions = nb_actions
+        self._continuous = continuous
+        self._mlp = MLP(nb_state_feats, nb_actions + 1, nb_layers, hidden_size)
+        if continuous:
+            self._log_sigma = nn.Parameter(torch.zeros(()))
+
+    def forward(self, *inputs: Tensorable):
+        output = self._mlp(inputs[0])
+        policy, value = output[..., :self._nb_actions], output[..., self._nb_actions:]
+        if self._continuous:
+            policy = (torch.tanh(policy), torch.exp(self._log_sigma))
+        return policy, value
+
+    def input_shape(self) -> Shape:
+        return self._mlp.input_shape()
+
+    def output_shape(self) -> Shape:
+        return ((self._nb_actions,), (1,))
+
+
+class ActorCriticHead(nn.Module, ParametricFunction):
+    """Policy (head='policy') or value (head='value') output of a shared ActorCriticMLP.
+
+    :args shared: the (possibly normalized) ActorCriticMLP
+    :args head: output selected
+    """
+    def __init__(self, shared: ParametricFunction, head: str) -> None:
+        super().__init__()
+        assert head in ('policy', 'value')
+        self._shared = shared
+        self._head = head
+
+    @property
+    def shared(self) -> ParametricFunction:
+        return self._shared
+
+    def forward(self, *inputs: Tensorable):
+        policy, value = self._shared(*inputs)
+        return policy if self._head == 'policy' else value
+
+    def input_shape(self) -> Shape:
+        return self._shared.input_shape()
+
+    def output_shape(self) -> Shape:
+        policy_shape, value_shape = self._shared.output_shape()
+        return ((policy_shape if self._head == 'policy' else value_shape),)
@@ -2,12 +2,19 @@
 https://github.com/openai/baselines/blob/master/baselines/logger.py
 """
 from abc import ABC, abstractmethod
-from os import makedirs
+from os import makedirs, listdir, fdopen, replace
 from os import remove
 from shutil import rmtree
 from os.path import join, exists, isfile, dirname
-from typing import Dict
+from typing import Dict, List
+import atexit
+# multiprocessing.util registers its own exit hook on import, which terminates
+# daemon processes: importing it before Logger registers close makes close run first
+import multiprocessing
+import multiprocessing.util
 import pickle
+import re
+import tempfile
 import numpy as np
 from PIL import Image
 
@@ -30,6 +37,10 @@ class KVTWriter(ABC):
         """Load previously logged key-value-timestamps."""
         pass
 
+    def close(self):
+        """Flush what is still buffered."""
+        pass
+
 class PickleKVTWriter(KVTWriter):
     """Write key-value-timestamps into a pickle file."""
     def __init__(self):
@@ -69,6 +80,92 @@ class PickleKVTWriter(KVTWriter):
         assert self._dir is not None
         pickle.dump(self._logs, open(join(self._dir, 'logs.pkl'), 'wb'))
 
+class ArrayKVTWriter(KVTWriter):
+    """Write key-value-timestamps into append-only segments of typed arrays.
+
+    Every `buffering` writes, the buffered elements are written to a new
+    segment kvts/segment_<n>.npz, atomically. A segment holds `keys`, the
+    int64 `timestamps` and float32 `values` of all its elements grouped by
+    key, and `offsets` such that key i owns elements offsets[i]:offsets[i+1].
+    Writing a segment costs the same whatever the length of the run, and a
+    crash can at worst lose the buffered elements. Segments are read back by
+    analysis.dataloader.load_kvts.
+    """
+    SEGMENT_DIR = 'kvts'
+    SEGMENT_PATTERN = re.compile(r'^segment_(\d+)\.npz$')
+
+    def __init__(self):
+        self._timestamps: Dict[str, List[int]] = dict()
+        self._values: Dict[str, List[float]] = dict()
+        self._buffering = 500
+        self._count = 0
+        self._segment = 0
+        self._dir = None
+        atexit.register(self.dump)
+
+    def writekvts(self, key: str, value: float, timestamp: int):
+        if key not in self._timestamps:
+            self._timestamps[key] = []
+            self._values[key] = []
+        self._timestamps[key].append(timestamp)
+        self._values[key].append(value)
+        self._count += 1
+        if self._count == self._buffering:
+            self.dump()
+
+    def set_dir(self, logdir: str, reload: bool = True):
+        self._dir = join(logdir, self.SEGMENT_DIR)
+        if not reload:
+            rmtree(self._dir, ignore_errors=True)
+            if isfile(join(logdir, 'logs.pkl')):
+                remove(join(logdir, 'logs.pkl'))
+            rmtree(join(logdir, "videos"), ignore_errors=True)
+        makedirs(self._dir, exist_ok=True)
+        self.load()
+
+        info("logdir: {}".format(self._dir))
+
+    def load(self):
+        """Append after the segments already written, nothing is read back.
+
+        The logs.pkl of a run logged before segments existed is converted into
+        the first segments, so that resuming it keeps its history.
+        """
+        assert self._dir is not None
+        segments = [int(m.group(1)) for m in map(self.SEGMENT_PATTERN.match, listdir(self._dir)) if m]
+        self._segment = max(segments, default=-1) + 1
+        log_file = join(dirname(self._dir), 'logs.pkl')
+        if not segments and isfile(log_file):
+            with open(log_file, 'rb') as f:
+                logs = pickle.load(f)
+            for key, kvs in logs.items():
+                for timestamp, value in kvs.items():
+                    self.writekvts(key, value, timestamp)
+            self.dump()
+
+    def dump(self):
+        """Write the buffered elements as a new segment."""
+        if self._dir is None or self._count == 0:
+            return
+        keys = list(self._timestamps)
+        lengths = [len(self._timestamps[k]) for k in keys]
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        timestamps = np.concatenate([np.asarray(self._timestamps[k], dtype=np.int64) for k in keys])
+        values = np.concatenate([np.asarray(self._values[k], dtype=np.float32) for k in keys])
+
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir, suffix='.tmp')
+        with fdopen(fd, 'wb') as f:
+            np.savez(f, keys=np.array(keys, dtype=str), offsets=offsets,
+                     timestamps=timestamps, values=values)
+        replace(tmp_path, join(self._dir, f"segment_{self._segment:08d}.npz"))
+        self._segment += 1
+        self._timestamps, self._values = dict(), dict()
+        self._count = 0
+
+    def close(self):
+        self.dump()
+
 class TensorboardKVTWriter(KVTWriter):
     """Write key-value-timestamps into tensorflow summaries."""
     def __init__(self):
@@ -99,34 +196,77 @@ class TensorboardKVTWriter(KVTWriter):
     def writekvts(self, key: str, value: float, timestamp: int):
         self._writer.add_scalar(key, value, timestamp)
 
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+def write_video(logdir: str, tag: str, timestamp: int, frames):
+    """Save 4D (T, H, W, C) numpy array as a compressed npz."""
+    video_dir = join(logdir, "videos")
+    if not exists(video_dir):
+        makedirs(video_dir)
+    np.savez_compressed(join(video_dir, f"{tag}_{timestamp}.npz"), frames)
+
+def write_image(logdir: str, tag: str, timestamp: int, image):
+    """Save 3D (T, H, W) numpy array as a png."""
+    img_dir = join(logdir, "imgs")
+    image = image.astype(np.uint8)
+    if not exists(img_dir):
+        makedirs(img_dir)
+    Image.fromarray(image).save(join(img_dir, f"{tag}_{timestamp}.png"), compress_level=6)
+
+def write_logs(queue, logdir: str, reload: bool):
+    """Body of the writer process: perform the writes sent by Logger until None."""
+    writers = [TensorboardKVTWriter(), ArrayKVTWriter()]
+    for writer in writers:
+        writer.set_dir(logdir, reload)
+    try:
+        for kind, *payload in iter(queue.get, None):
+            if kind == 'kvt':
+                for writer in writers:
+                    writer.writekvts(*payload)
+            elif kind == 'video':
+                write_video(logdir, *payload)
+            elif kind == 'image':
+                write_image(logdir, *payload)
+    finally:
+        for writer in writers:
+            writer.close()
+
 class Logger:
-    """Logging facilities."""
+    """Logging facilities.
+
+    Writes are handed to a writer process, so that neither tensorboard,
+    image encoding nor video compression ever block the training loop.
+    """
     CURRENT = None # current logger
 
     def __init__(self):
         assert Logger.CURRENT is None
-        self._writers = [TensorboardKVTWriter(), PickleKVTWriter()]
+        self._queue = None
+        self._process = None
         self._dir = None
+        atexit.register(self.close)
+
+    def _put(self, *item):
+        assert self._process is not None, "logto must be called before logging"
+        if not self._process.is_alive():
+            exitcode = self._process.exitcode
+            self.close()
+            raise RuntimeError(f"log writer process exited with code {exitcode}")
+        self._queue.put(item)
 
     def log(self, key: str, value: float, timestamp: int):
         """Transmit key-value-timestamp to all writers."""
-        for writer in self._writers:
-            writer.writekvts(key, value, timestamp)
+        self._put('kvt', key, value, timestamp)
 
     def log_video(self, tag: str, timestamp: int, frames):
         """Log 4D (T, H, W, C) numpy array as a video."""
-        video_dir = join(self._dir, "videos")
-        if not exists(video_dir):
-            makedirs(video_dir)
-        np.savez(join(video_dir, f"{tag}_{timestamp}.npz"), frames)
+        self._put('video', tag, timestamp, frames)
 
     def log_image(self, tag: str, timestamp: int, image):
         """Log 3D (T, H, W) numpy array as an image."""
-        img_dir = join(self._dir, "imgs")
-        image = image.astype(np.uint8)
-        if not exists(img_dir):
-            makedirs(img_dir)
-        Image.fromarray(image).save(join(img_dir, f"{tag}_{timestamp}.png"))
+        self._put('image', tag, timestamp, image)
 
     def set_dir(self, logdir: str, reload: bool = True):
         """Set logging directory.
@@ -134,9 +274,27 @@ class Logger:
         :args logdir: logging directory
         :args reload: reload previous results from directory?
         """
+        self.close()
         self._dir = logdir
-        for writer in self._writers:
-            writer.set_dir(logdir, reload)
+        # spawn rather than fork, the trainer may already hold cuda state
+        context = multiprocessing.get_context('spawn')
+        self._queue = context.Queue()
+        self._process = context.Process(
+            target=write_logs, args=(self._queue, logdir, reload), daemon=True)
+        self._process.start()
+
+    def close(self):
+        """Wait for every pending write to be performed."""
+        if self._process is None:
+            return
+        if self._process.is_alive():
+            self._queue.put(None)
+            self._process.join()
+        else:
+            # nobody will read what is left, do not wait on it at exit
+            self._queue.cancel_join_thread()
+        self._process = None
+        self._queue = None
 
 def logto(logdir: str, reload: bool = True):
     """Set logging directory.
@@ -147,6 +305,11 @@ def logto(logdir: str, reload: bool = True):
     assert Logger.CURRENT is not None
     Logger.CURRENT.set_dir(logdir, reload)
 
+def logclose():
+    """Wait for every pending write to be performed, and stop the writer process."""
+    assert Logger.CURRENT is not None
+    Logger.CURRENT.close()
+
 def log(key: str, value: float, timestamp: int):
     """Log key-value-timestamp."""
     assert Logger.CURRENT is not None
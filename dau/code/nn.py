@@ -1,6 +1,10 @@
 """Some nn utilities."""
+from typing import Any, List
 import torch
-from abstract import ParametricFunction
+from torch import nn
+from abstract import ParametricFunction, Tensorable
+from models import RunningNormalizer
+from stateful import CompoundStateful
 
 def copy_buffer(net: ParametricFunction, target_net: ParametricFunction):
     """Copy all buffers from net to target_net."""
@@ -25,3 +29,40 @@ def hard_update(net: ParametricFunction, target_net: ParametricFunction):
     with torch.no_grad():
         for target_param, param in zip(target_net.parameters(), net.parameters()):
             target_param.copy_(param)
+
+def modules(*objs: Any, targets: bool = True) -> List[nn.Module]:
+    """All the distinct modules held by modules or CompoundStatefuls, in a fixed order.
+
+    Two deep copies of the same objects give their modules in the same order.
+    If targets is False, attributes named as target networks are skipped.
+    """
+    found = {}
+    stack = [(None, obj) for obj in reversed(objs)]
+    while stack:
+        key, obj = stack.pop()
+        if not targets and key is not None and 'target' in key:
+            continue
+        if isinstance(obj, nn.Module):
+            found.setdefault(id(obj), obj)
+        elif isinstance(obj, CompoundStateful):
+            stack.extend(reversed(list(obj._statefuls.items())))
+        # some statefuls (e.g. DiscreteActor) are not compound, look at their attributes
+        elif hasattr(obj, '__dict__'):
+            stack.extend(reversed([(k, v) for k, v in vars(obj).items()
+                                   if isinstance(v, nn.Module)]))
+    return list(found.values())
+
+def normalizers(*objs: Any) -> List[RunningNormalizer]:
+    """All the distinct RunningNormalizers held by modules or CompoundStatefuls.
+
+    Target networks are skipped, they get the statistics through soft_update.
+    """
+    found = {}
+    for module in modules(*objs, targets=False):
+        found.update({id(m): m for m in module.modules() if isinstance(m, RunningNormalizer)})
+    return list(found.values())
+
+def update_normalizers(normalizers: List[RunningNormalizer], obs: Tensorable):
+    """Update state normalizers (as listed once by normalizers) with a batch of observed states."""
+    for normalizer in normalizers:
+        normalizer.update(obs)
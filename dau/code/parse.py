@@ -48,6 +48,13 @@ def setup_args():
                         help='size of the memory buffer.')
     parser.add_argument('--learn_per_step', type=int, default=50,
                         help='number of gradient step in one learning step')
+    parser.add_argument('--shared_trunk', action='store_true',
+                        help='ppo actor and critic share their hidden layers.')
+    parser.add_argument('--replay_ratio', type=float, default=None,
+                        help='number of batches processed per environment step, '
+                        'replaces steps_btw_train/learn_per_step when set.')
+    parser.add_argument('--async_learn', action='store_true',
+                        help='train off-policy agents in a learner thread.')
     parser.add_argument('--normalize_state', action='store_true',
                         help='is state normalization used.')
     parser.add_argument('--lr', type=float, default=.03,
@@ -77,13 +84,16 @@ def setup_args():
                         help='do not reload previously saved model when set.')
     parser.add_argument('--snapshot', action='store_true',
                         help='if true, stores snapshot every once in a while')
+    parser.add_argument('--headless', action='store_true',
+                        help='do not plot evaluations, only log them.')
     parser = argload.ArgumentLoader(parser, to_reload=[
         'algo', 'dt', 'steps_btw_train', 'env_id', 'noise_type',
         'batch_size', 'hidden_size', 'nb_layers', 'gamma', 'n_step', 'nb_true_epochs', 'nb_steps',
         'sigma', 'theta', 'c_entropy', 'eps_clamp', 'c_kl', 'nb_train_env', 'nb_eval_env', 'memory_size',
         'learn_per_step', 'normalize_state', 'lr', 'time_limit',
         'policy_lr', 'alpha', 'beta', 'weight_decay', 'optimizer',
-        'tau', 'eval_gap', 'noscale', 'epsilon', 'snapshot'
+        'tau', 'eval_gap', 'noscale', 'epsilon', 'snapshot', 'shared_trunk',
+        'replay_ratio', 'async_learn'
     ])
     args = parser.parse_args()
 
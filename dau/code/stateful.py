@@ -38,8 +38,12 @@ class CompoundStateful(Stateful, Cudaable):
             super().__setattr__(key, value)
 
     def __getattr__(self, key: str) -> Any:
-        if key in self.__dict__['_statefuls']:
-            return self._statefuls[key]
+        # copy looks up special methods before _statefuls is restored
+        statefuls = self.__dict__.get('_statefuls', {})
+        if key in statefuls:
+            return statefuls[key]
+        if key.startswith('__'):
+            raise AttributeError(key)
 
     def unregister(self, key: str):
         assert key in self._statefuls
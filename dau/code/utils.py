@@ -6,7 +6,30 @@ from memory.trajectory import BatchTraj
 import numpy as np
 from abstract import ParametricFunction, Arrayable
 from convert import check_array
-from copy import deepcopy
+
+@torch.jit.script
+def discounted_scan(x: Tensor, mask: Tensor, scale: float) -> Tensor:
+    """Reverse discounted scan along the last dimension.
+
+    out[..., -1] = x[..., -1] and
+    out[..., t] = x[..., t] + mask[..., t] * (scale * out[..., t + 1]).
+
+    :args x: (..., seq_len) tensor to scan
+    :args mask: (..., seq_len) tensor, 0 where the scan is cut
+    :args scale: discount applied at each step
+
+    :return: (..., seq_len) scanned tensor
+
+    This stays a seq_len step loop on purpose: it adds in the same order as the
+    python loops it replaces, so values and compute_return are bitwise equal to
+    what they were. A cumprod/cumsum closed form would change the summation
+    order (and divide by zero at cut steps).
+    """
+    out = x.clone()
+    for t in range(x.shape[-1] - 2, -1, -1):
+        out[..., t] += mask[..., t] * (scale * out[..., t + 1])
+    return out
+
 
 def compute_return(rewards: Arrayable, dones: Arrayable) -> float:
     """Compute return from rewards and termination signals.
@@ -16,12 +39,13 @@ def compute_return(rewards: Arrayable, dones: Arrayable) -> float:
 
     :return: averaged undiscounted return
     """
-    R = 0
-    rewards = check_array(rewards)
-    dones = check_array(dones)
-    for r, d in zip(rewards[::-1], dones[::-1]):
-        R = r + R * (1 - d)
-    return np.mean(R)
+    rewards, dones = check_array(rewards), check_array(dones)
+    if len(rewards) == 0:
+        return 0.
+    rewards = torch.from_numpy(np.moveaxis(rewards.astype(np.float64), 0, -1))
+    dones = torch.from_numpy(np.moveaxis(dones.astype(np.float64), 0, -1))
+    R = discounted_scan(rewards, 1 - dones, 1.)[..., 0]
+    return np.mean(R.numpy())
 
 def values(v_function: ParametricFunction, traj: BatchTraj,
            gamma: float, lambd: float, dt: float) -> Tuple[Tensor, Tensor]:
@@ -39,16 +63,15 @@ def values(v_function: ParametricFunction, traj: BatchTraj,
     :return: (values (batch_size, seq_len), target_values (batch_size, seq_len))
     """
     v = v_function(traj.obs).squeeze(-1)
-    r = traj.rewards * dt
-    d = traj.done
-    tl = deepcopy(traj.time_limit)
-    tl[..., -1] = 1
-    stop = torch.max(d, tl)
-
-    gae = (1 - tl) * \
-        (r + gamma * (1 - d) * torch.cat([v[..., 1:], v[..., :1]], dim=-1) - v)
+    with torch.no_grad():
+        r = traj.rewards * dt
+        d = traj.done
+        tl = traj.time_limit.clone()
+        tl[..., -1] = 1
+        stop = torch.max(d, tl)
 
-    for t in reversed(range(0, traj.length - 1)):
-        gae[..., t] += (1 - stop[..., t]) * (gamma * lambd * gae[..., t + 1])
+        gae = (1 - tl) * \
+            (r + gamma * (1 - d) * torch.cat([v[..., 1:], v[..., :1]], dim=-1) - v)
+        gae = discounted_scan(gae, 1 - stop, gamma * lambd)
 
     return v, (v + gae).detach()
@@ -1,6 +1,10 @@
+import concurrent.futures
 import csv
+import hashlib
 import math
 import os
+import pickle
+import tempfile
 import numpy as np
 import json
 import itertools
@@ -21,8 +25,23 @@ def flatten(l):
     return [item for sublist in l for item in sublist]
 
 
+# records written by viskit.logging.ColumnarProgress
+PROGRESS_RECORD_DTYPE = np.dtype([('row', '<i4'), ('key', '<i4'), ('value', '<f8')])
+
+
+def load_columnar_progress(progress_path):
+    with open(progress_path + '.keys', 'r') as f:
+        keys = [json.loads(line) for line in f]
+    records = np.fromfile(progress_path, dtype=PROGRESS_RECORD_DTYPE)
+    n_rows = int(records['row'].max()) + 1 if len(records) > 0 else 0
+    columns = np.full((len(keys), n_rows), np.nan)
+    columns[records['key'], records['row']] = records['value']
+    return dict(zip(keys, columns))
+
+
 def load_progress(progress_csv_path):
-    print("Reading %s" % progress_csv_path)
+    if progress_csv_path.endswith('.records'):
+        return load_columnar_progress(progress_csv_path)
     entries = dict()
     if progress_csv_path.split('.')[-1] == "csv":
         delimiter = ','
@@ -42,6 +61,147 @@ def load_progress(progress_csv_path):
     return entries
 
 
+class ProgressTail(object):
+    """
+    Incremental reader of a progress file that is still being written.
+
+    Starts from the rows already loaded in progress, and only reads what was
+    appended to the file since. Columns live in buffers that grow by
+    doubling, self.progress holds views of their filled part. self.progress
+    is always the same dict, so it can be shared with the experiment.
+    """
+
+    def __init__(self, progress_path, progress):
+        self.progress_path = progress_path
+        self.progress = dict(progress)
+        self.n_rows = max([len(v) for v in progress.values()] or [0])
+        self._buffers = {}
+        self._offset = None
+        self._header = None
+        stat = os.stat(progress_path)
+        self._stat = (stat.st_size, stat.st_mtime_ns)
+
+    def poll(self):
+        """
+        Read the rows appended since the last call, returns whether
+        self.progress changed. Files that did not change are not opened.
+        """
+        stat = os.stat(self.progress_path)
+        if (stat.st_size, stat.st_mtime_ns) == self._stat:
+            return False
+        self._stat = (stat.st_size, stat.st_mtime_ns)
+        if self._offset is None:
+            self._seek_loaded_rows()
+        if self._offset is None or stat.st_size < self._offset:
+            # rewritten or truncated, e.g. by a resumed run
+            self._reset(load_progress(self.progress_path))
+            self._seek_loaded_rows()
+            return True
+        if self.progress_path.endswith('.records'):
+            return self._poll_records()
+        return self._poll_text()
+
+    def _reset(self, progress):
+        # in place, callers keep a reference to self.progress
+        self.progress.clear()
+        self.progress.update(progress)
+        self.n_rows = max([len(v) for v in progress.values()] or [0])
+        self._buffers = {}
+
+    def _seek_loaded_rows(self):
+        """Offset right after the self.n_rows rows that are already loaded."""
+        self._offset = None
+        if self.progress_path.endswith('.records'):
+            # rows are appended in order, so the loaded ones are a prefix
+            records = np.fromfile(self.progress_path, dtype=PROGRESS_RECORD_DTYPE)
+            self._offset = int(np.searchsorted(records['row'], self.n_rows)) * \
+                PROGRESS_RECORD_DTYPE.itemsize
+            return
+        with open(self.progress_path, 'rb') as f:
+            header = f.readline()
+            if not header.endswith(b'\n'):
+                return
+            for _ in range(self.n_rows):
+                if not f.readline().endswith(b'\n'):
+                    return
+            self._header = next(csv.reader(
+                [header.decode('utf-8')], delimiter=self._delimiter()))
+            self._offset = f.tell()
+
+    def _delimiter(self):
+        return ',' if self.progress_path.split('.')[-1] == "csv" else '\t'
+
+    def _grow(self, n_rows, keys):
+        """Make room for n_rows rows, returns the buffers of keys."""
+        buffers = []
+        for k in keys:
+            buffer = self._buffers.get(k)
+            if buffer is None:
+                buffer = np.full(max(n_rows, 16), np.nan)
+                loaded = self.progress.get(k, ())
+                buffer[:len(loaded)] = loaded
+            elif len(buffer) < n_rows:
+                buffer = np.concatenate(
+                    [buffer, np.full(max(n_rows, 2 * len(buffer)) - len(buffer), np.nan)])
+            self._buffers[k] = buffer
+            buffers.append(buffer)
+        return buffers
+
+    def _publish(self, n_rows):
+        self.n_rows = n_rows
+        for k, buffer in self._buffers.items():
+            self.progress[k] = buffer[:n_rows]
+
+    def _poll_text(self):
+        with open(self.progress_path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        # leave a partially written last line for the next poll
+        data = data[:data.rfind(b'\n') + 1]
+        if not data:
+            return False
+        self._offset += len(data)
+        rows = list(csv.reader(
+            data.decode('utf-8').splitlines(), delimiter=self._delimiter()))
+        buffers = self._grow(self.n_rows + len(rows), self._header)
+        for i, row in enumerate(rows, self.n_rows):
+            for buffer, v in zip(buffers, row):
+                try:
+                    buffer[i] = float(v)
+                except:
+                    buffer[i] = 0.
+        self._publish(self.n_rows + len(rows))
+        return True
+
+    def _poll_records(self):
+        size = PROGRESS_RECORD_DTYPE.itemsize
+        with open(self.progress_path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        data = data[:len(data) - len(data) % size]
+        if not data:
+            return False
+        records = np.frombuffer(data, dtype=PROGRESS_RECORD_DTYPE)
+        if records['row'][0] < self.n_rows - 1:
+            # rewritten with fewer rows, then appended to again
+            self._reset(load_progress(self.progress_path))
+            self._seek_loaded_rows()
+            return True
+        self._offset += len(data)
+        # keys are always written before the records that use them
+        with open(self.progress_path + '.keys', 'r') as f:
+            keys = [json.loads(line) for line in f]
+        # a row can be split across polls, so rows below self.n_rows may get
+        # more values
+        n_rows = max(self.n_rows, int(records['row'].max()) + 1)
+        buffers = self._grow(n_rows, keys)
+        for key_id in np.unique(records['key']):
+            selected = records[records['key'] == key_id]
+            buffers[key_id][selected['row']] = selected['value']
+        self._publish(n_rows)
+        return True
+
+
 def to_json(stub_object):
     from rllab.misc.instrument import StubObject
     from rllab.misc.instrument import StubAttr
@@ -97,38 +257,143 @@ def lookup(d, keys):
     return d
 
 
+def _progress_path(exp_path, data_filename):
+    progress_csv_path = os.path.join(exp_path, data_filename)
+    progress_records_path = os.path.splitext(progress_csv_path)[0] + '.records'
+    if os.path.exists(progress_records_path):
+        return progress_records_path
+    if os.stat(progress_csv_path).st_size == 0:
+        return os.path.join(exp_path, "log.txt")
+    return progress_csv_path
+
+
+def _exp_stamp(exp_path, data_filename, params_filename):
+    """
+    Size and mtime of every file an experiment is loaded from, used to
+    invalidate its cache entry.
+    """
+    stamp = []
+    progress_path = _progress_path(exp_path, data_filename)
+    paths = [progress_path, os.path.join(exp_path, "variant.json"),
+             os.path.join(exp_path, params_filename)]
+    if progress_path.endswith('.records'):
+        paths.append(progress_path + '.keys')
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stamp.append((path, stat.st_size, stat.st_mtime_ns))
+    return stamp
+
+
+def _load_exp(exp_path, data_filename, params_filename, disable_variant):
+    """
+    Progress and params of one experiment, or the error that prevented
+    loading it. Runs in the loader processes.
+    """
+    try:
+        params_json_path = os.path.join(exp_path, params_filename)
+        variant_json_path = os.path.join(exp_path, "variant.json")
+        progress = load_progress(_progress_path(exp_path, data_filename))
+        if disable_variant:
+            params = load_params(params_json_path)
+        else:
+            try:
+                params = load_params(variant_json_path)
+            except IOError:
+                params = load_params(params_json_path)
+        return dict(progress=progress, params=params)
+    except IOError as e:
+        return e
+
+
+def default_cache_dir():
+    return os.environ.get(
+        'VISKIT_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'viskit'))
+
+
 def load_exps_data(
         exp_folder_paths,
         data_filename='progress.csv',
         params_filename='params.json',
         disable_variant=False,
+        cache_dir=None,
+        n_workers=None,
 ):
+    """
+    :param cache_dir: Directory of the on-disk experiment cache, entries are
+    reused as long as the experiment files keep their size and mtime. None
+    to use default_cache_dir(), '' to disable the cache.
+    :param n_workers: Number of processes reading the experiments that are
+    not cached, defaults to the number of cpus.
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+
     exps = []
     for exp_folder_path in exp_folder_paths:
         exps += [x[0] for x in os.walk(exp_folder_path)]
-    exps_data = []
+
+    loaded = {}
+    to_load = []
+    n_cached = 0
     for exp in exps:
         try:
-            exp_path = exp
-            params_json_path = os.path.join(exp_path, params_filename)
-            variant_json_path = os.path.join(exp_path, "variant.json")
-            progress_csv_path = os.path.join(exp_path, data_filename)
-            if os.stat(progress_csv_path).st_size == 0:
-                progress_csv_path = os.path.join(exp_path, "log.txt")
-            progress = load_progress(progress_csv_path)
-            if disable_variant:
-                params = load_params(params_json_path)
-            else:
-                try:
-                    params = load_params(variant_json_path)
-                except IOError:
-                    params = load_params(params_json_path)
-            exps_data.append(AttrDict(
-                progress=progress,
-                params=params,
-                flat_params=flatten_dict(params)))
+            stamp = _exp_stamp(exp, data_filename, params_filename)
         except IOError as e:
             print(e)
+            continue
+        cache_path = None
+        if cache_dir:
+            key = hashlib.sha1(
+                repr((os.path.realpath(exp), data_filename, params_filename,
+                      disable_variant)).encode()).hexdigest()
+            cache_path = os.path.join(cache_dir, key + '.pkl')
+            try:
+                with open(cache_path, 'rb') as f:
+                    entry = pickle.load(f)
+                if entry['stamp'] == stamp:
+                    loaded[exp] = entry['data']
+                    n_cached += 1
+                    continue
+            except (IOError, EOFError, pickle.UnpicklingError, KeyError):
+                pass
+        to_load.append((exp, stamp, cache_path))
+
+    args = [(exp, data_filename, params_filename, disable_variant)
+            for exp, _, _ in to_load]
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if len(to_load) > 1 and n_workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(n_workers) as executor:
+            chunksize = max(1, len(args) // (4 * n_workers))
+            results = list(executor.map(_load_exp, *zip(*args), chunksize=chunksize))
+    else:
+        results = [_load_exp(*a) for a in args]
+
+    for (exp, stamp, cache_path), data in zip(to_load, results):
+        if isinstance(data, Exception):
+            print(data)
+            continue
+        loaded[exp] = data
+        if cache_path is not None:
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(dict(stamp=stamp, data=data), f)
+            os.replace(tmp_path, cache_path)
+
+    print("Loaded %d experiments, %d from cache" % (len(loaded), n_cached))
+    exps_data = []
+    for exp in exps:
+        if exp in loaded:
+            data = loaded[exp]
+            exps_data.append(AttrDict(
+                progress_path=_progress_path(exp, data_filename),
+                progress=data['progress'],
+                params=data['params'],
+                flat_params=flatten_dict(data['params'])))
     return exps_data
 
 
@@ -162,58 +427,83 @@ def smart_eval(string):
 
 
 
-def extract_distinct_params(exps_data, excluded_params=('seed', 'log_dir'), l=1):
-    # all_pairs = unique(flatten([d.flat_params.items() for d in exps_data]))
-    # if logger:
-    #     logger("(Excluding {excluded})".format(excluded=', '.join(excluded_params)))
-    # def cmp(x,y):
-    #     if x < y:
-    #         return -1
-    #     elif x > y:
-    #         return 1
-    #     else:
-    #         return 0
-
-    try:
-        params_as_evalable_strings = [
-            list(
-                map(
-                    smart_repr,
-                    list(d.flat_params.items())
+class ParamIndex(object):
+    """
+    Inverted index from (flat param key, str(value)) to the positions of the
+    experiments having that value, built once per data load.
+
+    Values are compared through str(), as exp_has_key_value does, and an
+    experiment that lacks a key matches every value of it.
+    """
+
+    def __init__(self, exps_data):
+        self.exps_data = list(exps_data)
+        self.all_ids = frozenset(range(len(self.exps_data)))
+        self._positions = {id(exp): i for i, exp in enumerate(self.exps_data)}
+        self._ids = {}
+        self._key_ids = {}
+        # first value seen for each (key, str(value)), in its original type
+        self._values = {}
+        for i, exp in enumerate(self.exps_data):
+            for k, v in exp.flat_params.items():
+                pair = (k, str(v))
+                if pair not in self._ids:
+                    self._ids[pair] = set()
+                    self._values.setdefault(k, {})[pair[1]] = v
+                self._ids[pair].add(i)
+                self._key_ids.setdefault(k, set()).add(i)
+        self._ids = {pair: frozenset(ids) for pair, ids in self._ids.items()}
+        self._key_ids = {k: frozenset(ids) for k, ids in self._key_ids.items()}
+
+    def ids_of(self, exps_data):
+        return frozenset(self._positions[id(exp)] for exp in exps_data)
+
+    def extract(self, ids):
+        return [self.exps_data[i] for i in sorted(ids)]
+
+    def matching(self, k, v):
+        """Ids of the experiments for which exp_has_key_value(exp, k, v) holds."""
+        missing = self.all_ids - self._key_ids.get(k, frozenset())
+        return self._ids.get((k, str(v)), frozenset()) | missing
+
+    def distinct_params(self, ids=None, excluded_params=('seed', 'log_dir'), l=1):
+        """
+        Same as extract_distinct_params, restricted to the experiments in ids
+        when given.
+        """
+        proposals = []
+        for k in sorted(self._values):
+            values = [
+                v for string, v in self._values[k].items()
+                if ids is None or not self._ids[(k, string)].isdisjoint(ids)
+            ]
+            if values:
+                proposals.append((k, sorted(values, key=smart_repr)))
+        return [
+            (k, v) for (k, v) in proposals
+            if k == 'version' or (
+                len(v) > l and all(
+                    [k.find(excluded_param) != 0
+                     for excluded_param in excluded_params]
                 )
             )
-            for d in exps_data
         ]
-        unique_params = unique(
-            flatten(
-                params_as_evalable_strings
-            )
-        )
-        stringified_pairs = sorted(
-            map(
-                smart_eval,
-                unique_params
-            ),
-            key=lambda x: (
-                tuple(smart_repr(i) for i in x)
-                # tuple(0. if it is None else it for it in x),
-            )
-        )
-    except Exception as e:
-        print(e)
-        import ipdb; ipdb.set_trace()
-    proposals = [(k, [x[1] for x in v])
-                 for k, v in itertools.groupby(stringified_pairs, lambda x: x[0])]
-    filtered = [
-        (k, v) for (k, v) in proposals
-        if k == 'version' or (
-            len(v) > l and all(
-                [k.find(excluded_param) != 0
-                 for excluded_param in excluded_params]
-            )
-        )
-    ]
-    return filtered
+
+
+def extract_distinct_params(exps_data, excluded_params=('seed', 'log_dir'), l=1, index=None):
+    """
+    :param exps_data: experiments to look at
+    :param excluded_params: prefixes of the keys left out
+    :param l: only keep keys with more than l distinct values
+    :param index: ParamIndex that exps_data is a subset of, built if not given
+    :return: sorted list of (key, sorted distinct values)
+    """
+    if index is None:
+        return ParamIndex(exps_data).distinct_params(
+            excluded_params=excluded_params, l=l)
+    return index.distinct_params(
+        index.ids_of(exps_data), excluded_params=excluded_params, l=l)
+
 
 def exp_has_key_value(exp, k, v):
     return (
@@ -224,50 +514,72 @@ def exp_has_key_value(exp, k, v):
 
 
 class Selector(object):
-    def __init__(self, exps_data, filters=None, custom_filters=None):
-        self._exps_data = exps_data
-        if filters is None:
-            self._filters = tuple()
-        else:
-            self._filters = tuple(filters)
-        if custom_filters is None:
-            self._custom_filters = []
+    """
+    Filters over experiments, evaluated as intersections of ParamIndex sets.
+
+    :param exps_data: experiments to select from
+    :param index: ParamIndex that exps_data is a subset of, so that it is not
+    rebuilt for every selector
+    """
+
+    def __init__(self, exps_data, filters=None, custom_filters=None, index=None):
+        if index is None:
+            index = ParamIndex(exps_data)
+            ids = index.all_ids
         else:
-            self._custom_filters = custom_filters
+            ids = index.ids_of(exps_data)
+        self._index = index
+        self._ids = ids
+        self._filters = tuple()
+        self._custom_filters = []
+        for k, v in filters or ():
+            self._ids, self._filters = self._where(k, v)
+        for custom_filter in custom_filters or ():
+            self._ids = self._custom_filter(custom_filter)
+            self._custom_filters = self._custom_filters + [custom_filter]
+
+    @property
+    def _exps_data(self):
+        return self._index.exps_data
+
+    def _derive(self, ids, filters, custom_filters):
+        selector = Selector.__new__(Selector)
+        selector._index = self._index
+        selector._ids = ids
+        selector._filters = filters
+        selector._custom_filters = custom_filters
+        return selector
+
+    def _where(self, k, v):
+        return self._ids & self._index.matching(k, v), self._filters + ((k, v),)
+
+    def _custom_filter(self, filter):
+        return frozenset(
+            i for i in self._ids if filter(self._index.exps_data[i]))
 
     def where(self, k, v):
-        return Selector(
-            self._exps_data,
-            self._filters + ((k, v),),
-            self._custom_filters,
-        )
+        ids, filters = self._where(k, v)
+        return self._derive(ids, filters, self._custom_filters)
 
     def where_not(self, k, v):
-        return Selector(
-            self._exps_data,
+        return self._derive(
+            self._ids - self._index.matching(k, v),
             self._filters,
-            self._custom_filters + [
-                lambda exp: not exp_has_key_value(exp, k, v)
-            ],
+            self._custom_filters,
         )
 
     def custom_filter(self, filter):
-        return Selector(self._exps_data, self._filters, self._custom_filters + [filter])
-
-    def _check_exp(self, exp):
-        # or exp.flat_params.get(k, None) is None
-        return all(
-            (
-                exp_has_key_value(exp, k, v)
-                for k, v in self._filters
-            )
-        ) and all(custom_filter(exp) for custom_filter in self._custom_filters)
+        return self._derive(
+            self._custom_filter(filter),
+            self._filters,
+            self._custom_filters + [filter],
+        )
 
     def extract(self):
-        return list(filter(self._check_exp, self._exps_data))
+        return self._index.extract(self._ids)
 
     def iextract(self):
-        return filter(self._check_exp, self._exps_data)
+        return iter(self.extract())
 
 
 # Taken from plot.ly
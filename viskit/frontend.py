@@ -12,7 +12,10 @@ from viskit import core
 import sys
 import argparse
 import json
+import threading
+import time
 import numpy as np
+import plotly
 from plotly import tools
 import plotly.offline as po
 import plotly.graph_objs as go
@@ -39,27 +42,66 @@ def flatten(xs):
 
 
 def sliding_mean(data_array, window=5):
-    data_array = np.array(data_array)
-    new_list = []
-    for i in range(len(data_array)):
-        indices = list(range(max(i - window + 1, 0),
-                             min(i + window + 1, len(data_array))))
-        avg = 0
-        for j in indices:
-            avg += data_array[j]
-        avg /= float(len(indices))
-        new_list.append(avg)
-
-    return np.array(new_list)
+    """
+    Average of data_array[i - window + 1:i + window + 1] for every i, along
+    the last axis. As with a plain sum, a window holding a nan, or both +inf
+    and -inf, gives a nan, and one holding only +inf (-inf) gives +inf (-inf).
+    """
+    data_array = np.asarray(data_array, dtype=np.float64)
+    n = data_array.shape[-1]
+    if n == 0:
+        return data_array.copy()
+    idx = np.arange(n)
+    lo = np.maximum(idx - window + 1, 0)
+    hi = np.minimum(idx + window + 1, n)
+    pad = [(0, 0)] * (data_array.ndim - 1) + [(1, 0)]
+
+    def window_sums(x):
+        cum = np.pad(np.cumsum(x, axis=-1), pad)
+        return cum[..., hi] - cum[..., lo]
+
+    # non finite values are counted apart, so that they never enter the cumsum
+    avg = window_sums(np.where(np.isfinite(data_array), data_array, 0.)) / (hi - lo)
+    nans = window_sums(np.isnan(data_array))
+    pos_infs = window_sums(data_array == np.inf)
+    neg_infs = window_sums(data_array == -np.inf)
+    avg = np.where(pos_infs > 0, np.inf, avg)
+    avg = np.where(neg_infs > 0, -np.inf, avg)
+    return np.where((nans > 0) | ((pos_infs > 0) & (neg_infs > 0)), np.nan, avg)
+
+
+def pad_progresses(progresses):
+    """
+    Stack 1d series of different lengths into a (n_series, max_len) matrix,
+    padded with nans.
+    """
+    max_size = max(len(ps) for ps in progresses)
+    padded = np.full((len(progresses), max_size), np.nan)
+    for i, ps in enumerate(progresses):
+        padded[i, :len(ps)] = ps
+    return padded
 
 
 import itertools
+from collections import OrderedDict
 
 app = flask.Flask(__name__, static_url_path='/static')
 
 exps_data = None
 plottable_keys = None
 distinct_params = None
+exps_index = None
+# --live state: one core.ProgressTail per experiment, and a version bumped
+# every time tailed rows change the data, that live_plot streams wait on
+exps_tails = None
+data_version = 0
+data_lock = threading.RLock()
+data_changed = threading.Condition()
+LIVE_KEEPALIVE = 15.
+# memoized curve statistics and plot divs, both dropped by reload_data
+_statistics_cache = {}
+_plot_cache = OrderedDict()
+PLOT_CACHE_SIZE = 64
 
 
 @app.route('/js/<path:path>')
@@ -78,6 +120,7 @@ def create_bar_chart(
         plot_height=None,
         title=None,
         value_i=-1,
+        as_figure=False,
     ):
     """
     plot_lists is a list of lists.
@@ -85,6 +128,7 @@ def create_bar_chart(
     Each inner list represents different experiments to run, within that y-axis
     attribute.
     Each plot is an AttrDict which should have the elements used below.
+    With as_figure, the plotly figure is returned instead of its html div.
     """
 
     x_axis = [(subplot['plot_key'], subplot['means']) for plot_list in plot_lists for subplot in plot_list if subplot['x_key']]
@@ -153,6 +197,8 @@ def create_bar_chart(
             title=plt.plot_key,
         )
 
+    if as_figure:
+        return fig
     fig_div = po.plot(
         fig,
         output_type='div',
@@ -174,6 +220,7 @@ def make_plot(
         plot_width=None,
         plot_height=None,
         title=None,
+        as_figure=False,
     ):
     """
     plot_lists is a list of lists.
@@ -181,6 +228,7 @@ def make_plot(
     Each inner list represents different experiments to run, within that y-axis
     attribute.
     Each plot is an AttrDict which should have the elements used below.
+    With as_figure, the plotly figure is returned instead of its html div.
     """
 
     x_axis = [(subplot['plot_key'], subplot['means']) for plot_list in plot_lists for subplot in plot_list if subplot['x_key']]
@@ -256,6 +304,8 @@ def make_plot(
                 title=xlabel,
             )
 
+    if as_figure:
+        return fig
     fig_div = po.plot(fig, output_type='div', include_plotlyjs=False)
     if "footnote" in plot_list[0]:
         footnote = "<br />".join([
@@ -389,7 +439,12 @@ def get_plot_instruction(
         make_bar_chart=False,
         value_i=-1,  # TODO: add option to set value_i
         custom_series_splitter=None,
+        as_figures=False,
 ):
+    """
+    Html divs of the requested plots, or with as_figures the list of their
+    plotly figures, as pushed to live clients.
+    """
     if x_keys is None:
         x_keys = []
     if x_keys:
@@ -404,9 +459,9 @@ def get_plot_instruction(
     """
     if filter_nan:
         nonnan_exps_data = list(filter(check_nan, exps_data))
-        selector = core.Selector(nonnan_exps_data)
+        selector = core.Selector(nonnan_exps_data, index=exps_index)
     else:
-        selector = core.Selector(exps_data)
+        selector = core.Selector(exps_data, index=exps_index)
     if legend_post_processor is None:
         legend_post_processor = lambda x: x
     if filters is None:
@@ -451,7 +506,8 @@ def get_plot_instruction(
                     splitted_dict[key] = list()
                 splitted_dict[key].append(exp)
             splitted = list(splitted_dict.items())
-            group_selectors = [core.Selector(list(x[1])) for x in splitted]
+            group_selectors = [
+                core.Selector(list(x[1]), index=exps_index) for x in splitted]
             group_legends = [x[0] for x in splitted]
         else:
             if len(group_keys) > 0:
@@ -501,7 +557,7 @@ def get_plot_instruction(
                     # -----------------------
 
                     filtered_params = core.extract_distinct_params(
-                        filtered_data, l=0)
+                        filtered_data, l=0, index=exps_index)
                     filtered_params2 = [p[1] for p in filtered_params]
                     filtered_params_k = [p[0] for p in filtered_params]
                     product_space = list(itertools.product(
@@ -511,31 +567,23 @@ def get_plot_instruction(
                     best_regret = np.inf if best_is_lowest else -np.inf
                     kv_string_best_regret = None
                     for idx, params in enumerate(product_space):
-                        selector = core.Selector(exps_data)
+                        selector = core.Selector(exps_data, index=exps_index)
                         for k, v in zip(filtered_params_k, params):
                             selector = selector.where(k, str(v))
                         data = selector.extract()
                         if len(data) > 0:
-                            progresses = [
+                            progresses = pad_progresses([
                                 exp.progress.get(plot_key, np.array([np.nan]))
                                 for exp in data
-                            ]
-                            sizes = list(map(len, progresses))
-                            max_size = max(sizes)
-                            progresses = [
-                                np.concatenate(
-                                    [ps, np.ones(max_size - len(ps)) * np.nan])
-                                for ps in progresses]
+                            ])
 
                             if best_based_on_final:
-                                progresses = np.asarray(progresses)[:, -1]
+                                progresses = progresses[:, -1]
                             if only_show_best_sofar:
                                 if best_is_lowest:
-                                    progresses = np.min(np.asarray(progresses),
-                                                        axis=1)
+                                    progresses = np.min(progresses, axis=1)
                                 else:
-                                    progresses = np.max(np.asarray(progresses),
-                                                        axis=1)
+                                    progresses = np.max(progresses, axis=1)
                             if use_median:
                                 medians = np.nanmedian(progresses, axis=0)
                                 regret = np.mean(medians)
@@ -568,29 +616,12 @@ def get_plot_instruction(
                     print('best regret: {}'.format(best_regret))
                     # -----------------------
                     if np.isfinite(best_regret):
-                        progresses = [
-                            exp.progress.get(plot_key, np.array([np.nan])) for
-                            exp in data_best_regret]
-                        #                         progresses = [progress[:500] for progress in progresses ]
-                        sizes = list(map(len, progresses))
-                        # more intelligent:
-                        max_size = max(sizes)
-                        progresses = [
-                            np.concatenate(
-                                [ps, np.ones(max_size - len(ps)) * np.nan]) for
-                            ps in progresses]
                         legend = '{} (mu: {:.3f}, std: {:.5f})'.format(
                             group_legend, best_regret, np.std(best_progress))
-                        window_size = np.maximum(
-                            int(np.round(max_size / float(1000))), 1)
-                        statistics = get_statistics(
-                            progresses, use_median, normalize_error,
-                        )
-                        statistics = process_statistics(
-                            statistics,
-                            smooth_curve,
-                            clip_plot_value,
-                            window_size,
+                        statistics = get_curve_statistics(
+                            data_best_regret, plot_key, use_median,
+                            normalize_error, smooth_curve, clip_plot_value,
+                            window_divisor=1000,
                         )
                         to_plot.append(
                             AttrDict(
@@ -606,30 +637,9 @@ def get_plot_instruction(
                         else:
                             to_plot[-1]["footnote"] = ""
                 else:
-                    progresses = [
-                        exp.progress.get(plot_key, np.array([np.nan])) for exp
-                        in filtered_data
-                    ]
-                    sizes = list(map(len, progresses))
-                    # more intelligent:
-                    max_size = max(sizes)
-                    progresses = [
-                        np.concatenate(
-                            [ps, np.ones(max_size - len(ps)) * np.nan]) for ps
-                        in progresses]
-                    window_size = np.maximum(
-                        int(np.round(max_size / float(100))),
-                        1,
-                    )
-
-                    statistics = get_statistics(
-                        progresses, use_median, normalize_error,
-                    )
-                    statistics = process_statistics(
-                        statistics,
-                        smooth_curve,
-                        clip_plot_value,
-                        window_size,
+                    statistics = get_curve_statistics(
+                        filtered_data, plot_key, use_median, normalize_error,
+                        smooth_curve, clip_plot_value, window_divisor=100,
                     )
                     to_plot.append(
                         AttrDict(
@@ -649,18 +659,21 @@ def get_plot_instruction(
                     list_of_list_of_plot_dicts,
                     use_median=use_median, title=fig_title,
                     plot_width=plot_width, plot_height=plot_height,
-                    value_i=value_i,
+                    value_i=value_i, as_figure=as_figures,
                 ))
             else:
                 plots.append(make_plot(
                     list_of_list_of_plot_dicts,
                     use_median=use_median, title=fig_title,
-                    plot_width=plot_width, plot_height=plot_height
+                    plot_width=plot_width, plot_height=plot_height,
+                    as_figure=as_figures,
                 ))
 
         if gen_eps:
             make_plot_eps(to_plot, use_median=use_median, counter=counter)
         counter += 1
+    if as_figures:
+        return plots
     return "\n".join(plots)
 
 
@@ -706,24 +719,47 @@ def get_selector_score(key, selector, use_median, best_based_on_final):
         return np.nanmean(values)
 
 
+def nanpercentiles(progresses, q):
+    """
+    Same as np.nanpercentile(progresses, q, axis=0) with linear interpolation,
+    from a single sort of the (n_series, max_len) matrix instead of one
+    python level call per column that has a nan.
+    """
+    q = np.asarray(q, dtype=np.float64)
+    sorted_progresses = np.sort(progresses, axis=0)  # nans go last
+    counts = np.sum(~np.isnan(progresses), axis=0)
+    positions = np.maximum(counts - 1, 0) * q[:, None] / 100.
+    below = np.floor(positions).astype(np.int64)
+    above = np.ceil(positions).astype(np.int64)
+    lower = np.take_along_axis(sorted_progresses, below, axis=0)
+    upper = np.take_along_axis(sorted_progresses, above, axis=0)
+    percentiles = lower + (upper - lower) * (positions - below)
+    return np.where(counts > 0, percentiles, np.nan)
+
+
 def get_statistics(progresses, use_median, normalize_errors):
     """
     Get some dictionary of statistics (e.g. the median, mean).
-    :param progresses:
+    :param progresses: nan padded (n_series, max_len) matrix, or a list of
+    series that is padded first.
     :param use_median:
     :param normalize_errors:
     :return:
     """
+    if not isinstance(progresses, np.ndarray):
+        progresses = pad_progresses(progresses)
     if use_median:
+        percentile25, percentile50, percentile75 = nanpercentiles(
+            progresses, q=[25, 50, 75])
         return dict(
-            percentile25=np.nanpercentile(progresses, q=25, axis=0),
-            percentile50=np.nanpercentile(progresses, q=50, axis=0),
-            percentile75=np.nanpercentile(progresses, q=75, axis=0),
+            percentile25=percentile25,
+            percentile50=percentile50,
+            percentile75=percentile75,
         )
     else:
         stds = np.nanstd(progresses, axis=0)
         if normalize_errors:
-            stds /= np.sqrt(np.sum((1. - np.isnan(progresses)), axis=0))
+            stds /= np.sqrt(np.sum(~np.isnan(progresses), axis=0))
         return dict(
             means=np.nanmean(progresses, axis=0),
             stds=stds,
@@ -739,18 +775,51 @@ def process_statistics(
     """
     Smoothen and clip time-series data.
     """
-    clean_statistics = {}
-    for k, v in statistics.items():
-        clean_statistics[k] = v
-        if smooth_curve:
-            clean_statistics[k] = sliding_mean(v, window=window_size)
-        if clip_plot_value is not None:
-            clean_statistics[k] = np.clip(
-                clean_statistics[k],
-                -clip_plot_value,
-                clip_plot_value,
-            )
-    return clean_statistics
+    keys = list(statistics.keys())
+    if not keys:
+        return {}
+    # every statistic has the same length, smooth and clip them all at once
+    values = np.stack([statistics[k] for k in keys])
+    if smooth_curve:
+        values = sliding_mean(values, window=window_size)
+    if clip_plot_value is not None:
+        values = np.clip(values, -clip_plot_value, clip_plot_value)
+    return dict(zip(keys, values))
+
+
+def get_curve_statistics(
+        exps,
+        plot_key,
+        use_median,
+        normalize_error,
+        smooth_curve,
+        clip_plot_value,
+        window_divisor,
+):
+    """
+    Smoothed and clipped statistics of `plot_key` across `exps`, memoized
+    until the data is reloaded.
+    :param window_divisor: the smoothing window is the padded length divided
+    by this.
+    """
+    cache_key = (
+        tuple(id(exp) for exp in exps), plot_key, use_median, normalize_error,
+        smooth_curve, clip_plot_value, window_divisor,
+    )
+    if cache_key not in _statistics_cache:
+        progresses = pad_progresses([
+            exp.progress.get(plot_key, np.array([np.nan])) for exp in exps
+        ])
+        window_size = max(
+            int(np.round(progresses.shape[1] / float(window_divisor))), 1)
+        statistics = process_statistics(
+            get_statistics(progresses, use_median, normalize_error),
+            smooth_curve,
+            clip_plot_value,
+            window_size,
+        )
+        _statistics_cache[cache_key] = statistics
+    return _statistics_cache[cache_key]
 
 
 def get_possible_values(distinct_params, key):
@@ -824,9 +893,11 @@ def parse_float_arg(args, key):
         return None
 
 
-@app.route("/plot_div")
-def plot_div():
-    args = flask.request.args
+def parse_plot_args(args):
+    """
+    Keyword arguments of get_plot_instruction from the query string sent by
+    the control panel.
+    """
     plot_keys_json = args.get("plot_keys")
     plot_keys = json.loads(plot_keys_json)
     x_keys_json = args.get("x_keys")
@@ -874,7 +945,7 @@ def plot_div():
     else:
         custom_series_splitter = None
 
-    plot_div = get_plot_instruction(
+    return dict(
         plot_keys=plot_keys,
         x_keys=x_keys,
         split_keys=split_keys,
@@ -899,9 +970,61 @@ def plot_div():
         make_bar_chart=make_bar_chart,
         custom_series_splitter=custom_series_splitter,
     )
+
+
+@app.route("/plot_div")
+def plot_div():
+    args = flask.request.args
+    # the same query always renders the same div until the data changes
+    query = tuple(sorted(args.items(multi=True)))
+    with data_lock:
+        if query in _plot_cache:
+            _plot_cache.move_to_end(query)
+            return _plot_cache[query]
+        plot_args = parse_plot_args(args)
+        plot_div = get_plot_instruction(**plot_args)
+        if not plot_args['gen_eps']:
+            _plot_cache[query] = plot_div
+            while len(_plot_cache) > PLOT_CACHE_SIZE:
+                _plot_cache.popitem(last=False)
     return plot_div
 
 
+@app.route("/live_plot")
+def live_plot():
+    """
+    Server-sent events with the figures of a plot_div query, pushed every
+    time the rows tailed by --live change them.
+    """
+    plot_args = parse_plot_args(flask.request.args)
+    plot_args['gen_eps'] = False
+
+    def stream():
+        version = data_version
+        last_payload = None
+        while True:
+            with data_changed:
+                data_changed.wait_for(
+                    lambda: data_version != version, timeout=LIVE_KEEPALIVE)
+            if data_version == version:
+                # keeps proxies from closing an idle stream
+                yield ": keepalive\n\n"
+                continue
+            version = data_version
+            with data_lock:
+                figures = get_plot_instruction(as_figures=True, **plot_args)
+            payload = json.dumps(figures, cls=plotly.utils.PlotlyJSONEncoder)
+            # runs that are not part of this query changed
+            if payload == last_payload:
+                continue
+            last_payload = payload
+            yield "event: update\ndata: %s\n\n" % payload
+
+    return flask.Response(
+        stream(), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache'})
+
+
 def safer_eval(some_string):
     """
     Not full-proof, but taking advice from:
@@ -922,7 +1045,8 @@ def index():
         plot_keys = plottable_keys[0:1]
     else:
         plot_keys = None
-    plot_div = get_plot_instruction(plot_keys=plot_keys)
+    with data_lock:
+        plot_div = get_plot_instruction(plot_keys=plot_keys)
     return flask.render_template(
         "main.html",
         plot_div=plot_div,
@@ -932,6 +1056,7 @@ def index():
         distinct_param_keys=[str(k) for k, v in distinct_params],
         distinct_params=dict([(str(k), list(map(str, v)))
                               for k, v in distinct_params]),
+        live=exps_tails is not None,
     )
 
 
@@ -945,16 +1070,72 @@ def reload_data():
     global exps_data
     global plottable_keys
     global distinct_params
-    exps_data = core.load_exps_data(
-        args.data_paths,
-        args.data_filename,
-        args.params_filename,
-        args.disable_variant,
-    )
-    plottable_keys = list(
-        set(flatten(list(exp.progress.keys()) for exp in exps_data)))
-    plottable_keys = sorted([k for k in plottable_keys if k is not None])
-    distinct_params = sorted(core.extract_distinct_params(exps_data))
+    global exps_index
+    global exps_tails
+    with data_lock:
+        _statistics_cache.clear()
+        _plot_cache.clear()
+        exps_data = core.load_exps_data(
+            args.data_paths,
+            args.data_filename,
+            args.params_filename,
+            args.disable_variant,
+            cache_dir='' if args.no_cache else None,
+            n_workers=args.workers,
+        )
+        plottable_keys = list(
+            set(flatten(list(exp.progress.keys()) for exp in exps_data)))
+        plottable_keys = sorted([k for k in plottable_keys if k is not None])
+        exps_index = core.ParamIndex(exps_data)
+        distinct_params = core.extract_distinct_params(exps_data, index=exps_index)
+        if args.live:
+            exps_tails = []
+            for exp in exps_data:
+                tail = core.ProgressTail(exp.progress_path, exp.progress)
+                exp.progress = tail.progress
+                exps_tails.append(tail)
+    notify_data_changed()
+
+
+def notify_data_changed():
+    global data_version
+    with data_changed:
+        data_version += 1
+        data_changed.notify_all()
+
+
+def poll_live_data():
+    """
+    Append the rows written since the last poll to the experiments, and drop
+    what was memoized from the ones that changed.
+    """
+    global plottable_keys
+    with data_lock:
+        changed = set()
+        for exp, tail in zip(exps_data, exps_tails):
+            try:
+                if tail.poll():
+                    changed.add(id(exp))
+            except Exception as e:
+                print("Could not tail %s: %s" % (tail.progress_path, e))
+        if not changed:
+            return
+        for cache_key in list(_statistics_cache):
+            if not changed.isdisjoint(cache_key[0]):
+                del _statistics_cache[cache_key]
+        _plot_cache.clear()
+        keys = set(plottable_keys)
+        for exp in exps_data:
+            if id(exp) in changed:
+                keys.update(k for k in exp.progress if k is not None)
+        plottable_keys = sorted(keys)
+    notify_data_changed()
+
+
+def live_loop(interval):
+    while True:
+        time.sleep(interval)
+        poll_live_data()
 
 
 def main():
@@ -971,6 +1152,15 @@ def main():
     parser.add_argument("--params-filename",
                         default='params.json',
                         help='name of params file.')
+    parser.add_argument("--workers", type=int, default=None,
+                        help='number of processes loading experiments.')
+    parser.add_argument("--no-cache", default=False, action='store_true',
+                        help='always re-read every experiment.')
+    parser.add_argument("--live", default=False, action='store_true',
+                        help='tail the progress files and push new rows to '
+                             'the open pages.')
+    parser.add_argument("--live-interval", type=float, default=5.,
+                        help='seconds between two polls of the progress files.')
     args = parser.parse_args(sys.argv[1:])
 
     # load all folders following a prefix
@@ -984,6 +1174,9 @@ def main():
                 args.data_paths.append(path)
     print("Importing data from {path}...".format(path=args.data_paths))
     reload_data()
+    if args.live:
+        threading.Thread(
+            target=live_loop, args=(args.live_interval,), daemon=True).start()
     port = args.port
     try:
         print("View http://localhost:%d in your browser" % port)
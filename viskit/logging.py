@@ -22,6 +22,7 @@ import torch
 import tempfile
 
 from viskit.tabulate import tabulate
+from viskit.core import PROGRESS_RECORD_DTYPE
 
 
 class TerminalTablePrinter(object):
@@ -71,6 +72,55 @@ def mkdir_p(path):
             raise
 
 
+class ColumnarProgress(object):
+    """
+    Append-only tabular log that viskit reads back as columns in one pass.
+
+    Each row is appended to file_name as (row, key, value) records, see
+    viskit.core.PROGRESS_RECORD_DTYPE, and key names to file_name + '.keys',
+    one json string per line. Rows can hold any subset of the keys, missing
+    values read back as nan.
+    """
+
+    def __init__(self, file_name, append=False):
+        self.file_name = file_name
+        self.keys_file_name = file_name + '.keys'
+        self.key_ids = {}
+        self.n_rows = 0
+        if append and osp.exists(file_name) and osp.exists(self.keys_file_name):
+            with open(self.keys_file_name) as f:
+                for line in f:
+                    self.key_ids[json.loads(line)] = len(self.key_ids)
+            records = np.fromfile(file_name, dtype=PROGRESS_RECORD_DTYPE)
+            if len(records) > 0:
+                self.n_rows = int(records['row'].max()) + 1
+        else:
+            open(file_name, 'wb').close()
+            open(self.keys_file_name, 'w').close()
+
+    def append(self, row):
+        values = {}
+        for k, v in row.items():
+            try:
+                values[k] = float(v)
+            except (TypeError, ValueError):
+                continue
+        new_keys = [k for k in values if k not in self.key_ids]
+        if new_keys:
+            # keys go first, so that readers never see records of unknown keys
+            with open(self.keys_file_name, 'a') as f:
+                for k in new_keys:
+                    self.key_ids[k] = len(self.key_ids)
+                    f.write(json.dumps(k) + '\n')
+        records = np.empty(len(values), dtype=PROGRESS_RECORD_DTYPE)
+        records['row'] = self.n_rows
+        records['key'] = [self.key_ids[k] for k in values]
+        records['value'] = list(values.values())
+        with open(self.file_name, 'ab') as f:
+            records.tofile(f)
+        self.n_rows += 1
+
+
 class Logger(object):
     def __init__(self):
         self._prefixes = []
@@ -87,6 +137,7 @@ class Logger(object):
         self._text_fds = {}
         self._tabular_fds = {}
         self._tabular_header_written = set()
+        self._columnar_outputs = {}
 
         self._snapshot_dir = None
         self._snapshot_mode = 'all'
@@ -122,11 +173,22 @@ class Logger(object):
     def remove_text_output(self, file_name):
         self._remove_output(file_name, self._text_outputs, self._text_fds)
 
-    def add_tabular_output(self, file_name, relative_to_snapshot_dir=False):
+    def add_tabular_output(self, file_name, relative_to_snapshot_dir=False,
+                           append=False):
         if relative_to_snapshot_dir:
             file_name = osp.join(self._snapshot_dir, file_name)
         self._add_output(file_name, self._tabular_outputs, self._tabular_fds,
-                         mode='w')
+                         mode='a' if append else 'w')
+        if append and self._tabular_fds[file_name].tell() > 0:
+            self._tabular_header_written.add(self._tabular_fds[file_name])
+
+    def add_columnar_output(self, file_name, relative_to_snapshot_dir=False,
+                            append=False):
+        if relative_to_snapshot_dir:
+            file_name = osp.join(self._snapshot_dir, file_name)
+        if file_name not in self._columnar_outputs:
+            mkdir_p(os.path.dirname(file_name))
+            self._columnar_outputs[file_name] = ColumnarProgress(file_name, append)
 
     def remove_tabular_output(self, file_name, relative_to_snapshot_dir=False):
         if relative_to_snapshot_dir:
@@ -275,6 +337,8 @@ class Logger(object):
                     self._tabular_header_written.add(tabular_fd)
                 writer.writerow(tabular_dict)
                 tabular_fd.flush()
+            for columnar in self._columnar_outputs.values():
+                columnar.append(tabular_dict)
             del self._tabular[:]
 
     def pop_prefix(self, ):
@@ -379,16 +443,42 @@ def create_log_dir(
     return log_dir
 
 
+def truncate_tabular(file_name, n_rows):
+    """
+    Keep the header and the first n_rows rows of a tabular log, so that a
+    resumed run does not repeat the rows written after its checkpoint.
+    """
+    if not osp.exists(file_name):
+        return
+    with open(file_name, 'r', newline='') as f:
+        rows = list(csv.reader(f))[:n_rows + 1]
+    with open(file_name, 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+
+
+def truncate_columnar(file_name, n_rows):
+    """
+    Columnar counterpart of truncate_tabular.
+    """
+    if not osp.exists(file_name):
+        return
+    records = np.fromfile(file_name, dtype=PROGRESS_RECORD_DTYPE)
+    records[records['row'] < n_rows].tofile(file_name)
+
+
 def setup_logger(
         exp_prefix="default",
         variant=None,
         text_log_file="debug.log",
         variant_log_file="variant.json",
         tabular_log_file="progress.csv",
+        columnar_log_file="progress.records",
         snapshot_mode="last",
         snapshot_gap=1,
         log_tabular_only=False,
         base_log_dir=None,
+        log_dir=None,
+        resume_rows=None,
         **create_log_dir_kwargs
 ):
     """
@@ -411,11 +501,14 @@ def setup_logger(
     :param log_tabular_only:
     :param snapshot_gap:
     :param log_dir:
+    :param resume_rows: If set, keep that many rows of the existing tabular
+    log in log_dir and append to it.
     :return:
     """
-    log_dir = create_log_dir(
-        exp_prefix, base_log_dir=base_log_dir, **create_log_dir_kwargs
-    )
+    if log_dir is None:
+        log_dir = create_log_dir(
+            exp_prefix, base_log_dir=base_log_dir, **create_log_dir_kwargs
+        )
 
     if variant is not None:
         logger.log("Variant:")
@@ -427,7 +520,14 @@ def setup_logger(
     text_log_path = osp.join(log_dir, text_log_file)
 
     logger.add_text_output(text_log_path)
-    logger.add_tabular_output(tabular_log_path)
+    if resume_rows is not None:
+        truncate_tabular(tabular_log_path, resume_rows)
+    logger.add_tabular_output(tabular_log_path, append=resume_rows is not None)
+    if columnar_log_file is not None:
+        columnar_log_path = osp.join(log_dir, columnar_log_file)
+        if resume_rows is not None:
+            truncate_columnar(columnar_log_path, resume_rows)
+        logger.add_columnar_output(columnar_log_path, append=resume_rows is not None)
     logger.set_snapshot_dir(log_dir)
     logger.set_snapshot_mode(snapshot_mode)
     logger.set_snapshot_gap(snapshot_gap)